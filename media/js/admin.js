@@ -61,7 +61,8 @@ $(document).ready(function() {
       update_sendmail_count();
    });
 
-   $('input.mailcheckbox').change(function() {
+   /* Delegated, since lists loaded from the server add rows dynamically */
+   $(document).on('change', 'input.mailcheckbox', function() {
       update_sendmail_count();
    });
 
@@ -87,7 +88,7 @@ $(document).ready(function() {
       update_assign_count();
    });
 
-   $('input.assigncheckbox').change(function() {
+   $(document).on('change', 'input.assigncheckbox', function() {
       update_assign_count();
    });
 
@@ -884,6 +884,7 @@ class ConferenceSessionSlideManager(object):
 class BackendConferenceSessionForm(BackendForm):
     helplink = 'schedule#sessions'
     list_fields = ['title', 'q_speaker_list', 'q_status_string', 'starttime', 'track', 'room', 'cross_schedule']
+    list_server_side = True
     verbose_field_names = {
         'q_speaker_list': 'Speakers',
         'q_status_string': 'Status',
@@ -1138,6 +1139,7 @@ class BackendNewSpeakerForm(BackendBeforeNewForm):
 class BackendGlobalSpeakerForm(BackendForm):
     helplink = 'schedule#speakers'
     list_fields = ['fullname', 'user', 'company', ]
+    list_server_side = True
     markdown_fields = ['abstract', ]
     exclude_fields_from_validation = ['photo512', ]
     # We must save the photo field as well, since it's being updaed in the pre_save signal,
@@ -7,14 +7,13 @@ from django.db import transaction
 from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
-from django.utils import timezone
+from django.utils import timezone, dateformat
+from django.utils.dateparse import parse_datetime
 from django.conf import settings
 
 from collections import OrderedDict
 import re
 
-from postgresqleu.util.db import exec_to_list
-from postgresqleu.util.db import ensure_conference_timezone
 from postgresqleu.util.qr import generate_base64_qr
 from postgresqleu.util.decorators import global_login_exempt
 from postgresqleu.util.request import get_int_or_error
@@ -22,6 +21,8 @@ from postgresqleu.util.time import datetime_string
 from postgresqleu.confsponsor.scanning import SponsorScannerHandler, SponsorScanner
 
 from .models import ConferenceRegistration
+from .checkincache import get_checkin_snapshot, get_registration_changes
+from .checkincache import get_sync_scans, get_token_hash
 from .util import render_conference_response, reglog
 from .util import get_conference_or_404
 from .util import get_conference_scanner_permissions
@@ -231,31 +232,33 @@ def _json_response(d):
 
 
 def _get_statistics(conference):
+    regtypes, users, latest = get_checkin_snapshot(conference, _get_reg_json).checkin_statistics(10)
     return [
         (
             ('Registration types', 'Done', 'Left'),
-            exec_to_list("SELECT regtype, count(1) FILTER (WHERE checkedinat IS NOT NULL), count(1) FILTER (WHERE checkedinat IS NULL) FROM confreg_conferenceregistration r INNER JOIN confreg_registrationtype rt ON rt.id=r.regtype_id WHERE r.conference_id=%(confid)s AND payconfirmedat IS NOT NULL AND canceledat IS NULL GROUP BY ROLLUP(1) ORDER BY 1", {'confid': conference.id})
+            regtypes + [(None, sum(r[1] for r in regtypes), sum(r[2] for r in regtypes))],
         ),
         (
             ('Check in users', 'Done', ''),
-            exec_to_list("SELECT username, count(1), NULL FROM confreg_conferenceregistration r INNER JOIN confreg_conferenceregistration r2 ON r2.id=r.checkedinby_id INNER JOIN auth_user u ON u.id=r2.attendee_id WHERE r.conference_id=%(confid)s AND r.payconfirmedat IS NOT NULL AND r.canceledat IS NULL AND r.checkedinat IS NOT NULL GROUP BY 1 ORDER BY 2 DESC", {'confid': conference.id})
+            [(u, n, None) for u, n in users],
         ),
         (
             ('Latest checkins', 'By', 'Who'),
-            exec_to_list("SELECT to_char(r.checkedinat, 'ddth hh24:mi:ss'), username, r.firstname || ' ' || r.lastname FROM confreg_conferenceregistration r INNER JOIN confreg_conferenceregistration r2 ON r2.id=r.checkedinby_id INNER JOIN auth_user u ON u.id=r2.attendee_id WHERE r.conference_id=%(confid)s AND r.payconfirmedat IS NOT NULL AND r.canceledat IS NULL AND r.checkedinat IS NOT NULL ORDER BY r.checkedinat DESC LIMIT 10", {"confid": conference.id})
+            [(dateformat.format(timezone.localtime(t, conference.tzobj), 'dS H:i:s'), u, n) for t, u, n in latest],
         ),
     ]
 
 
 def _get_field_statistics(conference):
+    fields, latest = get_checkin_snapshot(conference, _get_reg_json).field_statistics(20)
     return [
         (
             ('Field', 'Done', 'Left'),
-            exec_to_list("SELECT field, count(1) FILTER (WHERE r.dynaprops ? field), count(1) FILTER (WHERE NOT r.dynaprops ? field) FROM (SELECT id, regexp_split_to_table(scannerfields, ',') AS field FROM confreg_conference WHERE id=%(confid)s) AS x LEFT JOIN confreg_conferenceregistration r ON r.conference_id=%(confid)s GROUP BY 1 ORDER BY 1", {'confid': conference.id})
+            fields,
         ),
         (
             ('Latest scans', 'Field', 'Who'),
-            exec_to_list("SELECT to_char((dynaprops->field)::text::timestamptz, 'ddth hh24:mi:ss'), field, r.firstname || ' ' || r.lastname FROM (SELECT id, regexp_split_to_table(scannerfields, ',') AS field FROM confreg_conference WHERE id=%(confid)s) AS x INNER JOIN confreg_conferenceregistration r ON r.conference_id=%(confid)s AND r.dynaprops ? field ORDER BY 1 desc LIMIT 20", {"confid": conference.id})
+            [(dateformat.format(parse_datetime(t), 'dS H:i:s'), f, n) for t, f, n in latest],
         ),
     ]
 
@@ -295,6 +298,37 @@ def _get_reg_json(r, fieldscan=False):
     return d
 
 
+# Compact version of the registration for the attendee lists downloaded by scanner apps
+def _get_roster_entry(r, tokenfield, fieldscan=None):
+    return {
+        'id': r.id,
+        'tokenhash': get_token_hash(getattr(r, tokenfield)),
+        'name': r.fullname,
+        'type': r.regtype.regtype,
+        'partition': r.queuepartition,
+        'done': r.dynaprops.get(fieldscan, None) if fieldscan else r.checkedinat,
+    }
+
+
+# List of attendees for the apps to work offline, either complete or the changes
+# since the version the app already has.
+def _get_roster(conference, since, tokenfield, fieldscan=None):
+    version, full, regs = get_registration_changes(conference, since)
+    entries = []
+    removed = []
+    for r in regs:
+        if r.payconfirmedat and not r.canceledat:
+            entries.append(_get_roster_entry(r, tokenfield, fieldscan))
+        elif not full:
+            removed.append(r.id)
+    return {
+        'version': version,
+        'full': full,
+        'regs': entries,
+        'removed': removed,
+    }
+
+
 _idtokenmatcher = re.compile('^{}/t/id/([^/]+)/$'.format(settings.SITEBASE))
 _publictokenmatcher = re.compile('^{}/t/at/([^/]+)/$'.format(settings.SITEBASE))
 
@@ -331,27 +365,81 @@ def _checkin_api(request, urlname, regtoken, what, tokenfield, tokenmatcher, fie
             token = m.group(1)
         else:
             raise Http404()
-        r = get_object_or_404(ConferenceRegistration, conference=conference, payconfirmedat__isnull=False, canceledat__isnull=True, **{tokenfield: token})
-        return _json_response({'reg': _get_reg_json(r, fieldname)})
+        r = get_checkin_snapshot(conference, _get_reg_json).lookup(tokenfield, token, fieldname)
+        if r is None:
+            raise Http404()
+        return _json_response({'reg': r})
     elif cansearch and what == 'search':
         s = request.GET.get('search').strip()
         if not s:
             return _json_response({'regs': []})
-        q = Q()
-        for n in s.split():
-            # For each part of the given string, search both first and last name
-            # When two or more name parts are specified, require that they all match,
-            # but don't care which one matches which part.
-            q = q & (Q(firstname__icontains=n) | Q(lastname__icontains=n))
+        # For each part of the given string, search both first and last name
+        # When two or more name parts are specified, require that they all match,
+        # but don't care which one matches which part.
         return _json_response({
-            'regs': [_get_reg_json(r) for r in ConferenceRegistration.objects.filter(
-                q,
-                conference=conference, payconfirmedat__isnull=False, canceledat__isnull=True,
-            )],
+            'regs': get_checkin_snapshot(conference, _get_reg_json).search(s),
         })
     elif is_admin and what == 'stats':
-        with ensure_conference_timezone(conference):
-            return _json_response(getstats(conference))
+        return _json_response(getstats(conference))
+    elif what == 'roster':
+        return _json_response(_get_roster(conference, request.GET.get('since', None), tokenfield, fieldname))
+    elif request.method == 'POST' and what == 'sync':
+        # Store a batch of scans made by the app, possibly while it was offline. They are
+        # processed in the order they were made, with the same rules as when stored one
+        # by one, so the first one to check in an attendee wins. Attendees can only be
+        # referenced by id in apps that can search for them.
+        scans = get_sync_scans(request, conference)
+        if isinstance(scans, HttpResponse):
+            return scans
+
+        for scan in scans:
+            if 'token' in scan:
+                m = tokenmatcher.match(scan['token'])
+                if m:
+                    scan['token'] = m.group(1)
+
+        results = []
+        with transaction.atomic():
+            # Lock all the registrations in a consistent order, so concurrent syncs of the
+            # same attendees from different devices are processed one after the other.
+            valid = [s for s in scans if 'rejected' not in s]
+            regs = list(ConferenceRegistration.objects.select_related('conference', 'regtype').select_for_update(of=('self', )).filter(
+                Q(**{'{}__in'.format(tokenfield): [s['token'] for s in valid if 'token' in s]}) |
+                Q(id__in=[s['id'] for s in valid if cansearch and 'token' not in s]),
+                conference=conference, payconfirmedat__isnull=False, canceledat__isnull=True,
+            ).order_by('id'))
+            regs_by_token = {getattr(r, tokenfield): r for r in regs}
+            regs_by_id = {r.id: r for r in regs}
+
+            for scan in scans:
+                if 'token' in scan:
+                    reg = regs_by_token.get(scan['token'], None)
+                    result = {'token': scan['token']}
+                else:
+                    reg = regs_by_id.get(scan['id'], None) if cansearch else None
+                    result = {'id': scan['id']}
+
+                if 'rejected' in scan:
+                    result.update({'status': 400, 'message': scan['rejected']})
+                elif reg is None:
+                    result.update({'status': 404, 'message': 'Attendee not found'})
+                else:
+                    status, msg = store(reg, user, scan['at'])
+                    result.update({
+                        'status': status or 200,
+                        'message': msg if status else message(reg),
+                        'reg': _get_roster_entry(reg, tokenfield, fieldname),
+                    })
+                results.append(result)
+
+        # Include any changes since the previous sync, so the app can stay up to date
+        # with a single request.
+        if 'since' in request.GET:
+            return _json_response({
+                'results': results,
+                **_get_roster(conference, request.GET['since'], tokenfield, fieldname)
+            })
+        return _json_response({'results': results})
     elif request.method == 'POST' and what == 'store':
         if not conference.checkinactive:
             return HttpResponse("Check-in not open", status=412)
@@ -365,7 +453,7 @@ def _checkin_api(request, urlname, regtoken, what, tokenfield, tokenmatcher, fie
         reg = get_object_or_404(ConferenceRegistration, conference=conference, payconfirmedat__isnull=False, canceledat__isnull=True, **{tokenfield: token})
 
         with transaction.atomic():
-            status, msg = store(reg, user)
+            status, msg = store(reg, user, timezone.now())
             if status is not None:
                 return HttpResponse(msg, status=status, content_type='text/plain')
 
@@ -381,11 +469,11 @@ def _checkin_api(request, urlname, regtoken, what, tokenfield, tokenmatcher, fie
 @csrf_exempt
 @global_login_exempt
 def api(request, urlname, regtoken, what):
-    def _store(reg, user):
+    def _store(reg, user, when):
         if reg.checkedinat:
             return 412, "Already checked in."
 
-        reg.checkedinat = timezone.now()
+        reg.checkedinat = when
         reg.checkedinby = user
         reg.save()
         return None, None
@@ -406,12 +494,12 @@ def api(request, urlname, regtoken, what):
 @csrf_exempt
 @global_login_exempt
 def checkin_field_api(request, urlname, regtoken, fieldname, what):
-    def _store(reg, user):
+    def _store(reg, user, when):
         if not reg.checkedinat:
             return 412, "Attendee not checked in."
 
         reglog(reg, "Marked scanner field {}".format(fieldname), user.attendee)
-        reg.dynaprops[fieldname] = datetime_string(timezone.now())
+        reg.dynaprops[fieldname] = datetime_string(when)
         reg.save(update_fields=['dynaprops'])
         return None, None
 
@@ -0,0 +1,308 @@
+# Per-process snapshot of the registrations of a conference, used by the
+# check-in scanners to look up tokens and search names without querying
+# and serializing the registrations for each scan.
+#
+# Changes to registrations are picked up incrementally. A trigger stamps each
+# registration with the id of the last transaction that inserted or updated
+# it (changes to the additional options of a registration touch it as well).
+# Each time the snapshot is used, it looks at the registrations stamped by any
+# transaction that may have committed since the previous refresh, which are
+# the ones with an id at or above the oldest transaction that was running at
+# the time, and reloads the ones that it has not already seen with the same
+# transaction id. Anything else that affects the output, such as deleted
+# registrations, registration types, additional options and shirt sizes,
+# increments the checkin data version of the conference, which causes a full
+# reload.
+#
+# The check-in statistics are maintained the same way, by counting each
+# registration as it is loaded and uncounting it when it's removed or reloaded,
+# so polling them does not need to look at all the registrations.
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from collections import defaultdict, Counter
+from datetime import datetime, time, timedelta
+import bisect
+import hashlib
+import json
+import threading
+
+from postgresqleu.util.db import exec_to_list
+from postgresqleu.util.lrucache import LRUCache
+from .models import ConferenceRegistration
+
+
+_checkin_cache = LRUCache(20)
+
+
+def _trigrams(s):
+    return set(s[i:i + 3] for i in range(len(s) - 2))
+
+
+def _sorted_remove(lst, entry):
+    del lst[bisect.bisect_left(lst, entry)]
+
+
+class CheckinSnapshot:
+    def __init__(self, conference, key, builder, xmin):
+        self.conference = conference
+        self.key = key
+        self.xmin = xmin
+        self._builder = builder
+        self._lock = threading.Lock()
+
+        # Eligible registrations by id, with the tokens mapped to the id
+        self._regs = {}
+        # Transaction id of the loaded version of each registration
+        self._xids = {}
+        self._tokens = {
+            'idtoken': {},
+            'publictoken': {},
+        }
+        # Index of the trigrams of the lowercased first and last names
+        self._trigrams = defaultdict(set)
+
+        # Statistics: number of done and left per registration type, number of
+        # check-ins per user and number of marks per scanner field
+        self._regtypes = defaultdict(lambda: [0, 0])
+        self._checkinusers = Counter()
+        self._fields = Counter()
+        # All check-ins as (checkedinat, id) and scanner field marks as (time, field, id),
+        # kept sorted so the latest ones are at the end.
+        self._latest = []
+        self._latestfields = []
+
+        self._load(self._get_queryset())
+
+    def _get_queryset(self):
+        return ConferenceRegistration.objects.select_related(
+            'conference', 'regtype', 'shirtsize', 'checkedinby', 'checkedinby__attendee',
+        ).prefetch_related('additionaloptions').filter(conference=self.conference).extra(
+            select={'checkinxid': 'confreg_conferenceregistration.checkinxid'},
+        )
+
+    def _count(self, regid, r, n):
+        self._regtypes[r['regtype']][0 if r['checkedinat'] else 1] += n
+        if r['checkedinat'] and r['checkedinby']:
+            self._checkinusers[r['checkedinby']] += n
+            if n > 0:
+                bisect.insort(self._latest, (r['checkedinat'], regid))
+            else:
+                _sorted_remove(self._latest, (r['checkedinat'], regid))
+        for f, t in r['fields'].items():
+            self._fields[f] += n
+            if n > 0:
+                bisect.insort(self._latestfields, (t, f, regid))
+            else:
+                _sorted_remove(self._latestfields, (t, f, regid))
+
+    def _remove(self, regid):
+        r = self._regs.pop(regid, None)
+        if r:
+            for f, t in self._tokens.items():
+                t.pop(r[f], None)
+            for t in _trigrams(r['firstname']) | _trigrams(r['lastname']):
+                self._trigrams[t].discard(regid)
+            self._count(regid, r, -1)
+
+    def _load(self, regs):
+        for reg in regs:
+            self._remove(reg.id)
+            self._xids[reg.id] = reg.checkinxid
+            if not reg.payconfirmedat or reg.canceledat:
+                continue
+
+            # The output for regular check-in, and for each of the scanner fields
+            json = {None: self._builder(reg)}
+            for f in self.conference.scannerfields_list:
+                json[f] = self._builder(reg, f)
+
+            r = {
+                'idtoken': reg.idtoken,
+                'publictoken': reg.publictoken,
+                'firstname': reg.firstname.lower(),
+                'lastname': reg.lastname.lower(),
+                'json': json,
+                'name': reg.fullname,
+                'regtype': reg.regtype.regtype,
+                'checkedinat': reg.checkedinat,
+                'checkedinby': reg.checkedinby and reg.checkedinby.attendee and reg.checkedinby.attendee.username,
+                # Marked scanner fields are stored as strings in the conference timezone,
+                # which sort the same way as the times they represent.
+                'fields': {f: reg.dynaprops[f] for f in self.conference.scannerfields_list if f in reg.dynaprops},
+            }
+            self._regs[reg.id] = r
+            self._count(reg.id, r, 1)
+            for f, t in self._tokens.items():
+                t[r[f]] = reg.id
+            for t in _trigrams(r['firstname']) | _trigrams(r['lastname']):
+                self._trigrams[t].add(reg.id)
+
+    # Refresh with a list of (id, transaction id) for the registrations that may have
+    # changed. The list can contain the same registrations over and over again while
+    # an old transaction is still running, so only reload those not already loaded.
+    def refresh(self, changed, xmin):
+        with self._lock:
+            regids = [regid for regid, xid in changed if self._xids.get(regid, None) != xid]
+            if regids:
+                found = self._get_queryset().filter(id__in=regids)
+                self._load(found)
+                # Anything that wasn't found was deleted, which is normally handled
+                # by a full reload, but don't leave them around if it happens anyway.
+                for regid in set(regids) - set(r.id for r in found):
+                    self._remove(regid)
+            self.xmin = xmin
+
+    def lookup(self, tokenfield, token, fieldname=None):
+        with self._lock:
+            regid = self._tokens[tokenfield].get(token, None)
+            if regid is None:
+                return None
+            return self._regs[regid]['json'].get(fieldname, None)
+
+    # Search for registrations where each part of the string matches either the
+    # first or the last name, the same way as a case insensitive substring search.
+    def search(self, s):
+        with self._lock:
+            matches = None
+            for n in s.lower().split():
+                if len(n) >= 3:
+                    candidates = set.intersection(*(self._trigrams.get(t, set()) for t in _trigrams(n)))
+                else:
+                    candidates = self._regs.keys()
+                found = set(
+                    regid for regid in candidates
+                    if n in self._regs[regid]['firstname'] or n in self._regs[regid]['lastname']
+                )
+                matches = found if matches is None else matches & found
+            return [self._regs[regid]['json'][None] for regid in sorted(matches or [])]
+
+    # Returns the number of done and left per registration type, the number of
+    # check-ins per user, and the latest check-ins as (time, user, name).
+    def checkin_statistics(self, latest):
+        with self._lock:
+            return (
+                sorted((regtype, done, left) for regtype, (done, left) in self._regtypes.items() if done or left),
+                [(u, n) for u, n in self._checkinusers.most_common() if n],
+                [(t, self._regs[regid]['checkedinby'], self._regs[regid]['name']) for t, regid in reversed(self._latest[-latest:])],
+            )
+
+    # Returns the number of done and left per scanner field, and the latest marks
+    # as (time, field, name).
+    def field_statistics(self, latest):
+        with self._lock:
+            return (
+                [(f, self._fields[f], len(self._regs) - self._fields[f]) for f in sorted(self.conference.scannerfields_list)],
+                [(t, f, self._regs[regid]['name']) for t, f, regid in reversed(self._latestfields[-latest:])],
+            )
+
+
+# Get the current check-in snapshot for a conference, creating it or bringing it
+# up to date as necessary. The builder is called with a registration and optionally
+# the name of a scanner field, and returns what should be returned for it.
+# If called in a transaction that has made changes, the snapshot it sees includes
+# changes that may still be rolled back, so it's not shared with anything else.
+def get_checkin_snapshot(conference, builder):
+    snapshot = _checkin_cache.get(conference.id)
+
+    # Get the data version, the oldest transaction still running, our own transaction
+    # if we have made any changes, and if there is a snapshot also the registrations
+    # changed since the previous refresh, all in a single roundtrip.
+    version, xmin, ownxid, changed = exec_to_list("""SELECT version, txid_snapshot_xmin(txid_current_snapshot()), txid_current_if_assigned(),
+ ARRAY(SELECT ARRAY[id, checkinxid] FROM confreg_conferenceregistration WHERE conference_id=%(confid)s AND checkinxid >= %(since)s)
+FROM confreg_conferencedataversion WHERE conference_id=%(confid)s AND datatype='checkin'""", {
+        'confid': conference.id,
+        'since': snapshot.xmin if snapshot else None,
+    })[0]
+
+    key = (
+        version,
+        conference.askphotoconsent,
+        conference.confirmpolicy,
+        conference.scannerfields,
+    )
+    if ownxid is not None:
+        return CheckinSnapshot(conference, key, builder, xmin)
+    if snapshot is None or snapshot.key != key:
+        snapshot = CheckinSnapshot(conference, key, builder, xmin)
+        _checkin_cache.set(conference.id, snapshot)
+    else:
+        snapshot.refresh(changed, xmin)
+    return snapshot
+
+
+# Get the registrations of a conference that have changed since a version previously
+# returned from here, for the scanner apps that keep their own copy of the attendee
+# list. Returns a tuple of the new version, whether this is a full list (in which
+# case anything not included should be removed), and a queryset of the registrations.
+# The registrations are not filtered on being confirmed or not, since registrations
+# that are no longer eligible need to be removed by the client.
+def get_registration_changes(conference, since):
+    version, xmin = exec_to_list("SELECT version, txid_snapshot_xmin(txid_current_snapshot()) FROM confreg_conferencedataversion WHERE conference_id=%(confid)s AND datatype='checkin'", {
+        'confid': conference.id,
+    })[0]
+
+    regs = ConferenceRegistration.objects.select_related('conference', 'regtype').filter(conference=conference)
+
+    try:
+        sinceversion, sincexmin = map(int, (since or '').split('-'))
+    except ValueError:
+        sinceversion = sincexmin = None
+
+    if sinceversion == version:
+        return ('{}-{}'.format(version, xmin), False, regs.extra(where=['checkinxid >= %s'], params=[sincexmin]))
+    else:
+        return ('{}-{}'.format(version, xmin), True, regs)
+
+
+# Max number of scans accepted in a single sync from a scanner app
+MAX_SYNC_SCANS = 500
+
+# Max time a scanner app can have been offline, and still sync the scans it made
+MAX_SYNC_SCAN_AGE = timedelta(hours=12)
+
+
+# The attendee lists given to the scanner apps contain hashes of the tokens rather
+# than the tokens themselves, so they can validate a scanned token while offline
+# without being able to produce valid tokens for attendees they haven't scanned.
+def get_token_hash(token):
+    return hashlib.sha256(token.encode('utf8')).hexdigest()
+
+
+# Parse the list of scans uploaded by a scanner app, which is a JSON object with a
+# list of scans in "scans", each having a "token" (or for apps that get the id of
+# the registrations, an "id") and the time of the scan in "at", and optionally
+# other fields. Returns the scans ordered by the time they were made,
+# with the time parsed (times in the future are assumed to be clock skew and set to
+# the current time), or a HttpResponse with the error. Scans made before the start
+# of the conference, or longer ago than an app can be expected to be offline, can't
+# be stored, since the app would otherwise decide what time is stored. They are
+# returned with the reason in "rejected", and should be reported back for each scan
+# without affecting the rest of them.
+def get_sync_scans(request, conference):
+    now = timezone.now()
+    earliest = max(
+        datetime.combine(conference.startdate, time.min, tzinfo=conference.tzobj),
+        now - MAX_SYNC_SCAN_AGE,
+    )
+    try:
+        scans = json.loads(request.body)['scans']
+        if not isinstance(scans, list):
+            raise ValueError()
+        for scan in scans:
+            at = parse_datetime(scan['at'])
+            if at is None or timezone.is_naive(at):
+                return HttpResponse("Invalid scan time {}".format(scan['at']), status=400)
+            if at < earliest:
+                scan['rejected'] = "Scan time {} is too old".format(scan['at'])
+            scan['at'] = min(at, now)
+            if not isinstance(scan.get('token', None), str) and not isinstance(scan.get('id', None), int):
+                raise ValueError()
+    except (ValueError, KeyError, TypeError):
+        return HttpResponse("Invalid sync data", status=400)
+
+    if len(scans) > MAX_SYNC_SCANS:
+        return HttpResponse("Too many scans, max {} can be synced at once".format(MAX_SYNC_SCANS), status=400)
+
+    return sorted(scans, key=lambda s: s['at'])
@@ -0,0 +1,83 @@
+# Conditional GET support for the public conference endpoints.
+#
+# Each endpoint computes a cheap token for the current version of the data
+# it returns, normally based on the data versions maintained by triggers in
+# confreg_conferencedataversion, and if the client (or a proxy in front of
+# us) already has that version a 304 is returned without building the
+# response at all.
+from django.conf import settings
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+import hashlib
+
+from postgresqleu.util.db import exec_to_scalar, exec_to_list
+from .contextutil import find_cached_git_revision
+from .models import Conference
+
+
+def get_data_version(conference, datatype):
+    return exec_to_scalar("SELECT version FROM confreg_conferencedataversion WHERE conference_id=%(confid)s AND datatype=%(datatype)s", {
+        'confid': conference.id,
+        'datatype': datatype,
+    }) or 0
+
+
+# The news version also has to change when a news item that was posted with
+# a time in the future becomes visible, so include the time of the latest
+# visible one. Returns the version and the time of the last modification.
+def get_news_version(conference):
+    r = exec_to_list("""SELECT v.version, greatest(v.lastmodified, (
+  SELECT max(datetime) FROM confreg_conferencenews n WHERE n.conference_id=v.conference_id AND datetime<CURRENT_TIMESTAMP
+)) FROM confreg_conferencedataversion v WHERE v.conference_id=%(confid)s AND v.datatype='news'""", {
+        'confid': conference.id,
+    })
+    if not r:
+        return (0, None)
+    return r[0]
+
+
+# Revision of the templates used to render pages for this conference, or
+# None if it cannot be determined, in which case pages cannot be cached.
+def get_template_revision(conference):
+    coderev = find_cached_git_revision(settings.PROJECT_ROOT)
+    if coderev is None:
+        return None
+    if conference.jinjaenabled and conference.jinjadir:
+        confrev = find_cached_git_revision(conference.jinjadir)
+        if confrev is None:
+            return None
+        return (coderev, confrev)
+    return (coderev, )
+
+
+def conference_etag(conference, *parts):
+    # Templates can use any field of the conference, so include all of them
+    sig = [getattr(conference, f.attname) for f in Conference._meta.concrete_fields]
+    return '"{}"'.format(hashlib.sha1(repr((sig, parts)).encode('utf8')).hexdigest())
+
+
+# Return a 304 if the client already has the version identified by etag and/or
+# lastmodified, or otherwise the response generated by builder. Public responses
+# can be cached by proxies for PUBLIC_FEED_CACHE_TIME seconds, private ones
+# must always be revalidated.
+def conditional_response(request, builder, etag=None, lastmodified=None, public=True):
+    r = get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(lastmodified.timestamp()) if lastmodified else None,
+    )
+    if r is None:
+        r = builder()
+        if r.status_code != 200:
+            return r
+
+    if etag:
+        r['ETag'] = etag
+    if lastmodified:
+        r['Last-Modified'] = http_date(lastmodified.timestamp())
+    if public:
+        patch_cache_control(r, public=True, max_age=settings.PUBLIC_FEED_CACHE_TIME)
+    else:
+        patch_cache_control(r, private=True, no_cache=True)
+    return r
@@ -83,49 +83,147 @@ def update_with_override_context(context, rootdir):
 
 # Locate the git revision for a repository in the given path, including
 # walking up the tree to find it if the specified path is not the root.
-def find_git_revision(path):
+# Returns the revision and a list of the files that it was read from.
+def _find_git_revision_and_files(path):
     while path != '/':
         if os.path.exists(os.path.join(path, ".git/HEAD")):
             # Found it!
             with open(os.path.join(path, '.git/HEAD')) as f:
                 ref = f.readline().strip()
             if not ref.startswith('ref: refs/heads/'):
-                return None
+                return None, [os.path.join(path, '.git/HEAD')]
             refname = os.path.join(path, ".git/", ref[5:])
             if not os.path.isfile(refname):
-                return None
+                return None, [os.path.join(path, '.git/HEAD'), refname]
             with open(refname) as f:
                 fullref = f.readline()
-                return fullref[:7]
+                return fullref[:7], [os.path.join(path, '.git/HEAD'), refname]
         elif os.path.exists(os.path.join(path, ".deploystatic_githash")):
             with open(os.path.join(path, ".deploystatic_githash")) as f:
-                return f.readline().strip()
+                return f.readline().strip(), [os.path.join(path, ".deploystatic_githash")]
 
         # Else step up one level
         path = os.path.dirname(path)
     # If no direct git hash found, search for a deploystatic file
-    return None
+    return None, []
+
+
+def find_git_revision(path):
+    return _find_git_revision_and_files(path)[0]
+
+
+def _stat_signature(filenames):
+    sig = []
+    for fn in filenames:
+        try:
+            st = os.stat(fn)
+            sig.append((fn, st.st_mtime_ns, st.st_size))
+        except OSError:
+            sig.append((fn, None, None))
+    return tuple(sig)
+
+
+#
+# Parsing the context files and finding the git revision is done for every
+# page and every email rendered, so keep a cache of them per directory. The
+# cache is invalidated whenever any of the files that were read change.
+#
+_git_revision_cache = {}
+_context_cache = {}
+
+
+def find_cached_git_revision(path):
+    cached = _git_revision_cache.get(path, None)
+    if cached and _stat_signature(cached[1]) == cached[2]:
+        return cached[0]
+
+    revision, files = _find_git_revision_and_files(path)
+    _git_revision_cache[path] = (revision, files, _stat_signature(files))
+    return revision
+
+
+def _get_context_files(rootdir):
+    files = [
+        os.path.join(rootdir, 'templates/context.json'),
+        os.path.join(rootdir, 'templates/context.yaml'),
+    ]
+    if os.path.isdir(os.path.join(rootdir, 'templates/context.override.d')):
+        files.extend([
+            os.path.join(rootdir, 'templates/context.override.d', fn)
+            for fn in sorted(os.listdir(os.path.join(rootdir, 'templates/context.override.d')))
+        ])
+    return files
+
+
+class _CachedContext:
+    def __init__(self, rootdir, signature):
+        self.signature = signature
+        self.base = load_base_context(rootdir)
+        self.override = load_override_context(rootdir)
+
+        # For keys where the override context is merged into a dict in the base
+        # context, pre-merge them so it doesn't have to be done on every call.
+        self.merged = {}
+        for k, v in self.override.items():
+            if isinstance(v, dict) and isinstance(self.base.get(k, None), dict):
+                self.merged[k] = {}
+                deep_update_context(self.merged[k], self.base[k])
+                deep_update_context(self.merged[k], v)
+
+
+def _get_cached_context(rootdir):
+    signature = _stat_signature(_get_context_files(rootdir))
+    cached = _context_cache.get(rootdir, None)
+    if cached is None or cached.signature != signature:
+        cached = _CachedContext(rootdir, signature)
+        _context_cache[rootdir] = cached
+    return cached
+
+
+# Apply the cached context to a context built from the cached base context.
+# Everything that comes from the cache is deep copied, so that modifying the
+# returned context (in a view or in a template) can't change the cache.
+def _apply_cached_context(context, cached):
+    for k, v in cached.override.items():
+        if k in cached.merged and context.get(k, None) is cached.base[k]:
+            # Value is still the one from the base context, so use the pre-merged
+            # version of it.
+            context[k] = copy.deepcopy(cached.merged[k])
+        elif isinstance(v, dict) and isinstance(context.get(k, None), dict):
+            # Value was replaced by the caller, so merge into a copy of it.
+            merged = {}
+            deep_update_context(merged, context[k])
+            deep_update_context(merged, copy.deepcopy(v))
+            context[k] = merged
+        else:
+            context[k] = copy.deepcopy(v)
+
+    for k, v in cached.base.items():
+        if context.get(k, None) is v:
+            context[k] = copy.deepcopy(v)
 
 
 def load_all_context(conference, inject, dictionary=None):
     if conference and conference.jinjaenabled and conference.jinjadir:
         try:
-            c = load_base_context(conference.jinjadir)
+            cached = _get_cached_context(conference.jinjadir)
         except ValueError as e:
             return HttpResponse("JSON parse failed: {0}".format(e), content_type="text/plain")
+        c = dict(cached.base)
     else:
+        cached = None
         c = {}
 
     c.update(inject)
 
-    if conference and conference.jinjaenabled and conference.jinjadir:
-        c['githash'] = find_git_revision(conference.jinjadir)
+    if cached:
+        c['githash'] = find_cached_git_revision(conference.jinjadir)
 
     if dictionary:
         c.update(dictionary)
 
-    if conference and conference.jinjaenabled and conference.jinjadir:
-        update_with_override_context(c, conference.jinjadir)
+    if cached:
+        _apply_cached_context(c, cached)
 
     c.update(settings_context())
 
@@ -5,6 +5,7 @@ from django.template.defaultfilters import slugify
 
 from .models import Conference
 from .util import get_conference_or_404
+from .conditional import conditional_response, conference_etag, get_news_version
 
 from postgresqleu.util.db import exec_to_dict, ensure_conference_timezone
 
@@ -12,8 +13,18 @@ from postgresqleu.util.db import exec_to_dict, ensure_conference_timezone
 class ConferenceNewsFeed(Feed):
     description_template = "pieces/news_description.html"
 
-    def get_object(self, request, what):
-        return get_conference_or_404(what)
+    def __call__(self, request, what):
+        conference = get_conference_or_404(what)
+        version, lastmodified = get_news_version(conference)
+        return conditional_response(
+            request,
+            lambda: super(ConferenceNewsFeed, self).__call__(request, conference=conference),
+            etag=conference_etag(conference, 'newsfeed', version, lastmodified),
+            lastmodified=lastmodified,
+        )
+
+    def get_object(self, request, conference):
+        return conference
 
     def title(self, obj):
         return "News - {0}".format(obj.conferencename)
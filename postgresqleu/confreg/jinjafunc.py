@@ -6,11 +6,13 @@ from django.contrib.messages.api import get_messages
 from django.utils.text import slugify
 from django.utils.timesince import timesince, timeuntil
 from django.utils import timezone
+from django.utils.functional import cached_property
 from django.conf import settings
 import django.db.models
 
 import os.path
 import random
+import stat
 from itertools import groupby
 import base64
 from datetime import datetime, date, time
@@ -27,6 +29,7 @@ from postgresqleu.util.templatetags.assets import do_render_asset
 from postgresqleu.util.messaging import get_messaging_class_from_typename
 from postgresqleu.util.markup import pgmarkdown
 from postgresqleu.util.qr import generate_base64_qr
+from postgresqleu.util.lrucache import LRUCache
 
 import markupsafe
 import jinja2
@@ -36,13 +39,27 @@ try:
 except ImportError:
     # Try Jinja2 2.x version
     from jinja2 import contextfilter as pass_context
+try:
+    import pynliner
+    import cssutils
+except ImportError:
+    pynliner = None
 
-from .contextutil import load_all_context
+from .contextutil import load_all_context, find_cached_git_revision
 
 # We use a separate root directory for jinja2 templates, so find that
 # directory by searching relative to ourselves.
 JINJA_TEMPLATE_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '../../template.jinja'))
 
+# Process wide cache of compiled conference templates, see ConfTemplateLoader.load()
+_template_code_cache = LRUCache(1000)
+
+# Process wide cache of parsed stylesheets for CSS inlining, see filter_inlinecss()
+_inline_stylesheet_cache = LRUCache(50)
+
+# Process wide cache of compiled sandboxed templates, see compile_sandboxed_template()
+_sandboxed_template_cache = LRUCache(500)
+
 
 def _get_conference_pathlist(conference, disableconferencetemplates):
     pathlist = []
@@ -83,7 +100,7 @@ class ConfTemplateLoader(jinja2.FileSystemLoader):
 
         super(ConfTemplateLoader, self).__init__(self.pathlist)
 
-    def get_source(self, environment, template):
+    def _set_searchpath(self, template):
         # Only allow loading of the root template from confreg. Everything else we allow
         # only from the conference specific directory. This is so we don't end up
         # loading a template with the wrong parameters passed to it.
@@ -101,8 +118,51 @@ class ConfTemplateLoader(jinja2.FileSystemLoader):
             self.searchpath = self.pathlist[self.cutlevel:]
         else:
             self.searchpath = self.pathlist
+
+    def get_source(self, environment, template):
+        self._set_searchpath(template)
         return super(ConfTemplateLoader, self).get_source(environment, template)
 
+    def load(self, environment, name, globals=None):
+        # Look for a compiled version of the template in the process wide cache
+        # before loading and compiling it. The cache is keyed on the full path of
+        # the file that would be loaded, which takes into account both the
+        # conference directory and the level in the search path (for the
+        # extend-from-parent support), as well as the modification time and size
+        # of the file and the git revision of the conference templates.
+        self._set_searchpath(name)
+        pieces = jinja2.loaders.split_template_path(name)
+        for searchpath in self.searchpath:
+            filename = os.path.join(searchpath, *pieces)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode):
+                continue
+
+            def uptodate():
+                try:
+                    return os.stat(filename).st_mtime_ns == st.st_mtime_ns
+                except OSError:
+                    return False
+
+            key = (filename, name, st.st_mtime_ns, st.st_size, self.githash)
+            code = _template_code_cache.get(key)
+            if code is None:
+                source, filename, uptodate = self.get_source(environment, name)
+                code = environment.compile(source, name, filename)
+                _template_code_cache.set(key, code)
+            return environment.template_class.from_code(environment, code, globals or {}, uptodate)
+
+        raise jinja2.TemplateNotFound(name)
+
+    @cached_property
+    def githash(self):
+        if self.conference and self.conference.jinjaenabled and self.conference.jinjadir and not self.disableconferencetemplates:
+            return find_cached_git_revision(self.conference.jinjadir)
+        return None
+
 
 #
 # A jinja2 sandbox for rendering confreg templates.
@@ -127,10 +187,10 @@ class ConfSandbox(jinja2.sandbox.SandboxedEnvironment):
     def __init__(self, *args, **kwargs):
         # We have to disable the cache for our extend-from-parent support, since the cache key
         # for confreg/foo.html would become the same regardless of if the template is from the
-        # base, from the skin or from the conference. Given that we currently recreate the
-        # environment once for each request, the caching doesn't really make any difference
-        # anyway. Should we in the future want to use the caching, we have to take this into
-        # account though.
+        # base, from the skin or from the conference. Given that we recreate the environment
+        # once for each request, the caching wouldn't make any difference anyway. Instead,
+        # ConfTemplateLoader keeps a process wide cache of compiled templates that is keyed
+        # on the actual file loaded.
         super().__init__(*args, cache_size=0, **kwargs)
 
     def get_template(self, name, parent=None, globals=None):
@@ -330,17 +390,74 @@ def filter_social_links(context, attr):
                 yield (k, v, m.get_link_from_identifier(v))
 
 
+# The version of pynliner that _CachingPynliner is written for. It overrides internal
+# methods of pynliner, so any other version (which should not be installed, since
+# this version is pinned in the requirements) falls back to the regular one.
+PYNLINER_VERSION = '0.8.0'
+
+if pynliner and getattr(pynliner, '__version__', None) == PYNLINER_VERSION:
+    # Every email uses the same stylesheet, and parsing it is the most expensive
+    # part of inlining, so reuse the parsed version, along with the style text
+    # generated for each combination of rules matching an element. Also, pynliner
+    # tracks the styled elements in a dict keyed on the elements themselves, and
+    # hashing a BeautifulSoup element serializes it along with everything below
+    # it, which makes inlining quadratic in the size of the document. So track
+    # them by id only (the elements are kept alive by the soup anyway).
+    class _CachingPynliner(pynliner.Pynliner):
+        def _get_styles(self):
+            self._get_external_styles()
+            self._get_internal_styles()
+            for style_string in self.extra_style_strings:
+                self.style_string += style_string
+            cached = _inline_stylesheet_cache.get(self.style_string)
+            if cached is None:
+                cached = (cssutils.CSSParser(log=self.log).parseString(self.style_string), {})
+                _inline_stylesheet_cache.set(self.style_string, cached)
+            self.stylesheet, self._style_text_cache = cached
+
+        def _get_style_text(self, rules):
+            style_declaration = cssutils.css.CSSStyleDeclaration()
+            for rule in rules:
+                for prop in rule.style.getProperties():
+                    style_declaration.removeProperty(prop.name)
+                    style_declaration.setProperty(prop.name, prop.value)
+            return style_declaration.cssText.replace('\n', ' ')
+
+        def _apply_styles(self):
+            rules = list(self.stylesheet.cssRules.rulesOfType(cssutils.css.CSSRule.STYLE_RULE))
+            elements = {}
+            elem_rules = {}
+            for ruleidx, rule in enumerate(rules):
+                for selector in rule.selectorList:
+                    for element in pynliner.select(self.soup, selector.selectorText):
+                        elements[id(element)] = element
+                        elem_rules.setdefault(id(element), []).append((selector.specificity, ruleidx))
+
+            for elemid, matched in elem_rules.items():
+                elem = elements[elemid]
+                # Rules are applied in ascending order of specificity
+                key = tuple(ruleidx for specificity, ruleidx in sorted(matched, key=lambda m: m[0]))
+                if key not in self._style_text_cache:
+                    self._style_text_cache[key] = self._get_style_text([rules[i] for i in key])
+                style = self._style_text_cache[key]
+
+                if elem.has_attr('style'):
+                    elem['style'] = '%s; %s' % (style, elem['style'])
+                else:
+                    elem['style'] = style
+elif pynliner:
+    _CachingPynliner = pynliner.Pynliner
+
+
 # Inline CSS using pynliner, if available
 @pass_context
 def filter_inlinecss(context, contents, cssname):
-    try:
-        import pynliner
-    except ImportError:
+    if not pynliner:
         print("CSS inlining not supported withut pynliner!")
         return contents
 
     css = render_jinja_conference_template(context['conference'], cssname, context)
-    p = pynliner.Pynliner().from_string(contents)
+    p = _CachingPynliner().from_string(contents)
     p.with_cssString(css)
     return p.run()
 
@@ -398,7 +515,7 @@ def _resolve_asset(assettype, assetname):
     return do_render_asset(assettype, assetname)
 
 
-def _get_jinja_conference_template(conference, templatename, dictionary, disableconferencetemplates=False, renderglobals={}):
+def _get_jinja_conference_environment(conference, templatename, disableconferencetemplates=False, renderglobals={}):
     # It all starts from the base template for this conference. If it
     # does not exist, just throw a 404 early.
     if conference and conference.jinjaenabled and conference.jinjadir and not os.path.exists(os.path.join(conference.jinjadir, 'templates/base.html')):
@@ -416,16 +533,24 @@ def _get_jinja_conference_template(conference, templatename, dictionary, disable
     env.globals.update(extra_globals)
     env.globals.update(renderglobals)
 
-    t = env.get_template(templatename)
+    return env
 
-    c = load_all_context(conference,
-                         {
-                             'pgeu_hosted': True,
-                             'now': timezone.now(),
-                             'conference': conference,
-                             'asset': _resolve_asset,
-                         },
-                         dictionary)
+
+def _get_jinja_conference_context(conference, dictionary):
+    return load_all_context(conference,
+                            {
+                                'pgeu_hosted': True,
+                                'now': timezone.now(),
+                                'conference': conference,
+                                'asset': _resolve_asset,
+                            },
+                            dictionary)
+
+
+def _get_jinja_conference_template(conference, templatename, dictionary, disableconferencetemplates=False, renderglobals={}):
+    env = _get_jinja_conference_environment(conference, templatename, disableconferencetemplates, renderglobals)
+    t = env.get_template(templatename)
+    c = _get_jinja_conference_context(conference, dictionary)
 
     return t, c
 
@@ -454,96 +579,128 @@ def _get_contenttype_from_extension(f):
 _re_base64_image = re.compile(r'<img\s+([^>]+)src="data:(image/png);base64,([^"]+)"([^>]*)>', flags=re.I)
 
 
-def render_jinja_conference_mail(conference, templatename, dictionary, subject):
-    templatename, templateext = os.path.splitext(templatename)
-    if templateext not in ('.txt', '.md', '.mail'):
-        raise Exception("Invalid mail template extension")
+class _MailAttachments:
+    def __init__(self):
+        self.attachments = {}
 
-    dictionary['subject'] = subject
+    def register(self, context, name, filename):
+        self.attachments[name] = filename
+        return ''
 
-    class Attachments:
-        def __init__(self):
-            self.attachments = {}
 
-        def register(self, context, name, filename):
-            self.attachments[name] = filename
-            return ''
+# Convert inline images to cid attachments for better compatibility
+class _MailImageReplacer:
+    def __init__(self, attachments):
+        self.imgnum = 0
+        self.attachments = attachments
 
-    renderglobals = {
-        'attachments': Attachments(),
-    }
+    def replacehtml(self, m):
+        self.imgnum += 1
+
+        # We should support other than image/png at some point,
+        # but for now, hardcode to that. Keep in sync with the
+        # regexp above.
+        _name = 'image{}.png'.format(self.imgnum)
+
+        self.attachments.append((_name, m.group(2), base64.b64decode(m.group(3))))
+
+        return '<img {} src="cid:{}@img" {}>'.format(
+            (m.group(1) or '').strip(),
+            _name,
+            (m.group(4) or '').strip(),
+        )
 
-    # Find the root template(s) to render.
-    for p in _get_conference_pathlist(conference, False):
-        if os.path.isfile(os.path.join(p, templatename + '.txt')):
-            if os.path.isfile(os.path.join(p, templatename + '.html')):
-                # Both HTML and TXT exists, so render as separate parts
-                txtpart = render_jinja_conference_template(conference, templatename + '.txt', dictionary)
-                htmltempl, htmlctx = _get_jinja_conference_template(conference, templatename + '.html', dictionary, renderglobals=renderglobals)
+    def replacetext(self, m):
+        self.imgnum += 1
+        return '* See attachment {} *'.format('image{}.png'.format(self.imgnum))
+
+
+#
+# Renders a conference mail template into the text part, html part and attachments
+# for the html part. The templates are located and loaded once, so the same
+# renderer can be used to efficiently render the same mail for many recipients.
+#
+class JinjaConferenceMailRenderer:
+    def __init__(self, conference, templatename):
+        templatename, templateext = os.path.splitext(templatename)
+        if templateext not in ('.txt', '.md', '.mail'):
+            raise Exception("Invalid mail template extension")
+
+        self.conference = conference
+        self.attachments = _MailAttachments()
+        self.attachmentcontents = {}
+        renderglobals = {
+            'attachments': self.attachments,
+        }
+
+        # Find the root template(s) to render.
+        for p in _get_conference_pathlist(conference, False):
+            if os.path.isfile(os.path.join(p, templatename + '.txt')):
+                self.txttempl = _get_jinja_conference_environment(conference, templatename + '.txt').get_template(templatename + '.txt')
+                if os.path.isfile(os.path.join(p, templatename + '.html')):
+                    # Both HTML and TXT exists, so render as separate parts
+                    self.markdown = False
+                    htmltemplatename = templatename + '.html'
+                else:
+                    # TXT exists, but not HTML, so render as markdown inside base template
+                    self.markdown = True
+                    htmltemplatename = conference and 'confreg/mailbase.html' or 'mailbase.html'
+                self.htmltempl = _get_jinja_conference_environment(conference, htmltemplatename, renderglobals=renderglobals).get_template(htmltemplatename)
+                return
             else:
-                # TXT exists, but not HTML, so render as markdown inside base template
-                # Extract the first line to be the "greeting" part of the email in the HTML template.
-                txtpart = render_jinja_conference_template(conference, templatename + '.txt', dictionary)
-                contentlines = txtpart.splitlines()
-                htmltempl, htmlctx = _get_jinja_conference_template(
-                    conference,
-                    conference and 'confreg/mailbase.html' or 'mailbase.html',
-                    {
-                        'subject': subject,
-                        'greeting': contentlines[0],
-                        'content': markupsafe.Markup(pgmarkdown("\n".join(contentlines[1:]))),
-                    },
-                    renderglobals=renderglobals,
-                )
-            # If there are any attachments here they should've been specified in a block, so we read
-            # it out of there.
-            htmlpart = htmltempl.render(**htmlctx)
-            attachments = []
-            for name, filename in renderglobals['attachments'].attachments.items():
-                # Find the filename in the template directory structure
-                for p in _get_conference_pathlist(conference, False):
-                    if os.path.isfile(os.path.join(p, filename)):
-                        with open(os.path.join(p, filename), 'rb') as f:
-                            attachments.append((name, _get_contenttype_from_extension(name), f.read()))
-                            break
-
-            # Next if there are any inline attachments, convert them to
-            # cid attachments for better compatibility
-            class ImageReplacer:
-                def __init__(self):
-                    self.imgnum = 0
-
-                def replacehtml(self, m):
-                    self.imgnum += 1
-
-                    # We should support other than image/png at some point,
-                    # but for now, hardcode to that. Keep in sync with the
-                    # regexp above.
-                    _name = 'image{}.png'.format(self.imgnum)
-
-                    attachments.append((_name, m.group(2), base64.b64decode(m.group(3))))
-
-                    return '<img {} src="cid:{}@img" {}>'.format(
-                        (m.group(1) or '').strip(),
-                        _name,
-                        (m.group(4) or '').strip(),
-                    )
-
-                def replacetext(self, m):
-                    self.imgnum += 1
-                    return '* See attachment {} *'.format('image{}.png'.format(self.imgnum))
-
-            htmlpart, num = _re_base64_image.subn(ImageReplacer().replacehtml, htmlpart)
-            if num > 0:
-                txtpart, num = _re_base64_image.subn(ImageReplacer().replacetext, txtpart)
-
-            return (txtpart, htmlpart, attachments)
+                # TXT does not exist, so we ignore and move on to the next level
+                pass
+
+        # This should maybe not be Http404, but for consistency...
+        raise Http404("Mail template not found")
+
+    def _get_attachment(self, filename):
+        if filename not in self.attachmentcontents:
+            # Find the filename in the template directory structure
+            self.attachmentcontents[filename] = None
+            for p in _get_conference_pathlist(self.conference, False):
+                if os.path.isfile(os.path.join(p, filename)):
+                    with open(os.path.join(p, filename), 'rb') as f:
+                        self.attachmentcontents[filename] = f.read()
+                        break
+        return self.attachmentcontents[filename]
+
+    def render(self, dictionary, subject):
+        dictionary['subject'] = subject
+
+        txtpart = self.txttempl.render(**_get_jinja_conference_context(self.conference, dictionary))
+        if self.markdown:
+            # Extract the first line to be the "greeting" part of the email in the HTML template.
+            contentlines = txtpart.splitlines()
+            htmlctx = _get_jinja_conference_context(self.conference, {
+                'subject': subject,
+                'greeting': contentlines[0],
+                'content': markupsafe.Markup(pgmarkdown("\n".join(contentlines[1:]))),
+            })
         else:
-            # TXT does not exist, so we ignore and move on to the next level
-            pass
+            htmlctx = _get_jinja_conference_context(self.conference, dictionary)
+
+        # If there are any attachments here they should've been specified in a block, so we read
+        # it out of there.
+        self.attachments.attachments = {}
+        htmlpart = self.htmltempl.render(**htmlctx)
+        attachments = []
+        for name, filename in self.attachments.attachments.items():
+            content = self._get_attachment(filename)
+            if content is not None:
+                attachments.append((name, _get_contenttype_from_extension(name), content))
 
-    # This should maybe not be Http404, but for consistency...
-    raise Http404("Mail template not found")
+        # Next if there are any inline attachments, convert them to
+        # cid attachments for better compatibility
+        htmlpart, num = _re_base64_image.subn(_MailImageReplacer(attachments).replacehtml, htmlpart)
+        if num > 0:
+            txtpart, num = _re_base64_image.subn(_MailImageReplacer(attachments).replacetext, txtpart)
+
+        return (txtpart, htmlpart, attachments)
+
+
+def render_jinja_conference_mail(conference, templatename, dictionary, subject):
+    return JinjaConferenceMailRenderer(conference, templatename).render(dictionary, subject)
 
 
 # Render a conference response based on jinja2 templates configured for the conference.
@@ -610,22 +767,43 @@ def render_jinja_conference_svg(request, conference, cardformat, templatename, d
         return r
 
 
-# Small sandboxed jinja templates that can be configured in system
-def render_sandboxed_template(templatestr, context, filters=None, referenced_vars=None):
+# Compile a small sandboxed jinja template that can be configured in system, for
+# when the same template is rendered many times. The compiled templates are cached
+# by the contents of the template and the set of extra filters, so rendering the
+# same template again (such as the same email to many recipients, or the same post
+# for multiple providers) only has to do the actual rendering. Templates using a
+# custom context class are always compiled, since they are typically tied to the
+# specific call.
+def compile_sandboxed_template(templatestr, filters=None, context_class=None):
+    if not context_class:
+        key = (SHA.new(templatestr.encode('utf8')).hexdigest(), frozenset(filters.items()) if filters else None)
+        template = _sandboxed_template_cache.get(key)
+        if template is not None:
+            return template
+
     env = ConfSandbox(loader=jinja2.DictLoader({'t': templatestr}))
     env.filters.update(extra_filters)
     if filters:
         env.filters.update(filters)
+    if context_class:
+        env.context_class = context_class
+        return env.get_template('t')
+
+    template = env.get_template('t')
+    _sandboxed_template_cache.set(key, template)
+    return template
 
+
+# Small sandboxed jinja templates that can be configured in system
+def render_sandboxed_template(templatestr, context, filters=None, referenced_vars=None):
     if referenced_vars is not None:
         class _TrackingContext(jinja2.runtime.Context):
             def resolve_or_missing(self, key):
                 referenced_vars.add(key)
                 return super().resolve_or_missing(key)
-        env.context_class = _TrackingContext
+        return compile_sandboxed_template(templatestr, filters, _TrackingContext).render(context)
 
-    t = env.get_template('t')
-    return t.render(context)
+    return compile_sandboxed_template(templatestr, filters).render(context)
 
 
 class JinjaTemplateValidator(object):
@@ -6,12 +6,16 @@ import argparse
 import sys
 import re
 import operator
+import hashlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from reportlab.lib.units import mm
 from reportlab.lib.pagesizes import A4, LETTER, landscape
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
-from reportlab.pdfbase.pdfmetrics import registerFont
+from reportlab.pdfbase.pdfmetrics import registerFont, stringWidth
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.platypus import SimpleDocTemplate, Paragraph, PageBreak
 from reportlab.platypus.flowables import Flowable
@@ -27,6 +31,20 @@ try:
 except ImportError:
     import contextutil
 
+try:
+    from postgresqleu.util.reporttools import register_fonts
+except ImportError:
+    # When running standalone, fonts are only registered once anyway
+    def register_fonts(fonts):
+        for font, fontfile in fonts:
+            registerFont(TTFont(font, fontfile))
+
+try:
+    from postgresqleu.util.qr import get_qr_png, store_qr_png
+except ImportError:
+    # When running standalone, QR codes are generated without the shared cache
+    get_qr_png = store_qr_png = None
+
 
 DEFAULT_CUTMARK_LENGTH = 8
 DEFAULT_CUTMARK_OFS = 3
@@ -51,6 +69,101 @@ def getmm(struct, key):
     return struct[key] * mm
 
 
+QR_SIZE = 500
+
+
+def get_qr_version(s):
+    if len(s) < 20:
+        return 1
+    elif len(s) < 38:
+        return 2
+    elif len(s) < 61:
+        return 3
+    elif len(s) < 90:
+        return 4
+    elif len(s) < 122:
+        return 5
+    elif len(s) < 154:
+        return 6
+    else:
+        raise Exception("String too long for QR encode")
+
+
+# Generate a QR code image for the string, returned as PNG. Returns None if
+# there is no QR library available.
+def make_qr_png(s):
+    ver = get_qr_version(s)
+    if get_qr_png:
+        return get_qr_png(s, ver, QR_SIZE)
+
+    try:
+        import qrcode
+
+        qrimage = qrcode.make(s, version=ver, border=0)
+    except ImportError:
+        raise
+        try:
+            import qrencode
+            (ver, size, qrimage) = qrencode.encode(s, version=ver, level=qrencode.QR_ECLEVEL_M)
+        except ImportError:
+            return None
+
+    if qrimage.size[0] != QR_SIZE:
+        if qrimage.size[0] < QR_SIZE:
+            size = (QR_SIZE // qrimage.size[0]) * qrimage.size[0]
+        else:
+            size = qrimage.size[0] // (qrimage.size[0] // QR_SIZE + 1)
+        qrimage = qrimage.resize((size, size), Image.NEAREST)
+
+    b = io.BytesIO()
+    qrimage.save(b, 'png')
+    return b.getvalue()
+
+
+def get_paragraph_fontname(o, defaultfont):
+    fontname = o.get('fontname', defaultfont)
+    if o.get('bold', False):
+        fontname += ' Bold'
+    if o.get('italic', False):
+        fontname += ' Italic'
+    if o.get('extralight', False):
+        fontname += ' ExtraLight'
+    return fontname
+
+
+# Find the largest font size at which all lines of the paragraph fit
+def get_paragraph_fontsize(o, fontname, lines):
+    # Max height is total height divided by lines divided by 1.2 since
+    # we multiply the leading value with 1.2 later
+    maxsize = o.get('maxsize', None)
+    maxfont_height = int((getmm(o, 'height') // len(lines)) / 1.2)
+    if maxsize:
+        maxfontsize = min(maxsize, maxfont_height)
+    else:
+        maxfontsize = maxfont_height
+    for fontsize in range(4, maxfontsize):
+        maxwidth = max([stringWidth(line, fontname, fontsize) for line in lines])
+        if maxwidth > getmm(o, 'width'):
+            fontsize -= 1
+            break
+    return fontsize
+
+
+# Do the expensive parts of drawing a badge, generating QR codes and sizing
+# paragraphs, ahead of time. This is independent of the document the badge is
+# drawn into, so it can run in a separate process and the result can be reused.
+def prepare_badge(js):
+    defaultfont = js.get('fontname', 'DejaVu Serif')
+    for e in js.get('elements', []):
+        if e.get('type', None) == 'qrimage' and e.get('qrcontent', None):
+            e['_qrpng'] = make_qr_png(e['qrcontent'])
+        elif e.get('type', None) == 'paragraph':
+            lines = e['text'].splitlines()
+            if lines:
+                e['_fontsize'] = get_paragraph_fontsize(e, get_paragraph_fontname(e, defaultfont), lines)
+    return js
+
+
 class JinjaFlowable(Flowable):
     def __init__(self, js, imgpath):
         self.js = js
@@ -174,46 +287,19 @@ class JinjaFlowable(Flowable):
         s = o.get('qrcontent')
         if not s:
             return
-        if len(s) < 20:
-            ver = 1
-        elif len(s) < 38:
-            ver = 2
-        elif len(s) < 61:
-            ver = 3
-        elif len(s) < 90:
-            ver = 4
-        elif len(s) < 122:
-            ver = 5
-        elif len(s) < 154:
-            ver = 6
-        else:
-            raise Exception("String too long for QR encode")
 
-        try:
-            import qrcode
-
-            qrimage = qrcode.make(s, version=ver, border=0)
-        except ImportError:
-            raise
-            try:
-                import qrencode
-                (ver, size, qrimage) = qrencode.encode(s, version=ver, level=qrencode.QR_ECLEVEL_M)
-            except ImportError:
-                o2 = o.copy()
-                o2['stroke'] = True
-                o2['text'] = "qrencode library\nnot found"
-                self.draw_box(o2)
-                self.draw_paragraph(o2)
-                return
-
-        if qrimage.size[0] != 500:
-            if qrimage.size[0] < 500:
-                size = (500 // qrimage.size[0]) * qrimage.size[0]
-            else:
-                size = qrimage.size[0] // (qrimage.size[0] // 500 + 1)
-            qrimage = qrimage.resize((size, size), Image.NEAREST)
+        png = o['_qrpng'] if '_qrpng' in o else make_qr_png(s)
+        if png is None:
+            o2 = o.copy()
+            o2['stroke'] = True
+            o2['text'] = "qrencode library\nnot found"
+            self.draw_box(o2)
+            self.draw_paragraph(o2)
+            return
 
-        self.canv.drawImage(ImageReader(qrimage),
+        # Draw as greyscale, since reportlab would otherwise expand the 1-bit image to
+        # RGB, making it three times as expensive to compress and embed.
+        self.canv.drawImage(ImageReader(Image.open(io.BytesIO(png)).convert('L')),
                             getmm(o, 'x'),
                             self.calc_y(o),
                             getmm(o, 'width'),
@@ -225,32 +311,17 @@ class JinjaFlowable(Flowable):
     def draw_paragraph(self, o):
         # Attempt to draw a paragraph that can dynamically change the font size
         # as necessary.
-        fontname = o.get('fontname', self.fontname)
-        if o.get('bold', False):
-            fontname += ' Bold'
-        if o.get('italic', False):
-            fontname += ' Italic'
-        if o.get('extralight', False):
-            fontname += ' ExtraLight'
+        fontname = get_paragraph_fontname(o, self.fontname)
         lines = o['text'].splitlines()
 
         if len(lines) == 0:
             # Don't try to draw empty lines
             return
 
-        # Max height is total height divided by lines divided by 1.2 since
-        # we multiply the leading value with 1.2 later
-        maxsize = o.get('maxsize', None)
-        maxfont_height = int((getmm(o, 'height') // len(lines)) / 1.2)
-        if maxsize:
-            maxfontsize = min(maxsize, maxfont_height)
+        if '_fontsize' in o:
+            fontsize = o['_fontsize']
         else:
-            maxfontsize = maxfont_height
-        for fontsize in range(4, maxfontsize):
-            maxwidth = max([self.canv.stringWidth(line, fontname, fontsize) for line in lines])
-            if maxwidth > getmm(o, 'width'):
-                fontsize -= 1
-                break
+            fontsize = get_paragraph_fontsize(o, fontname, lines)
 
         if o.get('verticalcenter', False):
             yoffset = (getmm(o, 'height') - (len(lines) * fontsize)) // 2
@@ -295,8 +366,8 @@ class JinjaRenderer(object):
 
         self.border = self.pagebreaks = False
 
-        for font, fontfile in fonts:
-            registerFont(TTFont(font, fontfile))
+        self.fonts = fonts
+        register_fonts(fonts)
 
         if self.templatedir and os.path.exists(os.path.join(self.templatedir, templatefile)):
             template = os.path.join(self.templatedir, templatefile)
@@ -335,6 +406,9 @@ class JinjaRenderer(object):
         self.story = []
 
     def add_to_story(self, ctx):
+        self.add_json_to_story(self.parse_json(self.render_json(ctx)))
+
+    def render_json(self, ctx):
         ctx.update(self.context)
         s = self.template.render(**ctx)
         if self.jinjadebug:
@@ -343,6 +417,9 @@ class JinjaRenderer(object):
             print(s)
             print("------------------------")
             self.jinjadebug = False  # For badges so we don't print one for each badge!
+        return s
+
+    def parse_json(self, s):
         try:
             js = json.loads(s)
         except ValueError as e:
@@ -355,7 +432,9 @@ class JinjaRenderer(object):
                 sys.exit(1)
             else:
                 raise Exception("JSON parse failed.")
+        return js
 
+    def add_json_to_story(self, js):
         # Potentially override border settings
         if self.border == 0 or self.border == 'none':
             js['border'] = ''
@@ -385,6 +464,20 @@ class JinjaRenderer(object):
         doc.build(self.story)
 
 
+# Prepared badges, keyed by a hash of the JSON rendered from the template for them,
+# so reprinting a set of badges only has to prepare the ones that changed.
+try:
+    from postgresqleu.util.lrucache import LRUCache
+    _prepared_badge_cache = LRUCache(5000)
+except ImportError:
+    # When running standalone, only one set of badges is rendered so there is
+    # nothing to cache.
+    _prepared_badge_cache = None
+
+# Don't bother with separate processes for less than this number of badges each
+MIN_BADGES_PER_WORKER = 50
+
+
 class JinjaBadgeRenderer(JinjaRenderer):
     def __init__(self, rootdir, fonts, debug=False, jinjadebug=False, border=False, pagebreaks=False, systemroot=None, orientation='portrait', pagesize='A4'):
         super(JinjaBadgeRenderer, self).__init__(rootdir, 'badge.json', fonts, debug=debug, jinjadebug=jinjadebug, systemroot=systemroot, orientation=orientation, pagesize=pagesize)
@@ -398,6 +491,50 @@ class JinjaBadgeRenderer(JinjaRenderer):
             'conference': conference,
         })
 
+    def add_badges(self, regs, conference, workers=1):
+        rendered = [self.render_json({'reg': reg, 'conference': conference}) for reg in regs]
+        # Font sizes are calculated from the fonts, so they are part of the key as well
+        fontkey = repr([tuple(f) for f in self.fonts])
+        keys = [hashlib.sha256('{}\n{}'.format(fontkey, s).encode('utf8')).hexdigest() for s in rendered]
+
+        # Only badges that have changed since they were last rendered need to be prepared
+        prepared = {}
+        toprepare = {}
+        for k, s in zip(keys, rendered):
+            if k in prepared or k in toprepare:
+                continue
+            js = _prepared_badge_cache.get(k) if _prepared_badge_cache is not None else None
+            if js is None:
+                toprepare[k] = self.parse_json(s)
+            else:
+                prepared[k] = js
+
+        workers = min(workers, os.cpu_count() or 1, len(toprepare) // MIN_BADGES_PER_WORKER)
+        if workers > 1:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                results = pool.map(prepare_badge, toprepare.values(), chunksize=MIN_BADGES_PER_WORKER)
+                for k, js in zip(toprepare.keys(), results):
+                    prepared[k] = js
+        else:
+            for k, js in toprepare.items():
+                prepared[k] = prepare_badge(js)
+
+        if _prepared_badge_cache is not None:
+            for k in toprepare.keys():
+                _prepared_badge_cache.set(k, prepared[k])
+
+        if workers > 1 and store_qr_png:
+            # QR codes generated in the worker processes are lost with them, so
+            # add them to the shared cache here for tickets etc to use.
+            for k in toprepare.keys():
+                for e in prepared[k].get('elements', []):
+                    if e.get('_qrpng', None):
+                        store_qr_png(e['qrcontent'], get_qr_version(e['qrcontent']), QR_SIZE, e['_qrpng'])
+
+        for k in keys:
+            # The elements are shared with the cache, but only the top level is modified
+            self.add_json_to_story(dict(prepared[k]))
+
 
 class JinjaTicketRenderer(JinjaRenderer):
     def __init__(self, rootdir, fonts, debug=False, jinjadebug=False, systemroot=None):
@@ -412,12 +549,11 @@ class JinjaTicketRenderer(JinjaRenderer):
 
 # Render badges from within the website scope, meaning we have access to the
 # django objects here.
+# Badges are always prepared in this process, since forking the (threaded) web
+# server with its database connection open is not safe.
 def render_jinja_badges(conference, fonts, registrations, output, border, pagebreaks, orientation='portrait', pagesize='A4'):
     renderer = JinjaBadgeRenderer(conference.jinjadir, fonts, border=border, pagebreaks=pagebreaks, orientation=orientation, pagesize=pagesize)
-
-    for reg in registrations:
-        renderer.add_badge(reg, conference.safe_export())
-
+    renderer.add_badges(registrations, conference.safe_export())
     renderer.render(output)
 
 
@@ -439,6 +575,7 @@ if __name__ == "__main__":
     parser.add_argument('--fontroot', type=str, help='fontroot for dejavu fonts')
     parser.add_argument('--font', type=str, nargs=1, action='append', help='<font name>:<font path>')
     parser.add_argument('--debug-template', action='store_true', help='Print template output before running')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes to prepare badges in')
 
     args = parser.parse_args()
 
@@ -485,8 +622,7 @@ if __name__ == "__main__":
 
     if args.what == 'badge':
         renderer = JinjaBadgeRenderer(args.repopath, fonts, debug=True, jinjadebug=args.debug_template, border=args.borders, pagebreaks=args.pagebreaks)
-        for reg in a:
-            renderer.add_badge(reg, conference)
+        renderer.add_badges(a, conference, args.workers)
     else:
         renderer = JinjaTicketRenderer(args.repopath, fonts, debug=True, jinjadebug=args.debug_template)
         renderer.add_reg(a[0], conference)
@@ -0,0 +1,83 @@
+# Expand recipients and queue cross conference emails.
+#
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import F
+
+from datetime import timedelta
+
+from postgresqleu.confreg.models import CrossConferenceEmail, CrossConferenceEmailRecipient
+from postgresqleu.confreg.util import get_crossmail_recipients
+from postgresqleu.confreg.jinjafunc import compile_sandboxed_template
+from postgresqleu.mailqueue.util import send_template_mail_bulk
+
+
+# Number of recipients to queue in each transaction, which is also how often the
+# progress shown to the sender is updated.
+BATCH_SIZE = 500
+
+
+class Command(BaseCommand):
+    help = 'Send cross conference emails'
+
+    class ScheduledJob:
+        scheduled_interval = timedelta(minutes=5)
+        internal = True
+
+        @classmethod
+        def should_run(self):
+            return CrossConferenceEmail.objects.filter(sent=False).exists()
+
+    def handle(self, *args, **options):
+        for email in CrossConferenceEmail.objects.filter(sent=False).order_by('id'):
+            self.send_email(email)
+
+    def send_email(self, email):
+        rules = email.crossconferenceemailrule_set.all()
+        recipients = get_crossmail_recipients(
+            [(r.conference_id, r.ruletype, r.ruleref, r.canceled) for r in rules if not r.isexclude],
+            [(r.conference_id, r.ruletype, r.ruleref, r.canceled) for r in rules if r.isexclude],
+        )
+
+        # If a previous run was interrupted, the ones that were already queued are
+        # recorded as recipients, so don't send to them again.
+        alreadysent = set(CrossConferenceEmailRecipient.objects.filter(email=email).values_list('address', flat=True))
+        recipients = [r for r in recipients if r['email'] not in alreadysent]
+
+        email.recipientcount = len(alreadysent) + len(recipients)
+        email.sentcount = len(alreadysent)
+        email.save(update_fields=['recipientcount', 'sentcount'])
+
+        # The text is the same for all recipients, so only compile it once
+        template = compile_sandboxed_template(email.text)
+
+        for i in range(0, len(recipients), BATCH_SIZE):
+            batch = recipients[i:i + BATCH_SIZE]
+            with transaction.atomic():
+                CrossConferenceEmailRecipient.objects.bulk_create([
+                    CrossConferenceEmailRecipient(email=email, address=r['email'])
+                    for r in batch
+                ])
+
+                # Cross conference mails are sent using a non-conference template as they
+                # reference multiple conferences that may have different ones.
+                send_template_mail_bulk(
+                    email.senderaddr,
+                    email.subject,
+                    'confreg/mail/cross_conference.txt',
+                    ((r['email'], r['fullname'], {
+                        'body': template.render({
+                            'name': r['fullname'],
+                            'email': r['email'],
+                            'token': r['token'],
+                        }),
+                        'token': r['token'],
+                    }) for r in batch),
+                    sendername=email.sendername,
+                )
+
+                CrossConferenceEmail.objects.filter(pk=email.pk).update(sentcount=F('sentcount') + len(batch))
+
+        email.sent = True
+        email.save(update_fields=['sent'])
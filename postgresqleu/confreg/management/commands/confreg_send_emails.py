@@ -4,14 +4,36 @@
 from django.core.management.base import BaseCommand
 from django.utils import timezone
 from django.db import transaction
-from django.db.models import Q
-from django.conf import settings
 
 from datetime import timedelta
 
 from postgresqleu.confreg.models import AttendeeMail, ConferenceRegistration
-from postgresqleu.confreg.util import send_conference_mail
-from postgresqleu.confreg.jinjafunc import render_sandboxed_template
+from postgresqleu.confreg.util import send_conference_mail_bulk
+from postgresqleu.confreg.jinjafunc import compile_sandboxed_template
+
+
+# All registrations that should receive the mail, each one only once, regardless
+# of how many of the criteria they match.
+_recipients_query = """SELECT r.* FROM confreg_conferenceregistration r
+WHERE (
+ -- By registration class or additional options, for confirmed registrations
+ r.conference_id=%(confid)s AND r.payconfirmedat IS NOT NULL AND r.canceledat IS NULL AND (
+  EXISTS (SELECT 1 FROM confreg_attendeemail_regclasses amrc
+          INNER JOIN confreg_registrationtype rt ON rt.regclass_id=amrc.registrationclass_id
+          WHERE amrc.attendeemail_id=%(mailid)s AND rt.id=r.regtype_id)
+  OR
+  EXISTS (SELECT 1 FROM confreg_attendeemail_addopts amao
+          INNER JOIN confreg_conferenceregistration_additionaloptions rao ON rao.conferenceadditionaloption_id=amao.conferenceadditionaloption_id
+          WHERE amao.attendeemail_id=%(mailid)s AND rao.conferenceregistration_id=r.id)
+ )
+)
+-- To direct attendees
+OR EXISTS (SELECT 1 FROM confreg_attendeemail_registrations amr WHERE amr.attendeemail_id=%(mailid)s AND amr.conferenceregistration_id=r.id)
+-- To volunteers
+OR (%(tovolunteers)s AND EXISTS (SELECT 1 FROM confreg_conference_volunteers v WHERE v.conference_id=%(confid)s AND v.conferenceregistration_id=r.id))
+-- To checkin processors
+OR (%(tocheckin)s AND EXISTS (SELECT 1 FROM confreg_conference_checkinprocessors c WHERE c.conference_id=%(confid)s AND c.conferenceregistration_id=r.id))
+"""
 
 
 class Command(BaseCommand):
@@ -27,46 +49,46 @@ class Command(BaseCommand):
 
     @transaction.atomic
     def handle(self, *args, **options):
-        for msg in AttendeeMail.objects.filter(sentat__lte=timezone.now(), sent=False):
-            # By registration type
-            attendees = set(ConferenceRegistration.objects.filter(conference=msg.conference, payconfirmedat__isnull=False, canceledat__isnull=True, regtype__regclass__attendeemail=msg))
-            # By additional options
-            attendees.update(ConferenceRegistration.objects.filter(conference=msg.conference, payconfirmedat__isnull=False, canceledat__isnull=True, additionaloptions__attendeemail=msg))
-            # To direct attendees
-            attendees.update(msg.registrations.all())
-            # To volunteers
-            if msg.tovolunteers:
-                attendees.update(msg.conference.volunteers.all())
-            # To checkin processors
-            if msg.tocheckin:
-                attendees.update(msg.conference.checkinprocessors.all())
-
-            def _render_and_send(email, attendee, firstname, lastname):
-                body = render_sandboxed_template(msg.message, dict({
+        for msg in AttendeeMail.objects.select_related('conference').filter(sentat__lte=timezone.now(), sent=False):
+            # The message is the same for all recipients, so only compile it once
+            template = compile_sandboxed_template(msg.message)
+
+            def _recipient(email, attendee, firstname, lastname):
+                body = template.render(dict({
                     'conference': msg.conference,
                     'attendee': attendee,
                     'firstname': firstname,
                     'lastname': lastname,
                 }, **msg.extracontext))
 
-                send_conference_mail(msg.conference,
-                                     email,
-                                     msg.subject,
-                                     'confreg/mail/attendee_mail.txt',
-                                     {
-                                         'body': body,
-                                         'linkback': True,
-                                     },
-                                     receivername=attendee.fullname if attendee else '{} {}'.format(firstname, lastname),
+                return (
+                    email,
+                    attendee.fullname if attendee else '{} {}'.format(firstname, lastname),
+                    {
+                        'body': body,
+                        'linkback': True,
+                    },
                 )
 
-            # Send to all regular recipients, where we can render a recipient specific version
-            for a in attendees:
-                _render_and_send(a.email, a, a.firstname, a.lastname)
+            def _all_recipients():
+                # Send to all regular recipients, where we can render a recipient specific version
+                for a in ConferenceRegistration.objects.raw(_recipients_query, {
+                        'confid': msg.conference_id,
+                        'mailid': msg.id,
+                        'tovolunteers': msg.tovolunteers,
+                        'tocheckin': msg.tocheckin,
+                }).iterator():
+                    yield _recipient(a.email, a, a.firstname, a.lastname)
+
+                # Pending regs have no registration, but we can still get the name
+                for p in msg.pending_regs.all():
+                    yield _recipient(p.email, None, p.first_name, p.last_name)
 
-            # Pending regs have no registration, but we can still get the name
-            for p in msg.pending_regs.all():
-                _render_and_send(p.email, None, p.first_name, p.last_name)
+            send_conference_mail_bulk(msg.conference,
+                                      msg.subject,
+                                      'confreg/mail/attendee_mail.txt',
+                                      _all_recipients(),
+            )
 
             msg.sent = True
             msg.save(update_fields=['sent'])
@@ -0,0 +1,157 @@
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('confreg', '0125_index_conference_enddate'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ConferenceDataVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('datatype', models.CharField(max_length=20)),
+                ('version', models.BigIntegerField(default=0)),
+                ('lastmodified', models.DateTimeField(default=django.utils.timezone.now)),
+                ('conference', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='confreg.conference')),
+            ],
+            options={
+                'unique_together': {('conference', 'datatype')},
+            },
+        ),
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_conference_create_data_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified)
+    SELECT NEW.id, d, 0, CURRENT_TIMESTAMP FROM unnest(ARRAY['schedule']) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_conference_create_data_versions()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conference_create_data_versions_trigger
+AFTER INSERT ON confreg_conference
+FOR EACH ROW EXECUTE FUNCTION confreg_conference_create_data_versions()
+            """,
+            "DROP TRIGGER confreg_conference_create_data_versions_trigger ON confreg_conference",
+        ),
+        migrations.RunSQL(
+            "INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified) SELECT id, 'schedule', 0, CURRENT_TIMESTAMP FROM confreg_conference",
+            "",
+        ),
+        # Increment the version of a datatype for the conference that a row belongs to.
+        # If parenttable is set, the column refers to a row in that table that has the
+        # conference_id, otherwise the column is the conference_id itself.
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_bump_data_version_for_row(_r anyelement, _datatype text, _column text, _parenttable text) RETURNS void AS $$
+DECLARE
+    _id integer;
+BEGIN
+    EXECUTE format('SELECT ($1).%I', _column) INTO _id USING _r;
+    IF _parenttable IS NOT NULL THEN
+        EXECUTE format('SELECT conference_id FROM %I WHERE id=$1', _parenttable) INTO _id USING _id;
+    END IF;
+    UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP
+     WHERE conference_id=_id AND datatype=_datatype;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_bump_data_version_for_row(anyelement, text, text, text)",
+        ),
+        # Trigger function, with arguments datatype, column and optionally parent table
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_data_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF OLD IS NOT DISTINCT FROM NEW THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM confreg_bump_data_version_for_row(OLD, TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM confreg_bump_data_version_for_row(NEW, TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_data_changed()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conferencesession_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencesession
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conference_id');
+CREATE TRIGGER confreg_room_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_room
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conference_id');
+CREATE TRIGGER confreg_track_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_track
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conference_id');
+CREATE TRIGGER confreg_conferencesessiontag_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencesessiontag
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conference_id');
+CREATE TRIGGER confreg_conferencesession_speaker_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencesession_speaker
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conferencesession_id', 'confreg_conferencesession');
+CREATE TRIGGER confreg_conferencesession_tags_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencesession_tags
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'conferencesession_id', 'confreg_conferencesession');
+CREATE TRIGGER confreg_conferencesessionslides_schedule_trigger
+AFTER INSERT OR DELETE ON confreg_conferencesessionslides
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'session_id', 'confreg_conferencesession');
+CREATE TRIGGER confreg_room_availabledays_schedule_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_room_availabledays
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('schedule', 'room_id', 'confreg_room');
+            """,
+            """
+DROP TRIGGER confreg_conferencesession_schedule_trigger ON confreg_conferencesession;
+DROP TRIGGER confreg_room_schedule_trigger ON confreg_room;
+DROP TRIGGER confreg_track_schedule_trigger ON confreg_track;
+DROP TRIGGER confreg_conferencesessiontag_schedule_trigger ON confreg_conferencesessiontag;
+DROP TRIGGER confreg_conferencesession_speaker_schedule_trigger ON confreg_conferencesession_speaker;
+DROP TRIGGER confreg_conferencesession_tags_schedule_trigger ON confreg_conferencesession_tags;
+DROP TRIGGER confreg_conferencesessionslides_schedule_trigger ON confreg_conferencesessionslides;
+DROP TRIGGER confreg_room_availabledays_schedule_trigger ON confreg_room_availabledays;
+            """,
+        ),
+        # Speakers aren't tied to a conference, so update all conferences where they have sessions
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_speaker_schedule_changed() RETURNS trigger AS $$
+BEGIN
+    UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP
+     WHERE datatype='schedule' AND conference_id IN (
+      SELECT s.conference_id FROM confreg_conferencesession s
+      INNER JOIN confreg_conferencesession_speaker css ON css.conferencesession_id=s.id
+      WHERE css.speaker_id=NEW.id
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_speaker_schedule_changed()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_speaker_schedule_trigger
+AFTER UPDATE OF fullname, company, attributes, photo, photo512 ON confreg_speaker
+FOR EACH ROW
+WHEN (OLD.fullname IS DISTINCT FROM NEW.fullname OR OLD.company IS DISTINCT FROM NEW.company OR OLD.attributes IS DISTINCT FROM NEW.attributes OR OLD.photo_hashval IS DISTINCT FROM NEW.photo_hashval OR OLD.photo512_hashval IS DISTINCT FROM NEW.photo512_hashval)
+EXECUTE FUNCTION confreg_speaker_schedule_changed()
+            """,
+            "DROP TRIGGER confreg_speaker_schedule_trigger ON confreg_speaker",
+        ),
+    ]
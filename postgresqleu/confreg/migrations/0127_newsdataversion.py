@@ -0,0 +1,75 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('confreg', '0126_conferencedataversion'),
+        ('newsevents', '0004_tweet_news'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+CREATE OR REPLACE FUNCTION confreg_conference_create_data_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified)
+    SELECT NEW.id, d, 0, CURRENT_TIMESTAMP FROM unnest(ARRAY['schedule', 'news']) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            """
+CREATE OR REPLACE FUNCTION confreg_conference_create_data_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified)
+    SELECT NEW.id, d, 0, CURRENT_TIMESTAMP FROM unnest(ARRAY['schedule']) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+        ),
+        migrations.RunSQL(
+            "INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified) SELECT id, 'news', 0, CURRENT_TIMESTAMP FROM confreg_conference",
+            "DELETE FROM confreg_conferencedataversion WHERE datatype='news'",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conferencenews_news_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencenews
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('news', 'conference_id');
+CREATE TRIGGER confreg_conferencetweetqueue_news_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferencetweetqueue
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('news', 'conference_id');
+            """,
+            """
+DROP TRIGGER confreg_conferencenews_news_trigger ON confreg_conferencenews;
+DROP TRIGGER confreg_conferencetweetqueue_news_trigger ON confreg_conferencetweetqueue;
+            """,
+        ),
+        # The name of the author is included in the news, so update all conferences they have posted for
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_newsposter_news_changed() RETURNS trigger AS $$
+BEGIN
+    UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP
+     WHERE datatype='news' AND conference_id IN (
+      SELECT conference_id FROM confreg_conferencenews WHERE author_id=NEW.author_id
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_newsposter_news_changed()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_newsposter_news_trigger
+AFTER UPDATE OF fullname ON newsevents_newsposterprofile
+FOR EACH ROW
+WHEN (OLD.fullname IS DISTINCT FROM NEW.fullname)
+EXECUTE FUNCTION confreg_newsposter_news_changed()
+            """,
+            "DROP TRIGGER confreg_newsposter_news_trigger ON newsevents_newsposterprofile",
+        ),
+    ]
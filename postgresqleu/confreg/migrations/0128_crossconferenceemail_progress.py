@@ -0,0 +1,37 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('confreg', '0127_newsdataversion'),
+    ]
+
+    operations = [
+        # All existing emails were sent directly from the web request
+        migrations.AddField(
+            model_name='crossconferenceemail',
+            name='sent',
+            field=models.BooleanField(default=True),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='crossconferenceemail',
+            name='sent',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='crossconferenceemail',
+            name='recipientcount',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='crossconferenceemail',
+            name='sentcount',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunSQL(
+            "UPDATE confreg_crossconferenceemail e SET recipientcount=c.num, sentcount=c.num FROM (SELECT email_id, count(*) AS num FROM confreg_crossconferenceemailrecipient GROUP BY email_id) c WHERE c.email_id=e.id",
+            migrations.RunSQL.noop,
+        ),
+    ]
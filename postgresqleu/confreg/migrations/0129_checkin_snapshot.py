@@ -0,0 +1,130 @@
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('confreg', '0128_crossconferenceemail_progress'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            """
+CREATE OR REPLACE FUNCTION confreg_conference_create_data_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified)
+    SELECT NEW.id, d, 0, CURRENT_TIMESTAMP FROM unnest(ARRAY['schedule', 'news', 'checkin']) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            """
+CREATE OR REPLACE FUNCTION confreg_conference_create_data_versions() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified)
+    SELECT NEW.id, d, 0, CURRENT_TIMESTAMP FROM unnest(ARRAY['schedule', 'news']) d;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+        ),
+        migrations.RunSQL(
+            "INSERT INTO confreg_conferencedataversion (conference_id, datatype, version, lastmodified) SELECT id, 'checkin', 0, CURRENT_TIMESTAMP FROM confreg_conference",
+            "DELETE FROM confreg_conferencedataversion WHERE datatype='checkin'",
+        ),
+        # Id of the last transaction that inserted or updated the registration, used
+        # to incrementally refresh the check-in snapshots (see checkincache.py). This
+        # is maintained only by the database, so it's not part of the model.
+        migrations.RunSQL(
+            """
+ALTER TABLE confreg_conferenceregistration ADD COLUMN checkinxid bigint;
+CREATE INDEX confreg_conferenceregistration_checkinxid_idx ON confreg_conferenceregistration (conference_id, checkinxid);
+            """,
+            "ALTER TABLE confreg_conferenceregistration DROP COLUMN checkinxid",
+        ),
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_registration_set_checkinxid() RETURNS trigger AS $$
+BEGIN
+    NEW.checkinxid := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_registration_set_checkinxid()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conferenceregistration_checkinxid_trigger
+BEFORE INSERT OR UPDATE ON confreg_conferenceregistration
+FOR EACH ROW EXECUTE FUNCTION confreg_registration_set_checkinxid()
+            """,
+            "DROP TRIGGER confreg_conferenceregistration_checkinxid_trigger ON confreg_conferenceregistration",
+        ),
+        # Changing the additional options of a registration counts as changing the registration
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_registration_options_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        UPDATE confreg_conferenceregistration SET checkinxid=txid_current() WHERE id=OLD.conferenceregistration_id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        UPDATE confreg_conferenceregistration SET checkinxid=txid_current() WHERE id=NEW.conferenceregistration_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_registration_options_changed()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conferenceregistration_additionaloptions_checkin_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_conferenceregistration_additionaloptions
+FOR EACH ROW EXECUTE FUNCTION confreg_registration_options_changed()
+            """,
+            "DROP TRIGGER confreg_conferenceregistration_additionaloptions_checkin_trigger ON confreg_conferenceregistration_additionaloptions",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_conferenceregistration_checkin_trigger
+AFTER DELETE ON confreg_conferenceregistration
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('checkin', 'conference_id');
+CREATE TRIGGER confreg_registrationtype_checkin_trigger
+AFTER INSERT OR UPDATE OR DELETE ON confreg_registrationtype
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('checkin', 'conference_id');
+CREATE TRIGGER confreg_conferenceadditionaloption_checkin_trigger
+AFTER UPDATE OR DELETE ON confreg_conferenceadditionaloption
+FOR EACH ROW EXECUTE FUNCTION confreg_data_changed('checkin', 'conference_id');
+            """,
+            """
+DROP TRIGGER confreg_conferenceregistration_checkin_trigger ON confreg_conferenceregistration;
+DROP TRIGGER confreg_registrationtype_checkin_trigger ON confreg_registrationtype;
+DROP TRIGGER confreg_conferenceadditionaloption_checkin_trigger ON confreg_conferenceadditionaloption;
+            """,
+        ),
+        # Shirt sizes aren't tied to a conference, so update all conferences
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_shirtsize_checkin_changed() RETURNS trigger AS $$
+BEGIN
+    UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP
+     WHERE datatype='checkin';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_shirtsize_checkin_changed()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER confreg_shirtsize_checkin_trigger
+AFTER UPDATE ON confreg_shirtsize
+FOR EACH ROW
+WHEN (OLD.shirtsize IS DISTINCT FROM NEW.shirtsize)
+EXECUTE FUNCTION confreg_shirtsize_checkin_changed()
+            """,
+            "DROP TRIGGER confreg_shirtsize_checkin_trigger ON confreg_shirtsize",
+        ),
+    ]
@@ -0,0 +1,147 @@
+from django.db import migrations
+
+# Increment the data versions once per statement instead of once per row, so
+# bulk changes don't create a new version of the counter row for every row
+# changed, and don't hold the lock on it for longer than they have to.
+# Each entry is trigger name, table, events, datatype, column and parent table.
+# If parent table is set, the column refers to a row in that table that has
+# the conference_id, otherwise the column is the conference_id itself.
+TRIGGERS = (
+    ('confreg_conferencesession_schedule_trigger', 'confreg_conferencesession', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conference_id', None),
+    ('confreg_room_schedule_trigger', 'confreg_room', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conference_id', None),
+    ('confreg_track_schedule_trigger', 'confreg_track', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conference_id', None),
+    ('confreg_conferencesessiontag_schedule_trigger', 'confreg_conferencesessiontag', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conference_id', None),
+    ('confreg_conferencesession_speaker_schedule_trigger', 'confreg_conferencesession_speaker', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conferencesession_id', 'confreg_conferencesession'),
+    ('confreg_conferencesession_tags_schedule_trigger', 'confreg_conferencesession_tags', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conferencesession_id', 'confreg_conferencesession'),
+    ('confreg_conferencesessionslides_schedule_trigger', 'confreg_conferencesessionslides', ('INSERT', 'DELETE'), 'schedule', 'session_id', 'confreg_conferencesession'),
+    ('confreg_room_availabledays_schedule_trigger', 'confreg_room_availabledays', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'room_id', 'confreg_room'),
+    ('confreg_conferencenews_news_trigger', 'confreg_conferencenews', ('INSERT', 'UPDATE', 'DELETE'), 'news', 'conference_id', None),
+    ('confreg_conferencetweetqueue_news_trigger', 'confreg_conferencetweetqueue', ('INSERT', 'UPDATE', 'DELETE'), 'news', 'conference_id', None),
+    ('confreg_conferenceregistration_checkin_trigger', 'confreg_conferenceregistration', ('DELETE', ), 'checkin', 'conference_id', None),
+    ('confreg_registrationtype_checkin_trigger', 'confreg_registrationtype', ('INSERT', 'UPDATE', 'DELETE'), 'checkin', 'conference_id', None),
+    ('confreg_conferenceadditionaloption_checkin_trigger', 'confreg_conferenceadditionaloption', ('UPDATE', 'DELETE'), 'checkin', 'conference_id', None),
+)
+
+# Registration days are used for the room availability on the schedule,
+# but were not tracked before.
+NEW_TRIGGERS = (
+    ('confreg_registrationday_schedule_trigger', 'confreg_registrationday', ('INSERT', 'UPDATE', 'DELETE'), 'schedule', 'conference_id', None),
+)
+
+
+def _args(datatype, column, parenttable):
+    return ', '.join("'{}'".format(a) for a in (datatype, column, parenttable) if a)
+
+
+def _row_trigger(name, table, events, datatype, column, parenttable):
+    return "CREATE TRIGGER {} AFTER {} ON {} FOR EACH ROW EXECUTE FUNCTION confreg_data_changed({});".format(
+        name, ' OR '.join(events), table, _args(datatype, column, parenttable),
+    )
+
+
+def _statement_triggers(name, table, events, datatype, column, parenttable):
+    # Triggers with transition tables can only be for a single event, so
+    # there is one trigger per event.
+    referencing = {
+        'INSERT': 'NEW TABLE AS newrows',
+        'UPDATE': 'OLD TABLE AS oldrows NEW TABLE AS newrows',
+        'DELETE': 'OLD TABLE AS oldrows',
+    }
+    for event in events:
+        yield "CREATE TRIGGER {} AFTER {} ON {} REFERENCING {} FOR EACH STATEMENT EXECUTE FUNCTION confreg_data_changed({});".format(
+            _statement_trigger_name(name, event), event, table, referencing[event], _args(datatype, column, parenttable),
+        )
+
+
+def _statement_trigger_name(name, event):
+    return '{}_{}_trigger'.format(name[:-len('_trigger')], event.lower())
+
+
+def _drop_statement_triggers(name, table, events, *args):
+    for event in events:
+        yield "DROP TRIGGER {} ON {};".format(_statement_trigger_name(name, event), table)
+
+
+def _drop_trigger(name, table, *args):
+    return "DROP TRIGGER {} ON {};".format(name, table)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('confreg', '0129_checkin_snapshot'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            "\n".join(_drop_trigger(*t) for t in TRIGGERS),
+            "\n".join(_row_trigger(*t) for t in TRIGGERS),
+        ),
+        migrations.RunSQL(
+            """
+DROP FUNCTION confreg_data_changed();
+DROP FUNCTION confreg_bump_data_version_for_row(anyelement, text, text, text);
+            """,
+            """
+CREATE FUNCTION confreg_bump_data_version_for_row(_r anyelement, _datatype text, _column text, _parenttable text) RETURNS void AS $$
+DECLARE
+    _id integer;
+BEGIN
+    EXECUTE format('SELECT ($1).%I', _column) INTO _id USING _r;
+    IF _parenttable IS NOT NULL THEN
+        EXECUTE format('SELECT conference_id FROM %I WHERE id=$1', _parenttable) INTO _id USING _id;
+    END IF;
+    UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP
+     WHERE conference_id=_id AND datatype=_datatype;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION confreg_data_changed() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        IF OLD IS NOT DISTINCT FROM NEW THEN
+            RETURN NULL;
+        END IF;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM confreg_bump_data_version_for_row(OLD, TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM confreg_bump_data_version_for_row(NEW, TG_ARGV[0], TG_ARGV[1], TG_ARGV[2]);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+            """,
+        ),
+        # Statement level trigger function, with arguments datatype, column and optionally
+        # parent table. The changed rows are available as newrows and oldrows.
+        migrations.RunSQL(
+            """
+CREATE FUNCTION confreg_data_changed() RETURNS trigger AS $$
+DECLARE
+    _ids text;
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        _ids := format('SELECT %I FROM newrows', TG_ARGV[1]);
+    ELSIF TG_OP = 'DELETE' THEN
+        _ids := format('SELECT %I FROM oldrows', TG_ARGV[1]);
+    ELSE
+        -- Only rows that actually changed
+        _ids := format('SELECT unnest(ARRAY[o.%1$I, n.%1$I]) FROM oldrows o INNER JOIN newrows n ON n.id=o.id WHERE o IS DISTINCT FROM n', TG_ARGV[1]);
+    END IF;
+    IF TG_ARGV[2] IS NOT NULL THEN
+        _ids := format('SELECT conference_id FROM %I WHERE id IN (%s)', TG_ARGV[2], _ids);
+    END IF;
+    EXECUTE format('UPDATE confreg_conferencedataversion SET version=version+1, lastmodified=CURRENT_TIMESTAMP WHERE datatype=$1 AND conference_id IN (%s)', _ids) USING TG_ARGV[0];
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION confreg_data_changed()",
+        ),
+        migrations.RunSQL(
+            "\n".join(sql for t in TRIGGERS + NEW_TRIGGERS for sql in _statement_triggers(*t)),
+            "\n".join(sql for t in TRIGGERS + NEW_TRIGGERS for sql in _drop_statement_triggers(*t)),
+        ),
+    ]
@@ -1343,6 +1343,22 @@ class ConferenceSessionSlides(models.Model):
         ordering = ('session', 'name', )
 
 
+class ConferenceDataVersion(models.Model):
+    # Version counters for publicly visible data of a conference, used to
+    # invalidate caches of it. The rows are created when the conference is
+    # created, and the counters are incremented by triggers whenever any of
+    # the underlying data changes (see migrations 0126 and 0127).
+    conference = models.ForeignKey(Conference, null=False, blank=False, on_delete=models.CASCADE)
+    datatype = models.CharField(max_length=20, null=False, blank=False)
+    version = models.BigIntegerField(null=False, blank=False, default=0)
+    lastmodified = models.DateTimeField(null=False, blank=False, default=timezone.now)
+
+    class Meta:
+        unique_together = (
+            ('conference', 'datatype', ),
+        )
+
+
 class ConferenceSessionVote(models.Model):
     session = models.ForeignKey(ConferenceSession, null=False, blank=False, on_delete=models.CASCADE)
     voter = models.ForeignKey(User, null=False, blank=False, on_delete=models.CASCADE)
@@ -1916,6 +1932,10 @@ class CrossConferenceEmail(models.Model):
     sendername = models.CharField(max_length=100, null=False, blank=False, verbose_name='Sender name')
     subject = models.CharField(max_length=80, null=False, blank=False)
     text = models.TextField(blank=False, null=False)
+    # Recipients are expanded and the mails queued by the confreg_send_crossmails job
+    sent = models.BooleanField(null=False, blank=False, default=False)
+    recipientcount = models.IntegerField(null=True, blank=True)
+    sentcount = models.IntegerField(null=False, blank=False, default=0)
 
     @property
     def rules_included(self):
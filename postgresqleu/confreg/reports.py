@@ -1,4 +1,4 @@
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
 from django.conf import settings
 from django.contrib import messages
@@ -16,7 +16,7 @@ import json
 
 from .jinjapdf import render_jinja_badges
 
-from postgresqleu.util.db import exec_to_dict, exec_to_single_list
+from postgresqleu.util.db import exec_to_dict, exec_to_dict_iter, exec_to_single_list
 from postgresqleu.util.db import ensure_conference_timezone
 from postgresqleu.countries.models import Country
 from .models import ConferenceRegistration, RegistrationType, ConferenceAdditionalOption, ShirtSize
@@ -353,6 +353,9 @@ class ReportWriterBase(object):
     def add_row(self, row):
         self.rows.append(row)
 
+    def set_rows(self, rows):
+        self.rows = list(rows)
+
 
 class ReportWriterHtml(ReportWriterBase):
     def render(self):
@@ -367,14 +370,24 @@ class ReportWriterHtml(ReportWriterBase):
         })
 
 
+class _CsvLineBuffer:
+    # The csv writer wants a file, but we just want it to return the lines
+    def write(self, value):
+        return value
+
+
 class ReportWriterCsv(ReportWriterBase):
-    def render(self):
-        resp = HttpResponse(content_type='text/plain; charset=utf-8')
-        c = csv.writer(resp, delimiter=';')
-        for r in self.rows:
-            c.writerow(r)
+    # The CSV report is streamed, so rows can be set to a generator in which
+    # case they are written out as they are generated.
+    def set_rows(self, rows):
+        self.rows = rows
 
-        return resp
+    def render(self):
+        c = csv.writer(_CsvLineBuffer(), delimiter=';')
+        return StreamingHttpResponse(
+            (c.writerow(r) for r in self.rows),
+            content_type='text/plain; charset=utf-8',
+        )
 
 
 class ReportWriterPdf(ReportWriterBase):
@@ -572,7 +585,7 @@ class AttendeeReportManager:
             'conference_id': self.conference.id,
         }
 
-        if format not in ('json', 'badge'):
+        if format not in ('json', 'jsonl', 'badge'):
             # Regular reports, so we control all fields
             rfields = [self.fieldmap[f] for f in fields]
 
@@ -595,7 +608,7 @@ class AttendeeReportManager:
                 ", ".join([o.get_orderby_field() for o in ofields]),
             )
         else:
-            # For json and badge, we have a mostly hardcoded query, but we still get the filter from
+            # For json(l) and badge, we have a mostly hardcoded query, but we still get the filter from
             # above.
             # We do this hardcoded because the django ORM can't even begin to understand what we're
             # doing here, and generates a horrible loop of queries.
@@ -643,8 +656,16 @@ WHERE r.conference_id=%(conference_id)s {}
 GROUP BY r.id, conference.id, rt.id, rc.id, country.iso, s.id, pt.id
 ORDER BY {}""".format(settings.SITEBASE, settings.SITEBASE, where, ", ".join([_get_table_aliased_field(o.get_orderby_field()) for o in ofields]))
 
-        with ensure_conference_timezone(self.conference):
-            result = exec_to_dict(query, params)
+        if format in ('csv', 'jsonl'):
+            # These formats are streamed to the client straight from a server-side
+            # cursor, so memory usage does not depend on the size of the report.
+            def _stream_result():
+                with ensure_conference_timezone(self.conference):
+                    yield from exec_to_dict_iter(query, params)
+            result = _stream_result()
+        else:
+            with ensure_conference_timezone(self.conference):
+                result = exec_to_dict(query, params)
 
         if format == 'html':
             writer = ReportWriterHtml(request, self.conference, title, borders)
@@ -657,6 +678,13 @@ ORDER BY {}""".format(settings.SITEBASE, settings.SITEBASE, where, ", ".join([_g
             resp = HttpResponse(content_type='application/json')
             json.dump(result, resp, indent=2)
             return resp
+        elif format == 'jsonl':
+            resp = StreamingHttpResponse(
+                (json.dumps(r) + "\n" for r in result),
+                content_type='application/jsonl',
+            )
+            resp['Content-Disposition'] = 'attachment; filename="{}.jsonl"'.format(self.conference.urlname)
+            return resp
         elif format == 'badge':
             try:
                 resp = HttpResponse(content_type='application/pdf')
@@ -679,10 +707,13 @@ ORDER BY {}""".format(settings.SITEBASE, settings.SITEBASE, where, ", ".join([_g
             allheaders.extend(extracols)
         writer.set_headers(allheaders)
 
-        for r in result:
-            row = [self.fieldmap[f].get_value(r[f]) for f in fields]
-            row.extend([[]] * len(extracols))
-            writer.add_row(row)
+        def _get_rows():
+            for r in result:
+                row = [self.fieldmap[f].get_value(r[f]) for f in fields]
+                row.extend([[]] * len(extracols))
+                yield row
+
+        writer.set_rows(_get_rows())
 
         return writer.render()
 
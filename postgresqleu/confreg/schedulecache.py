@@ -0,0 +1,91 @@
+# Per-process cache of the published schedule of conferences.
+#
+# Anything that changes what's on the schedule (sessions, rooms, tracks,
+# tags, slides, speakers and registration days) increments the schedule
+# version of the conference by way of database triggers. The version, along with the
+# fields of the conference itself that affect the output, is used as the
+# key for the cache and to generate ETags for the different formats of
+# the schedule, so a client that already has the current version gets a
+# 304 without anything being regenerated.
+from django.http import HttpResponse
+from django.utils import timezone
+
+import hashlib
+import threading
+
+from postgresqleu.util.db import exec_to_scalar
+from postgresqleu.util.lrucache import LRUCache
+from .conditional import get_data_version, conditional_response
+
+
+_schedule_cache = LRUCache(100)
+
+
+class ScheduleSnapshot:
+    def __init__(self, conference, key):
+        self.key = key
+        self._items = {}
+        self._lock = threading.Lock()
+
+        # If feedback is open, whether a session can be given feedback on depends on
+        # if it has started, so the snapshot is only valid until the next session starts.
+        if conference.feedbackopen:
+            self.validuntil = exec_to_scalar("SELECT min(starttime) FROM confreg_conferencesession WHERE conference_id=%(confid)s AND starttime > CURRENT_TIMESTAMP", {
+                'confid': conference.id,
+            })
+        else:
+            self.validuntil = None
+
+        self._etagbase = '{}/{}'.format(repr(self.key), self.validuntil)
+
+    def is_valid(self):
+        return self.validuntil is None or self.validuntil > timezone.now()
+
+    def etag(self, what):
+        return '"{}"'.format(hashlib.sha1('{}/{}'.format(self._etagbase, what).encode('utf8')).hexdigest())
+
+    def get(self, what, builder):
+        # Holding the lock while building means concurrent requests for the same
+        # thing wait for it to be built once, rather than all building it.
+        with self._lock:
+            if what not in self._items:
+                self._items[what] = builder(self)
+            return self._items[what]
+
+
+def get_schedule_snapshot(conference):
+    key = (
+        conference.id,
+        get_data_version(conference, 'schedule'),
+        conference.urlname,
+        conference.conferencename,
+        conference.startdate,
+        conference.enddate,
+        conference.tzname,
+        conference.scheduleactive,
+        conference.tbdinschedule,
+        conference.schedulewidth,
+        conference.pixelsperminute,
+        conference.feedbackopen,
+    )
+    snapshot = _schedule_cache.get(conference.id)
+    if snapshot is None or snapshot.key != key or not snapshot.is_valid():
+        snapshot = ScheduleSnapshot(conference, key)
+        _schedule_cache.set(conference.id, snapshot)
+    return snapshot
+
+
+# Return a response for one format of the schedule from the cache. The builder
+# is called with the snapshot if the content is not yet cached, and should return
+# a tuple of content, content type and a dict of extra headers.
+def cached_schedule_response(request, conference, what, builder, public=True):
+    snapshot = get_schedule_snapshot(conference)
+
+    def _response():
+        content, content_type, headers = snapshot.get(what, builder)
+        r = HttpResponse(content, content_type=content_type)
+        for k, v in headers.items():
+            r[k] = v
+        return r
+
+    return conditional_response(request, _response, etag=snapshot.etag(what), public=public)
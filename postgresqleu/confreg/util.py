@@ -11,11 +11,11 @@ import os
 from decimal import Decimal
 from datetime import timedelta
 import urllib.parse
-from io import BytesIO
+from io import BytesIO, StringIO
 import re
 
-from postgresqleu.mailqueue.util import send_simple_mail, send_template_mail
-from postgresqleu.util.db import exec_to_keyed_dict
+from postgresqleu.mailqueue.util import send_simple_mail, send_template_mail, send_template_mail_bulk
+from postgresqleu.util.db import exec_to_dict, exec_to_keyed_dict
 from postgresqleu.util.middleware import RedirectException
 from postgresqleu.util.time import today_conference
 from postgresqleu.util.messaging.util import send_org_notification
@@ -61,6 +61,90 @@ def send_conference_mail(conference, receiver, subject, templatename, templateat
     )
 
 
+# Send the same conference template to many recipients, given as an iterable of
+# (receiver, receivername, templateattr). Returns the number of mails queued.
+def send_conference_mail_bulk(conference, subject, templatename, recipients, sender=None, sendername=None, sendat=None):
+    return send_template_mail_bulk(
+        sender or conference.contactaddr,
+        "[{0}] {1}".format(conference.conferencename, subject),
+        templatename,
+        recipients,
+        sendername=sendername or conference.conferencename,
+        sendat=sendat,
+        conference=conference,
+    )
+
+
+def _get_crossmail_rule_query(confid, ruletype, ruleref, canceled, optout_filter):
+    confid = int(confid)
+    ruleref = int(ruleref)
+    if ruletype == 'rt':
+        # Regtype
+        q = "SELECT attendee_id, email, firstname || ' ' || lastname, regtoken FROM confreg_conferenceregistration WHERE conference_id={0} AND payconfirmedat IS NOT NULL".format(confid)
+        if ruleref != -1:
+            q += ' AND regtype_id={0}'.format(ruleref)
+        if not canceled:
+            # Exclude canceled registrations
+            q += ' AND canceledat IS NULL'
+        if optout_filter:
+            q += " AND NOT localoptout AND NOT EXISTS (SELECT 1 FROM confreg_conferenceseriesoptout INNER JOIN confreg_conference ON confreg_conference.series_id=confreg_conferenceseriesoptout.series_id WHERE user_id=attendee_id AND confreg_conference.id={0})".format(confid)
+    elif ruletype == 'sp':
+        # Speaker
+        if ruleref == -1:
+            sf = ""
+        elif ruleref == -2:
+            sf = " AND status IN (1,3)"
+        else:
+            sf = " AND status = {0}".format(ruleref)
+
+        q = "SELECT user_id, email, fullname, speakertoken FROM confreg_speaker INNER JOIN auth_user ON auth_user.id=confreg_speaker.user_id WHERE EXISTS (SELECT 1 FROM confreg_conferencesession_speaker INNER JOIN confreg_conferencesession ON confreg_conferencesession.id=conferencesession_id WHERE speaker_id=confreg_speaker.id AND conference_id={0}{1})".format(confid, sf)
+        if optout_filter:
+            q += " AND NOT EXISTS (SELECT 1 FROM confreg_conferenceseriesoptout INNER JOIN confreg_conference ON confreg_conference.series_id=confreg_conferenceseriesoptout.series_id WHERE confreg_conferenceseriesoptout.user_id=confreg_speaker.user_id AND confreg_conference.id={0})".format(confid)
+    elif ruletype == 'vol':
+        # Volunteers
+        q = "SELECT attendee_id, email, firstname || ' ' || lastname, regtoken FROM confreg_conferenceregistration r WHERE r.conference_id={0} AND r.payconfirmedat IS NOT NULL ".format(confid)
+        if ruleref == 0:
+            # General volunteer
+            q += "AND EXISTS (SELECT 1 FROM confreg_conference_volunteers cv WHERE cv.conference_id={} AND cv.conferenceregistration_id=r.id)".format(confid)
+        elif ruleref == 1:
+            # Check-in processor
+            q += "AND EXISTS (SELECT 1 FROM confreg_conference_checkinprocessors cc WHERE cc.conference_id={} AND cc.conferenceregistration_id=r.id)".format(confid)
+        else:
+            raise Exception("Invalid filter value")
+    else:
+        raise Exception("Invalid filter type")
+    return q
+
+
+#
+# Get the recipients of a cross conference email. Includes and excludes are lists
+# of (conferenceid, ruletype, ruleref, canceled) tuples, and the result is a list
+# of dicts with email, fullname and token, with each address included only once.
+#
+def get_crossmail_recipients(includes, excludes):
+    if not includes:
+        return []
+
+    incs = [_get_crossmail_rule_query(*r, optout_filter=True) for r in includes]
+    excs = [_get_crossmail_rule_query(*r, optout_filter=False) for r in excludes]
+
+    q = StringIO()
+    q.write("WITH incs (userid, email, fullname, token) AS (")
+    q.write("\nUNION ALL\n".join(incs))
+    q.write("\n)")
+    if excs:
+        q.write(", excs (userid, email, fullname, token) AS (\n")
+        q.write("\nUNION ALL\n".join(excs))
+        q.write("\n)\n")
+    q.write("SELECT DISTINCT ON (email) email, fullname, token FROM incs\n")
+    q.write(" WHERE (userid IS NULL OR userid NOT IN (SELECT user_id FROM confreg_globaloptout))\n")
+    if excs:
+        q.write(" and email NOT IN (SELECT email FROM excs)\n")
+    q.write("ORDER BY email, userid NULLS LAST")  # If there is a userid attached, pick that entry in the DISTINCT ON. Can happen for canceled regs who canceled and then re-registered.
+
+    return exec_to_dict(q.getvalue())
+
+
 class InvoicerowsException(Exception):
     pass
 
@@ -52,6 +52,7 @@ from .util import attendee_cost_from_bulk_payment
 from .util import send_conference_mail, send_conference_notification, send_conference_notification_template
 from .util import reglog
 from .util import make_registration_transfer
+from .util import get_crossmail_recipients
 from .mail import attendee_email_form, BaseAttendeeEmailProvider, AttendeeEmailQuerySampleMixin
 from .mail import render_jinja_conference_mail_inline_attachments
 
@@ -67,6 +68,9 @@ from .util import get_authenticated_conference, get_conference_or_404
 from .backendforms import CancelRegistrationForm, ConfirmRegistrationForm
 from .backendforms import ResendWelcomeMailForm, ResendAttachMailForm
 from .twitter import create_twitterpost_thumbnail
+from .schedulecache import get_schedule_snapshot, cached_schedule_response
+from .conditional import conditional_response, conference_etag, get_news_version
+from .conditional import get_data_version, get_template_revision
 
 from postgresqleu.util.request import get_int_or_error
 from postgresqleu.util.random import generate_random_token
@@ -86,7 +90,6 @@ from postgresqleu.util.db import ensure_conference_timezone
 from postgresqleu.util.qr import generate_base64_qr
 from postgresqleu.util.time import datetime_string
 from postgresqleu.scheduler.util import trigger_immediate_job_run
-from postgresqleu.mailqueue.util import send_template_mail
 
 from decimal import Decimal
 from operator import itemgetter
@@ -97,7 +100,7 @@ import re
 import os
 from urllib.parse import urlencode
 from Cryptodome.Hash import SHA256
-from io import StringIO
+from io import BytesIO
 import xml.etree.ElementTree as ET
 
 import json
@@ -257,58 +260,68 @@ def news_json(request, confname):
     elif count > 20:
         count = 20
 
-    ret = {}
-    if 'news' in parts:
-        news = ConferenceNews.objects.select_related('author').filter(
-            conference=conference,
-            datetime__lt=timezone.now(),
-        )[:count]
-        ret['news'] = [{
-            'id': n.id,
-            'title': n.title,
-            'titleslug': slugify(n.title),
-            'datetime': timezone.localtime(n.datetime),
-            'authorname': n.author.fullname,
-            'summary': markdown.markdown(n.summary),
-            'inrss': n.inrss,
-            'url': '{}/events/{}/news/{}-{}/'.format(settings.SITEBASE, conference.urlname, slugify(n.title), n.id),
-        } for n in news]
-
-    if 'posts' in parts:
-        providers = ProviderCache()
-
-        # Only include posts that are sent to all associated accounts, otherwise we can end up generating invalid links.
-        posts = ConferenceTweetQueue.objects.defer('image', 'imagethumb').filter(
-            conference=conference,
-            approved=True,
-            sent=True,
-            datetime__lt=timezone.now(),
-        ).exclude(postids={}).extra(
-            select={'hasimage': "image is not null and image != ''"}
-        ).order_by('-datetime')[:count]
-
-        ret['posts'] = [{
-            'id': p.id,
-            'datetime': timezone.localtime(p.datetime),
-            'hasimage': p.hasimage,
-            'posts': [{
-                'type': providers.get_by_id(providerid).typename,
-                'provider': providerid,
-                'text': p.contents[str(providerid)] if isinstance(p.contents, dict) else p.contents,
-                'link': providers.get_by_id(providerid).get_link(postid)[1],
-            } for postid, providerid in p.postids.items()]
-        } for p in posts]
-
-    # Special case for legacy compatibility, returns news as top level object
-    if 'include' not in request.GET:
-        r = HttpResponse(json.dumps(
-            ret['news'],
-            cls=JsonSerializer), content_type='application/json')
-    else:
-        r = HttpResponse(json.dumps(
-            ret,
-            cls=JsonSerializer), content_type='application/json')
+    def _build():
+        ret = {}
+        if 'news' in parts:
+            news = ConferenceNews.objects.select_related('author').filter(
+                conference=conference,
+                datetime__lt=timezone.now(),
+            )[:count]
+            ret['news'] = [{
+                'id': n.id,
+                'title': n.title,
+                'titleslug': slugify(n.title),
+                'datetime': timezone.localtime(n.datetime),
+                'authorname': n.author.fullname,
+                'summary': markdown.markdown(n.summary),
+                'inrss': n.inrss,
+                'url': '{}/events/{}/news/{}-{}/'.format(settings.SITEBASE, conference.urlname, slugify(n.title), n.id),
+            } for n in news]
+
+        if 'posts' in parts:
+            providers = ProviderCache()
+
+            # Only include posts that are sent to all associated accounts, otherwise we can end up generating invalid links.
+            posts = ConferenceTweetQueue.objects.defer('image', 'imagethumb').filter(
+                conference=conference,
+                approved=True,
+                sent=True,
+                datetime__lt=timezone.now(),
+            ).exclude(postids={}).extra(
+                select={'hasimage': "image is not null and image != ''"}
+            ).order_by('-datetime')[:count]
+
+            ret['posts'] = [{
+                'id': p.id,
+                'datetime': timezone.localtime(p.datetime),
+                'hasimage': p.hasimage,
+                'posts': [{
+                    'type': providers.get_by_id(providerid).typename,
+                    'provider': providerid,
+                    'text': p.contents[str(providerid)] if isinstance(p.contents, dict) else p.contents,
+                    'link': providers.get_by_id(providerid).get_link(postid)[1],
+                } for postid, providerid in p.postids.items()]
+            } for p in posts]
+
+        # Special case for legacy compatibility, returns news as top level object
+        if 'include' not in request.GET:
+            r = HttpResponse(json.dumps(
+                ret['news'],
+                cls=JsonSerializer), content_type='application/json')
+        else:
+            r = HttpResponse(json.dumps(
+                ret,
+                cls=JsonSerializer), content_type='application/json')
 
+        return r
+
+    version, lastmodified = get_news_version(conference)
+    r = conditional_response(
+        request,
+        _build,
+        etag=conference_etag(conference, 'newsjson', version, lastmodified, request.GET.urlencode()),
+        lastmodified=lastmodified,
+    )
     r['Access-Control-Allow-Origin'] = '*'
     return r
 
@@ -1505,6 +1518,12 @@ ORDER BY day, s.starttime, r.sortkey""".format(
     }
 
 
+# The schedule data is shared between all requests in the process, and as such
+# must be treated as read-only.
+def _cached_scheduledata(conference):
+    return get_schedule_snapshot(conference).get('data', lambda snapshot: _scheduledata(None, conference))
+
+
 def schedule(request, confname):
     conference = get_conference_or_404(confname)
 
@@ -1512,7 +1531,7 @@ def schedule(request, confname):
         if not conference.testers.filter(pk=request.user.id):
             return render_conference_response(request, conference, 'schedule', 'confreg/scheduleclosed.html')
 
-    return render_conference_response(request, conference, 'schedule', 'confreg/schedule.html', _scheduledata(request, conference))
+    return render_conference_response(request, conference, 'schedule', 'confreg/schedule.html', _cached_scheduledata(conference))
 
 
 @csrf_exempt
@@ -1605,43 +1624,65 @@ def schedule_favorite(request, confname):
 def schedulejson(request, confname):
     conference = get_authenticated_conference(request, confname)
 
-    return HttpResponse(json.dumps(_scheduledata(request, conference),
-                                   cls=JsonSerializer,
-                                   indent=2),
-                        content_type='application/json')
+    def _build(snapshot):
+        return (
+            json.dumps(_cached_scheduledata(conference), cls=JsonSerializer, indent=2),
+            'application/json',
+            {},
+        )
+
+    return cached_schedule_response(request, conference, 'json', _build, public=False)
 
 
 def sessionlist(request, confname):
     conference = get_conference_or_404(confname)
 
-    if not conference.sessionsactive:
-        if not conference.testers.filter(pk=request.user.id):
-            return render_conference_response(request, conference, 'sessions', 'confreg/sessionsclosed.html')
+    def _render():
+        if not conference.sessionsactive:
+            if not conference.testers.filter(pk=request.user.id):
+                return render_conference_response(request, conference, 'sessions', 'confreg/sessionsclosed.html')
 
-    sessions = ConferenceSession.objects.filter(conference=conference).extra(select={
-        'has_slides': 'EXISTS (SELECT 1 FROM confreg_conferencesessionslides WHERE session_id=confreg_conferencesession.id)',
-    }).filter(cross_schedule=False).filter(status=1).filter(track__insessionlist=True).order_by('track__sortkey', 'track', 'title')
+        sessions = ConferenceSession.objects.filter(conference=conference).extra(select={
+            'has_slides': 'EXISTS (SELECT 1 FROM confreg_conferencesessionslides WHERE session_id=confreg_conferencesession.id)',
+        }).filter(cross_schedule=False).filter(status=1).filter(track__insessionlist=True).order_by('track__sortkey', 'track', 'title')
 
-    return render_conference_response(request, conference, 'sessions', 'confreg/sessionlist.html', {
-        'sessions': sessions,
-    })
+        return render_conference_response(request, conference, 'sessions', 'confreg/sessionlist.html', {
+            'sessions': sessions,
+        })
+
+    # Logged in users get per-user content on the page (and may be testers),
+    # so only the anonymous version of the page is cacheable.
+    templaterevision = get_template_revision(conference)
+    if request.user.is_authenticated or templaterevision is None:
+        return _render()
+
+    return conditional_response(
+        request,
+        _render,
+        etag=conference_etag(conference, 'sessionlist', get_data_version(conference, 'schedule'), templaterevision, request.GET.urlencode()),
+    )
 
 
 def schedule_ical(request, confname):
     conference = get_conference_or_404(confname)
 
-    if not conference.scheduleactive:
-        # Not open. But we can't really render an error, so render a
-        # completely empty session list instead
-        sessions = None
-    else:
-        sessions = ConferenceSession.objects.filter(conference=conference).filter(cross_schedule=False).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime')
-    resp = render(request, 'confreg/schedule.ical', {
-        'conference': conference,
-        'sessions': sessions,
-    }, content_type='text/calendar')
-    resp['Content-Disposition'] = 'attachment; filename="{}.ical"'.format(conference.urlname)
-    return resp
+    def _build(snapshot):
+        if not conference.scheduleactive:
+            # Not open. But we can't really render an error, so render a
+            # completely empty session list instead
+            sessions = None
+        else:
+            sessions = ConferenceSession.objects.filter(conference=conference).filter(cross_schedule=False).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime')
+        return (
+            render(request, 'confreg/schedule.ical', {
+                'conference': conference,
+                'sessions': sessions,
+            }).content,
+            'text/calendar',
+            {'Content-Disposition': 'attachment; filename="{}.ical"'.format(conference.urlname)},
+        )
+
+    return cached_schedule_response(request, conference, 'ical', _build)
 
 
 def schedule_xcal(request, confname):
@@ -1649,30 +1690,37 @@ def schedule_xcal(request, confname):
 
     if not conference.scheduleactive:
         raise Http404()
-    x = ET.Element('iCalendar')
-    v = ET.SubElement(x, 'vcalendar')
-    ET.SubElement(v, 'version').text = '2.0'
-    ET.SubElement(v, 'prodid').text = '//pgeusys//Schedule 1.0//EN'
-    ET.SubElement(v, 'x-wr-caldesc')
-    ET.SubElement(v, 'x-wr-calname').text = 'Schedule for {0}'.format(conference.conferencename)
-    for sess in ConferenceSession.objects.filter(conference=conference).filter(cross_schedule=False).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime'):
-        s = ET.SubElement(v, 'vevent')
-        ET.SubElement(s, 'method').text = 'PUBLISH'
-        ET.SubElement(s, 'uid').text = '{0}@{1}'.format(sess.id, conference.urlname)
-        ET.SubElement(s, 'dtstart').text = sess.starttime.strftime('%Y%m%dT%H%M%SZ')
-        ET.SubElement(s, 'dtend').text = sess.endtime.strftime('%Y%m%dT%H%M%SZ')
-        ET.SubElement(s, 'summary').text = sess.title
-        ET.SubElement(s, 'description').text = sess.abstract
-        ET.SubElement(s, 'class').text = 'PUBLIC'
-        ET.SubElement(s, 'status').text = 'CONFIRMED'
-        ET.SubElement(s, 'url').text = '{0}/events/{1}/schedule/session/{2}/'.format(settings.SITEBASE, conference.urlname, sess.id)
-        ET.SubElement(s, 'location').text = sess.room and sess.room.roomname or ''
-        for spk in sess.speaker.all():
-            ET.SubElement(s, 'attendee').text = spk.name
-    resp = HttpResponse(content_type='text/xml; charset=utf-8')
-    ET.ElementTree(x).write(resp, encoding='utf-8', xml_declaration=True)
-    resp['Content-Disposition'] = 'attachment; filename="{}.xcs"'.format(conference.urlname)
-    return resp
+
+    def _build(snapshot):
+        x = ET.Element('iCalendar')
+        v = ET.SubElement(x, 'vcalendar')
+        ET.SubElement(v, 'version').text = '2.0'
+        ET.SubElement(v, 'prodid').text = '//pgeusys//Schedule 1.0//EN'
+        ET.SubElement(v, 'x-wr-caldesc')
+        ET.SubElement(v, 'x-wr-calname').text = 'Schedule for {0}'.format(conference.conferencename)
+        for sess in ConferenceSession.objects.filter(conference=conference).filter(cross_schedule=False).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime'):
+            s = ET.SubElement(v, 'vevent')
+            ET.SubElement(s, 'method').text = 'PUBLISH'
+            ET.SubElement(s, 'uid').text = '{0}@{1}'.format(sess.id, conference.urlname)
+            ET.SubElement(s, 'dtstart').text = sess.starttime.strftime('%Y%m%dT%H%M%SZ')
+            ET.SubElement(s, 'dtend').text = sess.endtime.strftime('%Y%m%dT%H%M%SZ')
+            ET.SubElement(s, 'summary').text = sess.title
+            ET.SubElement(s, 'description').text = sess.abstract
+            ET.SubElement(s, 'class').text = 'PUBLIC'
+            ET.SubElement(s, 'status').text = 'CONFIRMED'
+            ET.SubElement(s, 'url').text = '{0}/events/{1}/schedule/session/{2}/'.format(settings.SITEBASE, conference.urlname, sess.id)
+            ET.SubElement(s, 'location').text = sess.room and sess.room.roomname or ''
+            for spk in sess.speaker.all():
+                ET.SubElement(s, 'attendee').text = spk.name
+        out = BytesIO()
+        ET.ElementTree(x).write(out, encoding='utf-8', xml_declaration=True)
+        return (
+            out.getvalue(),
+            'text/xml; charset=utf-8',
+            {'Content-Disposition': 'attachment; filename="{}.xcs"'.format(conference.urlname)},
+        )
+
+    return cached_schedule_response(request, conference, 'xcal', _build)
 
 
 def _timedelta_minutes(td):
@@ -1686,48 +1734,55 @@ def schedule_xml(request, confname):
 
     if not conference.scheduleactive:
         raise Http404()
-    x = ET.Element('schedule')
-    ET.SubElement(x, 'version').text = 'Firefly'
-    c = ET.SubElement(x, 'conference')
-    ET.SubElement(c, 'title').text = conference.conferencename
-    ET.SubElement(c, 'start').text = conference.startdate.strftime("%Y-%m-%d")
-    ET.SubElement(c, 'end').text = conference.enddate.strftime("%Y-%m-%d")
-    ET.SubElement(c, 'days').text = str((conference.enddate - conference.startdate).days + 1)
-    ET.SubElement(c, 'baseurl').text = '{0}/events/{1}/schedule/'.format(settings.SITEBASE, conference.urlname)
-
-    lastday = None
-    lastroom = None
-    for sess in ConferenceSession.objects.filter(conference=conference).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime', 'cross_schedule', 'room__sortkey'):
-        if lastday != timezone.localdate(sess.starttime):
-            lastday = timezone.localdate(sess.starttime)
-            lastroom = None
-            xday = ET.SubElement(x, 'day', date=lastday.strftime("%Y-%m-%d"))  # START/END!
-        if sess.cross_schedule:
-            thisroom = 'Other'
-        elif sess.room:
-            thisroom = sess.room.roomname
-        else:
-            thisroom = ''
-        if lastroom != thisroom:
-            lastroom = thisroom
-            xroom = ET.SubElement(xday, 'room', name=lastroom)
-        e = ET.SubElement(xroom, 'event', id=str(sess.id))
-        ET.SubElement(e, 'start').text = timezone.localtime(sess.starttime).strftime('%H:%M')
-        ET.SubElement(e, 'duration').text = _timedelta_minutes(sess.endtime - sess.starttime)
-        ET.SubElement(e, 'room').text = lastroom
-        ET.SubElement(e, 'title').text = sess.title
-        ET.SubElement(e, 'abstract').text = sess.abstract
-        ET.SubElement(e, 'url').text = '{0}/events/{1}/schedule/session/{2}/'.format(settings.SITEBASE, conference.urlname, sess.id)
-        if sess.track:
-            ET.SubElement(e, 'track').text = sess.track.trackname
-        p = ET.SubElement(e, 'persons')
-        for spk in sess.speaker.all():
-            ET.SubElement(p, 'person', id=str(spk.id)).text = spk.name
-
-    resp = HttpResponse(content_type='text/xml; charset=utf-8')
-    ET.ElementTree(x).write(resp, encoding='utf-8', xml_declaration=True)
-    resp['Content-Disposition'] = 'attachment; filename="{}.xml"'.format(conference.urlname)
-    return resp
+
+    def _build(snapshot):
+        x = ET.Element('schedule')
+        ET.SubElement(x, 'version').text = 'Firefly'
+        c = ET.SubElement(x, 'conference')
+        ET.SubElement(c, 'title').text = conference.conferencename
+        ET.SubElement(c, 'start').text = conference.startdate.strftime("%Y-%m-%d")
+        ET.SubElement(c, 'end').text = conference.enddate.strftime("%Y-%m-%d")
+        ET.SubElement(c, 'days').text = str((conference.enddate - conference.startdate).days + 1)
+        ET.SubElement(c, 'baseurl').text = '{0}/events/{1}/schedule/'.format(settings.SITEBASE, conference.urlname)
+
+        lastday = None
+        lastroom = None
+        for sess in ConferenceSession.objects.filter(conference=conference).filter(status=1).filter(starttime__isnull=False).filter(track__isnull=False).order_by('starttime', 'cross_schedule', 'room__sortkey'):
+            if lastday != timezone.localdate(sess.starttime):
+                lastday = timezone.localdate(sess.starttime)
+                lastroom = None
+                xday = ET.SubElement(x, 'day', date=lastday.strftime("%Y-%m-%d"))  # START/END!
+            if sess.cross_schedule:
+                thisroom = 'Other'
+            elif sess.room:
+                thisroom = sess.room.roomname
+            else:
+                thisroom = ''
+            if lastroom != thisroom:
+                lastroom = thisroom
+                xroom = ET.SubElement(xday, 'room', name=lastroom)
+            e = ET.SubElement(xroom, 'event', id=str(sess.id))
+            ET.SubElement(e, 'start').text = timezone.localtime(sess.starttime).strftime('%H:%M')
+            ET.SubElement(e, 'duration').text = _timedelta_minutes(sess.endtime - sess.starttime)
+            ET.SubElement(e, 'room').text = lastroom
+            ET.SubElement(e, 'title').text = sess.title
+            ET.SubElement(e, 'abstract').text = sess.abstract
+            ET.SubElement(e, 'url').text = '{0}/events/{1}/schedule/session/{2}/'.format(settings.SITEBASE, conference.urlname, sess.id)
+            if sess.track:
+                ET.SubElement(e, 'track').text = sess.track.trackname
+            p = ET.SubElement(e, 'persons')
+            for spk in sess.speaker.all():
+                ET.SubElement(p, 'person', id=str(spk.id)).text = spk.name
+
+        out = BytesIO()
+        ET.ElementTree(x).write(out, encoding='utf-8', xml_declaration=True)
+        return (
+            out.getvalue(),
+            'text/xml; charset=utf-8',
+            {'Content-Disposition': 'attachment; filename="{}.xml"'.format(conference.urlname)},
+        )
+
+    return cached_schedule_response(request, conference, 'xml', _build)
 
 
 def session(request, confname, section, sessionid, slug=None):
@@ -5075,73 +5130,23 @@ def crossmail_send(request):
 
         return HttpResponse(_get_preview_text(request.POST['previewval']))
 
-    def _get_recipients_for_crossmail(postdict):
-        def _get_one_filter(conf, filt, optout_filter=False):
-            conf = int(conf)
-            if conf not in conferenceids:
+    def _parse_crossmail_rules(rulestr):
+        rules = []
+        for r in rulestr.split(';'):
+            if r == '':
+                continue
+            (conf, filt) = r.split('@')
+            if int(conf) not in conferenceids:
                 raise ValidationError("Invalid conference selected")
-
             (t, v, c) = filt.split(':')
-            c = c == "1"
-            if t == 'rt':
-                # Regtype
-                q = "SELECT attendee_id, email, firstname || ' ' || lastname, regtoken FROM confreg_conferenceregistration WHERE conference_id={0} AND payconfirmedat IS NOT NULL".format(conf)
-                if v != '-1':
-                    q += ' AND regtype_id={0}'.format(int(v))
-                if not c:
-                    # Exclude canceled registrations
-                    q += ' AND canceledat IS NULL'
-                if optout_filter:
-                    q += " AND NOT localoptout AND NOT EXISTS (SELECT 1 FROM confreg_conferenceseriesoptout INNER JOIN confreg_conference ON confreg_conference.series_id=confreg_conferenceseriesoptout.series_id WHERE user_id=attendee_id AND confreg_conference.id={0})".format(int(conf))
-            elif t == 'sp':
-                # Speaker
-                if v == '-1':
-                    sf = ""
-                elif v == '-2':
-                    sf = " AND status IN (1,3)"
-                else:
-                    sf = " AND status = {0}".format(int(v))
-
-                q = "SELECT user_id, email, fullname, speakertoken FROM confreg_speaker INNER JOIN auth_user ON auth_user.id=confreg_speaker.user_id WHERE EXISTS (SELECT 1 FROM confreg_conferencesession_speaker INNER JOIN confreg_conferencesession ON confreg_conferencesession.id=conferencesession_id WHERE speaker_id=confreg_speaker.id AND conference_id={0}{1})".format(conf, sf)
-                if optout_filter:
-                    q += " AND NOT EXISTS (SELECT 1 FROM confreg_conferenceseriesoptout INNER JOIN confreg_conference ON confreg_conference.series_id=confreg_conferenceseriesoptout.series_id WHERE confreg_conferenceseriesoptout.user_id=confreg_speaker.user_id AND confreg_conference.id={0})".format(int(conf))
-            elif t == 'vol':
-                # Volunteers
-                q = "SELECT attendee_id, email, firstname || ' ' || lastname, regtoken FROM confreg_conferenceregistration r WHERE r.conference_id={0} AND r.payconfirmedat IS NOT NULL ".format(conf)
-                if v == "0":
-                    # General volunteer
-                    q += "AND EXISTS (SELECT 1 FROM confreg_conference_volunteers cv WHERE cv.conference_id={} AND cv.conferenceregistration_id=r.id)".format(conf)
-                elif v == "1":
-                    # Check-in processor
-                    q += "AND EXISTS (SELECT 1 FROM confreg_conference_checkinprocessors cc WHERE cc.conference_id={} AND cc.conferenceregistration_id=r.id)".format(conf)
-                else:
-                    raise Exception("Invalid filter value")
-            else:
-                raise Exception("Invalid filter type")
-            return q
-
-        if postdict['include'] == '':
-            return []
-
-        # Parse all includes and excludes
-        incs = [_get_one_filter(*i.split('@'), optout_filter=True) for i in postdict['include'].split(';') if i != '']
-        excs = [_get_one_filter(*i.split('@')) for i in postdict['exclude'].split(';') if i != '']
-
-        q = StringIO()
-        q.write("WITH incs (userid, email, fullname, token) AS (")
-        q.write("\nUNION ALL\n".join(incs))
-        q.write("\n)")
-        if excs:
-            q.write(", excs (userid, email, fullname, token) AS (\n")
-            q.write("\nUNION ALL\n".join(excs))
-            q.write("\n)\n")
-        q.write("SELECT DISTINCT ON (email) email, fullname, token FROM incs\n")
-        q.write(" WHERE (userid IS NULL OR userid NOT IN (SELECT user_id FROM confreg_globaloptout))\n")
-        if excs:
-            q.write(" and email NOT IN (SELECT email FROM excs)\n")
-        q.write("ORDER BY email, userid NULLS LAST")  # If there is a userid attached, pick that entry in the DISTINCT ON. Can happen for canceled regs who canceled and then re-registered.
-
-        return exec_to_dict(q.getvalue())
+            rules.append((int(conf), t, int(v), c == "1"))
+        return rules
+
+    def _get_recipients_for_crossmail(postdict):
+        return get_crossmail_recipients(
+            _parse_crossmail_rules(postdict['include']),
+            _parse_crossmail_rules(postdict['exclude']),
+        )
 
     if request.method == 'POST' and request.POST.get('submit', None) == 'Send email':
         is_confirm = True
@@ -5166,19 +5171,9 @@ def crossmail_send(request):
 
         if form.is_valid() and recipients:
             if request.POST['submit'] == 'Confirm and send':
-                # Store the email itself and all the recipients
-                def _addrule(email, ruledef, isexclude):
-                    (confid, parts) = ruledef.split('@')
-                    (t, ref, canc) = parts.split(':')
-                    CrossConferenceEmailRule(
-                        email=email,
-                        conference=Conference.objects.get(pk=confid),
-                        isexclude=isexclude,
-                        ruletype=t,
-                        ruleref=ref,
-                        canceled=canc,
-                    ).save()
-
+                # Store the email itself and the rules. The recipients are expanded and
+                # the emails queued by a background job, since that can take a long time
+                # for large lists.
                 email = CrossConferenceEmail(
                     sentby=request.user,
                     senderaddr=form.data['senderaddr'],
@@ -5188,37 +5183,21 @@ def crossmail_send(request):
                 )
                 email.save()
 
-                for r in request.POST['include'].split(';'):
-                    if r:
-                        _addrule(email, r, False)
-                for r in request.POST['exclude'].split(';'):
-                    if r:
-                        _addrule(email, r, True)
-
-                for r in recipients:
-                    CrossConferenceEmailRecipient(email=email, address=r['email']).save()
-
-                    # Cross conference mails are sent using a non-conference template as they
-                    # reference multiple conferences that may have different ones.
-                    send_template_mail(
-                        form.data['senderaddr'],
-                        r['email'],
-                        form.data['subject'],
-                        'confreg/mail/cross_conference.txt',
-                        {
-                            'body': render_sandboxed_template(form.data['text'], {
-                                'name': r['fullname'],
-                                'email': r['email'],
-                                'token': r['token'],
-                            }),
-                            'token': r['token'],
-                        },
-                        sendername=form.data['sendername'],
-                        receivername=r['fullname'],
-                    )
-
-                messages.info(request, "Sent {0} emails.".format(len(recipients)))
-                return HttpResponseRedirect("../")
+                for isexclude, rulestr in ((False, request.POST['include']), (True, request.POST['exclude'])):
+                    for (confid, t, ref, canc) in _parse_crossmail_rules(rulestr):
+                        CrossConferenceEmailRule(
+                            email=email,
+                            conference_id=confid,
+                            isexclude=isexclude,
+                            ruletype=t,
+                            ruleref=ref,
+                            canceled=canc,
+                        ).save()
+
+                trigger_immediate_job_run('confreg_send_crossmails')
+
+                messages.info(request, "Email to {0} recipients queued for sending.".format(len(recipients)))
+                return HttpResponseRedirect("../{}/".format(email.id))
         elif not recipients:
             # Form is valid, but no recipients
             if recipients is not None:
@@ -14,7 +14,7 @@ from django.db.models import Q, F, Count
 from postgresqleu.confreg.models import DiscountCode
 from postgresqleu.confreg.util import send_conference_mail
 from postgresqleu.confsponsor.util import send_conference_sponsor_notification, send_sponsor_manager_email
-from postgresqleu.invoices.util import InvoiceManager, InvoiceWrapper
+from postgresqleu.invoices.util import InvoiceManager, InvoiceWrapper, InvoicePdfRenderer
 from postgresqleu.util.time import today_global
 
 
@@ -35,6 +35,8 @@ class Command(BaseCommand):
         # open discount codes.
         filt = Q(sponsor__isnull=False, is_invoiced=False) & (Q(validuntil__lte=today_global()) | Q(num_uses__gte=F('maxuses')))
         codes = DiscountCode.objects.annotate(num_uses=Count('registrations')).filter(filt)
+        manager = InvoiceManager()
+        renderer = InvoicePdfRenderer()
         for code in codes:
             # Either the code has expired, or it is fully used by now. Time to generate the invoice. We'll also
             # send an email to the sponsor (and the admins) to inform them of what's happening.
@@ -76,7 +78,6 @@ class Command(BaseCommand):
                         discountvalue = r.regtype.cost * code.discountpercentage / 100
                     invoicerows.append(['Attendee "{0}"'.format(r.fullname), 1, discountvalue, r.conference.vat_registrations])
                 # All invoices are always due immediately
-                manager = InvoiceManager()
                 code.invoice = manager.create_invoice(
                     code.sponsor_rep,
                     code.sponsor_rep.email,
@@ -89,6 +90,7 @@ class Command(BaseCommand):
                     accounting_account=settings.ACCOUNTING_CONFREG_ACCOUNT,
                     accounting_object=code.conference.accounting_object,
                     paymentmethods=code.conference.paymentmethods.all(),
+                    renderer=renderer,
                 )
                 code.invoice.save()
                 code.is_invoiced = True
@@ -18,6 +18,7 @@ from postgresqleu.util.decorators import global_login_exempt
 from postgresqleu.confreg.models import ConferenceRegistration
 from postgresqleu.confreg.util import send_conference_mail, get_conference_or_404, render_conference_response
 from postgresqleu.confreg.util import get_conference_scanner_permissions
+from postgresqleu.confreg.checkincache import get_registration_changes, get_sync_scans, get_token_hash
 
 from .views import _get_sponsor_and_admin, get_authenticated_conference
 from .models import SponsorScanner, ScannedAttendee
@@ -251,17 +252,21 @@ class SponsorScannerHandler:
         return 'Sponsor: {}'.format(self.scanner.sponsor.displayname)
 
 
+def _get_reg_json(reg, existingnote=''):
+    return {
+        'name': reg.fullname,
+        'company': reg.company,
+        'country': reg.country and reg.country.printable_name or '',
+        'email': reg.email,
+        'note': existingnote,
+        'token': reg.publictoken,
+        'highlight': [],
+    }
+
+
 def _json_response(reg, status, existingnote='', message=''):
     return HttpResponse(json.dumps({
-        'reg': {
-            'name': reg.fullname,
-            'company': reg.company,
-            'country': reg.country and reg.country.printable_name or '',
-            'email': reg.email,
-            'note': existingnote,
-            'token': reg.publictoken,
-            'highlight': [],
-        },
+        'reg': _get_reg_json(reg, existingnote),
         'message': message,
         'showfields': False,
     }), content_type='application/json', status=status)
@@ -377,6 +382,82 @@ def scanning_api(request, scannertoken, what):
                             ' The note has been updated.' if 'note' in update else '',
                         ),
                     )
+        elif what == 'roster':
+            # Hashes of the tokens of the attendees that can be scanned, so the app can
+            # validate badges while offline. Sponsors don't get any other details about
+            # the attendees until they have actually scanned them.
+            version, full, regs = get_registration_changes(sponsor.conference, request.GET.get('since', None))
+            tokens = []
+            removed = []
+            for token, badgescan, canceledat in regs.values_list('publictoken', 'badgescan', 'canceledat'):
+                if badgescan and not canceledat:
+                    tokens.append(get_token_hash(token))
+                elif not full:
+                    removed.append(get_token_hash(token))
+            return HttpResponse(json.dumps({
+                'version': version,
+                'full': full,
+                'tokens': tokens,
+                'removed': removed,
+            }), content_type='application/json')
+        elif request.method == 'POST' and what == 'sync':
+            # Store a batch of scans made by the app, possibly while it was offline, with
+            # the time they were made and optionally a note.
+            scans = get_sync_scans(request, sponsor.conference)
+            if isinstance(scans, HttpResponse):
+                return scans
+
+            results = []
+            with transaction.atomic():
+                for s in scans:
+                    if 'token' not in s:
+                        results.append({'id': s['id'], 'status': 404, 'message': 'Attendee not found'})
+                        continue
+
+                    m = _tokenmatcher.match(s['token'])
+                    token = m.group(1) if m else s['token']
+                    if 'rejected' in s:
+                        results.append({'token': token, 'status': 400, 'message': s['rejected']})
+                        continue
+
+                    r = _get_scanned_attendee(sponsor, token)
+                    if isinstance(r, HttpResponse):
+                        results.append({'token': token, 'status': r.status_code, 'message': r.content.decode()})
+                        continue
+
+                    note = str(s.get('note', ''))
+                    scan, created = ScannedAttendee.objects.get_or_create(sponsor=sponsor, scannedby=scanner.scanner, attendee=r, defaults={'note': note, 'firstscan': False})
+                    if created:
+                        # scannedat is set to the current time on create, so record the time
+                        # the scan was actually made separately.
+                        ScannedAttendee.objects.filter(pk=scan.pk).update(scannedat=s['at'])
+                        isfirst = True
+                        update = []
+                    else:
+                        isfirst = scan.firstscan
+                        update = []
+                        if 'note' in s and scan.note != note:
+                            scan.note = note
+                            update.append('note')
+                        if scan.firstscan:
+                            scan.firstscan = False
+                            update.append('firstscan')
+                        if update:
+                            scan.save(update_fields=update)
+
+                    results.append({
+                        'token': token,
+                        'status': 201 if isfirst else 208,
+                        'message': 'Attendee {} scan stored successfully.'.format(r.fullname) if isfirst else 'Attendee {} has already been stored.{}'.format(
+                            r.fullname,
+                            ' The note has been updated.' if 'note' in update else '',
+                        ),
+                        'reg': _get_reg_json(r, scan.note),
+                    })
+
+            return HttpResponse(json.dumps({
+                'results': results,
+            }), content_type='application/json')
         else:
             raise Http404()
     else:
@@ -56,7 +56,6 @@ class InvoiceAdminForm(ConcurrentProtectedModelForm):
 class InvoiceAdmin(admin.ModelAdmin):
     list_display = ('id', 'title', 'recipient_name', 'total_amount', 'ispaid')
     form = InvoiceAdminForm
-    exclude = ['pdf_invoice', 'pdf_receipt', ]
     filter_horizontal = ['allowedmethods', ]
     search_fields = ['title', 'id', ]
 
@@ -67,7 +66,6 @@ class InvoiceLogAdmin(admin.ModelAdmin):
 
 class InvoiceRefundAdmin(admin.ModelAdmin):
     list_display = ('registered', 'issued', 'completed', 'amount', 'vatamount', 'reason')
-    exclude = ['refund_pdf', ]
 
 
 class InvoicePaymentMethodAdmin(admin.ModelAdmin):
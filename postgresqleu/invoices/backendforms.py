@@ -1,7 +1,10 @@
 import django.forms
 
 from postgresqleu.util.backendforms import BackendForm, BackendBeforeNewForm
-from postgresqleu.util.widgets import TestButtonWidget
+from postgresqleu.util.widgets import TestButtonWidget, HtmlDateInput
+from postgresqleu.accounting.fyear import format_fy_label
+from postgresqleu.accounting.models import Year
+from postgresqleu.confreg.models import Conference
 from postgresqleu.invoices.models import Invoice
 from postgresqleu.invoices.models import VatRate, VatValidationCache, InvoicePaymentMethod
 
@@ -128,3 +131,30 @@ class BanktransactionMultiToOneForm(django.forms.Form):
             i.title,
             format_currency(i.total_amount),
         )
+
+
+class InvoiceExportForm(django.forms.Form):
+    invoices = django.forms.BooleanField(required=False, initial=True, label="Include invoices")
+    receipts = django.forms.BooleanField(required=False, initial=True, label="Include receipts")
+    format = django.forms.ChoiceField(choices=(('tar', 'tar.gz'), ('zip', 'zip')))
+    year = django.forms.ModelChoiceField(queryset=Year.objects.all().order_by('-year'), required=False, label="Financial year")
+    startdate = django.forms.DateField(widget=HtmlDateInput(), required=False, label="Start date")
+    enddate = django.forms.DateField(widget=HtmlDateInput(), required=False, label="End date")
+    conference = django.forms.ModelChoiceField(queryset=Conference.objects.all().order_by('-startdate'), required=False)
+    paymentmethod = django.forms.ModelChoiceField(queryset=InvoicePaymentMethod.objects.all().order_by('internaldescription'), required=False, label="Payment method",
+                                                  help_text="Payment method used to pay the invoices")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['year'].label_from_instance = lambda y: format_fy_label(y.year)
+        self.fields['paymentmethod'].label_from_instance = lambda m: m.internaldescription or m.name
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not (cleaned_data.get('invoices') or cleaned_data.get('receipts')):
+            self.add_error('invoices', 'Must include at least one of invoices and receipts')
+        if cleaned_data.get('year') and (cleaned_data.get('startdate') or cleaned_data.get('enddate')):
+            self.add_error('year', 'Specify either a financial year or a start and/or end date, not both')
+        if not any(cleaned_data.get(f) for f in ('year', 'startdate', 'enddate', 'conference', 'paymentmethod')):
+            self.add_error(None, 'Must specify at least one of financial year, dates, conference or payment method')
+        return cleaned_data
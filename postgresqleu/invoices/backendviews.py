@@ -1,5 +1,5 @@
 from django.core.exceptions import PermissionDenied
-from django.http import HttpResponseRedirect, Http404
+from django.http import HttpResponseRedirect, Http404, StreamingHttpResponse
 from django.utils.html import escape
 from django.shortcuts import get_object_or_404, render
 from django.contrib import messages
@@ -14,8 +14,9 @@ from postgresqleu.util.pagination import simple_pagination
 from postgresqleu.util.request import get_int_or_error
 from postgresqleu.util.db import exec_to_dict
 from postgresqleu.util.currency import format_currency
+from postgresqleu.util.tar import generate_streaming_tar, generate_streaming_zip
 from postgresqleu.accounting.util import create_accounting_entry, get_account_choices
-from postgresqleu.invoices.util import InvoiceManager
+from postgresqleu.invoices.util import InvoiceManager, get_invoice_export_generator
 
 from postgresqleu.accounting.models import Account
 from postgresqleu.invoices.models import InvoicePaymentMethod, Invoice, InvoiceLog
@@ -29,6 +30,7 @@ from postgresqleu.invoices.backendforms import BackendVatValidationCacheForm
 from postgresqleu.invoices.backendforms import BackendInvoicePaymentMethodForm
 from postgresqleu.invoices.backendforms import BankfilePaymentMethodChoiceForm
 from postgresqleu.invoices.backendforms import BanktransactionMultiToOneForm
+from postgresqleu.invoices.backendforms import InvoiceExportForm
 from postgresqleu.invoices.util import register_bank_transaction
 
 import re
@@ -692,6 +694,47 @@ def refunds(request):
     })
 
 
+def export(request):
+    authenticate_backend_group(request, 'Invoice managers')
+
+    if request.method == 'POST':
+        form = InvoiceExportForm(data=request.POST)
+        if form.is_valid():
+            year = form.cleaned_data['year']
+            generator = get_invoice_export_generator(
+                invoices=form.cleaned_data['invoices'],
+                receipts=form.cleaned_data['receipts'],
+                startdate=year.start_date if year else form.cleaned_data['startdate'],
+                enddate=year.end_date if year else form.cleaned_data['enddate'],
+                conference=form.cleaned_data['conference'],
+                paymentmethod=form.cleaned_data['paymentmethod'],
+            )
+            if form.cleaned_data['format'] == 'zip':
+                resp = StreamingHttpResponse(generate_streaming_zip(generator))
+                resp['Content-Type'] = 'application/zip'
+                resp['Content-Disposition'] = 'attachment; filename=invoices.zip'
+            else:
+                resp = StreamingHttpResponse(generate_streaming_tar(generator))
+                resp['Content-Type'] = 'application/tar+gzip'
+                resp['Content-Disposition'] = 'attachment; filename=invoices.tar.gz'
+            return resp
+    else:
+        form = InvoiceExportForm()
+
+    return render(request, 'confreg/admin_backend_form.html', {
+        'basetemplate': 'adm/admin_base.html',
+        'form': form,
+        'whatverb': 'Export',
+        'what': 'invoices',
+        'savebutton': 'Export',
+        'cancelurl': '/admin/',
+        'cancelname': 'Back',
+        'note': 'The PDFs of all finalized invoices matching all the specified filters are exported. Canceled invoices are not connected to a conference anymore, so they are not included when filtering on conference.',
+        'topadmin': 'Invoices',
+        'helplink': 'payment',
+    })
+
+
 def refundexposure(request):
     authenticate_backend_group(request, 'Invoice managers')
 
@@ -1,50 +1,96 @@
 #!/usr/bin/env python
 #
-# Export invoices to PDF files
+# Export invoices and/or receipts as PDF files in a tar or zip file
 #
 # Copyright (C) 2025, PostgreSQL Europe
 #
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-import base64
-import os
+from datetime import date
 import sys
 
-from postgresqleu.invoices.models import Invoice
+from postgresqleu.accounting.fyear import fy_start_date, fy_end_date
+from postgresqleu.confreg.models import Conference
+from postgresqleu.invoices.models import InvoicePaymentMethod
+from postgresqleu.invoices.util import get_invoice_export_generator
+from postgresqleu.util.tar import generate_streaming_tar, generate_streaming_zip
 
 
 class Command(BaseCommand):
-    help = 'Export invoices by id'
+    help = 'Export invoices to a tar or zip file'
 
     def add_arguments(self, parser):
         parser.add_argument('--invoice', action='store_true')
         parser.add_argument('--receipt', action='store_true')
-        parser.add_argument('directory')
-        parser.add_argument('idlist', nargs='+', type=int)
+        parser.add_argument('--format', choices=('tar', 'zip'), default='tar', help='Output format (tar is gzipped)')
+        parser.add_argument('--startdate', type=date.fromisoformat, help='First invoice date to include (YYYY-MM-DD)')
+        parser.add_argument('--enddate', type=date.fromisoformat, help='Last invoice date to include (YYYY-MM-DD)')
+        parser.add_argument('--fyear', type=int, help='Financial year to include')
+        parser.add_argument('--conference', help='Url name of conference to include')
+        parser.add_argument('--paymentmethod', type=int, help='Id of payment method used to pay invoices')
+        parser.add_argument('--id', type=int, nargs='+', dest='idlist', help='Ids of invoices to include')
+        parser.add_argument('output', help='File to write, or - for stdout')
 
     def handle(self, *args, **options):
-        if not os.path.isdir(options['directory']):
-            print('{} is not a directory.'.format(options['directory']))
-            sys.exit(1)
-
         if not (options['invoice'] or options['receipt']):
-            print("Must specify at least one of --invoice and --receipt")
-            sys.exit(1)
-
-        invoices = Invoice.objects.filter(id__in=options['idlist'])
-        if len(invoices) != len(options['idlist']):
-            # Missing some invoices!
-            print("Can't find invoices with ids {}".format(", ".join(
-                (str(i) for i in set(options['idlist']).difference(set([i.id for i in invoices])))
-            )))
-            sys.exit(1)
-
-        for i in invoices:
-            if options['invoice']:
-                with open(os.path.join(options['directory'], 'invoice_{}.pdf'.format(i.id)), 'wb') as f:
-                    f.write(base64.b64decode(i.pdf_invoice))
-            if options['receipt']:
-                with open(os.path.join(options['directory'], 'receipt_{}.pdf'.format(i.id)), 'wb') as f:
-                    f.write(base64.b64decode(i.pdf_receipt))
-
-        print("Exported {} invoices.".format(len(invoices)))
+            raise CommandError("Must specify at least one of --invoice and --receipt")
+
+        startdate = options['startdate']
+        enddate = options['enddate']
+        if options['fyear']:
+            if startdate or enddate:
+                raise CommandError("Can't specify both --fyear and --startdate/--enddate")
+            startdate = fy_start_date(options['fyear'])
+            enddate = fy_end_date(options['fyear'])
+
+        if options['conference']:
+            try:
+                conference = Conference.objects.get(urlname=options['conference'])
+            except Conference.DoesNotExist:
+                raise CommandError("Conference {} not found".format(options['conference']))
+        else:
+            conference = None
+
+        if options['paymentmethod']:
+            try:
+                paymentmethod = InvoicePaymentMethod.objects.get(pk=options['paymentmethod'])
+            except InvoicePaymentMethod.DoesNotExist:
+                raise CommandError("Payment method {} not found".format(options['paymentmethod']))
+        else:
+            paymentmethod = None
+
+        if not any((startdate, enddate, conference, paymentmethod, options['idlist'])):
+            raise CommandError("Must specify at least one filter")
+
+        generator = get_invoice_export_generator(
+            invoices=options['invoice'],
+            receipts=options['receipt'],
+            startdate=startdate,
+            enddate=enddate,
+            conference=conference,
+            paymentmethod=paymentmethod,
+            idlist=options['idlist'],
+        )
+
+        num = 0
+
+        def _counting_generator():
+            nonlocal num
+            for d in generator():
+                num += 1
+                yield d
+
+        if options['format'] == 'zip':
+            stream = generate_streaming_zip(_counting_generator)
+        else:
+            stream = generate_streaming_tar(_counting_generator)
+
+        if options['output'] == '-':
+            for chunk in stream:
+                sys.stdout.buffer.write(chunk)
+            sys.stdout.buffer.flush()
+        else:
+            with open(options['output'], 'wb') as f:
+                for chunk in stream:
+                    f.write(chunk)
+            self.stdout.write("Exported {} documents.".format(num))
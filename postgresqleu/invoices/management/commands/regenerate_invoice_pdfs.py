@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+#
+# Regenerate the PDFs of finalized invoices and/or receipts, for example
+# after changing the invoice template or logo.
+#
+# Copyright (C) 2025, PostgreSQL Europe
+#
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from postgresqleu.confreg.models import Conference
+from postgresqleu.invoices.models import Invoice
+from postgresqleu.invoices.util import InvoicePdfRenderer, get_filtered_invoice_ids
+
+# Number of invoices to regenerate in each transaction
+BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    help = 'Regenerate invoice and/or receipt PDFs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--invoice', action='store_true')
+        parser.add_argument('--receipt', action='store_true')
+        parser.add_argument('--conference', help='Url name of conference to regenerate invoices for')
+        parser.add_argument('--id', type=int, nargs='+', dest='idlist', help='Ids of invoices to regenerate')
+
+    def handle(self, *args, **options):
+        if not (options['invoice'] or options['receipt']):
+            raise CommandError("Must specify at least one of --invoice and --receipt")
+
+        if options['conference']:
+            try:
+                conference = Conference.objects.get(urlname=options['conference'])
+            except Conference.DoesNotExist:
+                raise CommandError("Conference {} not found".format(options['conference']))
+        elif options['idlist']:
+            conference = None
+        else:
+            raise CommandError("Must specify --conference and/or --id")
+
+        ids = get_filtered_invoice_ids(
+            conference=conference,
+            idlist=options['idlist'],
+        )
+
+        # Commit each batch as it's done, so a large run doesn't keep everything
+        # in a single transaction, and can be restarted if it fails halfway.
+        renderer = InvoicePdfRenderer()
+        if options['invoice']:
+            num = 0
+            for i in range(0, len(ids), BATCH_SIZE):
+                with transaction.atomic():
+                    for invoice, pdf in renderer.render_many(Invoice.objects.filter(id__in=ids[i:i + BATCH_SIZE]).order_by('id')):
+                        invoice.set_pdf_invoice(pdf)
+                        num += 1
+            self.stdout.write("Regenerated {} invoices.".format(num))
+
+        if options['receipt']:
+            num = 0
+            for i in range(0, len(ids), BATCH_SIZE):
+                with transaction.atomic():
+                    for invoice, pdf in renderer.render_many(Invoice.objects.filter(id__in=ids[i:i + BATCH_SIZE], paidat__isnull=False).order_by('id'), receipt=True):
+                        invoice.set_pdf_receipt(pdf)
+                        num += 1
+            self.stdout.write("Regenerated {} receipts.".format(num))
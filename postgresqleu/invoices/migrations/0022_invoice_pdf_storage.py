@@ -0,0 +1,93 @@
+from django.db import migrations
+
+# Move the invoice, receipt and refund note PDFs out of the invoice and refund
+# rows and into util_storage as raw bytes. With a lot of invoices this is a lot
+# of data, so it's copied in batches that are each committed, and it can be
+# restarted if interrupted.
+
+BATCH_SIZE = 1000
+
+DOCUMENTS = (
+    ('invoicepdf', 'invoices_invoice', 'pdf_invoice'),
+    ('invoicereceipt', 'invoices_invoice', 'pdf_receipt'),
+    ('refundpdf', 'invoices_invoicerefund', 'refund_pdf'),
+)
+
+
+def copy_to_storage(apps, schema_editor):
+    with schema_editor.connection.cursor() as curs:
+        for key, table, column in DOCUMENTS:
+            curs.execute("SELECT COALESCE(max(id), 0) FROM {}".format(table))
+            maxid = curs.fetchone()[0]
+            for start in range(0, maxid + 1, BATCH_SIZE):
+                curs.execute("""INSERT INTO util_storage (key, storageid, data, metadata)
+SELECT %(key)s, id, decode({column}, 'base64'), '{{}}' FROM {table}
+WHERE id >= %(start)s AND id < %(end)s AND {column} != ''
+ON CONFLICT (key, storageid) DO NOTHING""".format(table=table, column=column), {
+                    'key': key,
+                    'start': start,
+                    'end': start + BATCH_SIZE,
+                })
+
+
+def copy_from_storage(apps, schema_editor):
+    with schema_editor.connection.cursor() as curs:
+        for key, table, column in DOCUMENTS:
+            curs.execute("UPDATE {table} t SET {column}=translate(encode(s.data, 'base64'), E'\\n', '') FROM util_storage s WHERE s.key=%(key)s AND s.storageid=t.id".format(table=table, column=column), {
+                'key': key,
+            })
+            curs.execute("DELETE FROM util_storage WHERE key=%(key)s", {
+                'key': key,
+            })
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('invoices', '0021_alter_vatrate_vatpercent'),
+        ('util', '0008_storage_metadata'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_to_storage, copy_from_storage),
+        migrations.RemoveField(
+            model_name='invoice',
+            name='pdf_invoice',
+        ),
+        migrations.RemoveField(
+            model_name='invoice',
+            name='pdf_receipt',
+        ),
+        migrations.RemoveField(
+            model_name='invoicerefund',
+            name='refund_pdf',
+        ),
+        # Remove the documents when invoices (normally only ones that were never
+        # finalized) or refunds are deleted
+        migrations.RunSQL(
+            """
+CREATE FUNCTION invoices_delete_documents() RETURNS trigger AS $$
+BEGIN
+    DELETE FROM util_storage WHERE key = ANY(TG_ARGV) AND storageid=OLD.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+            """,
+            "DROP FUNCTION invoices_delete_documents()",
+        ),
+        migrations.RunSQL(
+            """
+CREATE TRIGGER invoices_invoice_documents_trigger
+AFTER DELETE ON invoices_invoice
+FOR EACH ROW EXECUTE FUNCTION invoices_delete_documents('invoicepdf', 'invoicereceipt');
+CREATE TRIGGER invoices_invoicerefund_documents_trigger
+AFTER DELETE ON invoices_invoicerefund
+FOR EACH ROW EXECUTE FUNCTION invoices_delete_documents('refundpdf');
+            """,
+            """
+DROP TRIGGER invoices_invoice_documents_trigger ON invoices_invoice;
+DROP TRIGGER invoices_invoicerefund_documents_trigger ON invoices_invoicerefund;
+            """,
+        ),
+    ]
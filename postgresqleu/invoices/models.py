@@ -7,15 +7,28 @@ from django.utils.safestring import mark_safe
 from django.utils import timezone
 
 from decimal import Decimal
+from io import BytesIO
 
 from .payment import PaymentMethodWrapper
 
 from postgresqleu.util.validators import ListOfEmailAddressValidator
 from postgresqleu.util.checksum import luhn
 from postgresqleu.util.fields import LowercaseEmailField, NormalizedDecimalField
+from postgresqleu.util.storage import InlineEncodedStorage
 from postgresqleu.accounting.models import Account, JournalEntry
 
 
+# The PDFs of invoices, receipts and refund notes are kept in util_storage, keyed
+# by the id of the invoice or refund, so they are only loaded when they are
+# actually used and not with every query for invoices.
+def _get_document(key, id):
+    return InlineEncodedStorage(key).read(id)[1]
+
+
+def _save_document(key, id, pdf):
+    InlineEncodedStorage(key).save(id, BytesIO(pdf))
+
+
 class InvoiceProcessor(models.Model):
     # The processor name is purely cosmetic
     processorname = models.CharField(max_length=50, null=False, blank=False, unique=True)
@@ -71,8 +84,6 @@ class InvoiceRefund(models.Model):
 
     payment_reference = models.CharField(max_length=100, null=False, blank=True, help_text="Reference in payment system, depending on system used for invoice.")
 
-    refund_pdf = models.TextField(blank=True, null=False)
-
     _safe_attributes = ('amount', 'vatamount', 'vatrate', 'registered', 'issued', 'completed', 'fullamount')
 
     class Meta:
@@ -82,6 +93,16 @@ class InvoiceRefund(models.Model):
     def fullamount(self):
         return self.amount + self.vatamount
 
+    @property
+    def has_refund_pdf(self):
+        return InlineEncodedStorage('refundpdf').get_tag(self.id) is not None
+
+    def get_refund_pdf(self):
+        return _get_document('refundpdf', self.id)
+
+    def set_refund_pdf(self, pdf):
+        _save_document('refundpdf', self.id, pdf)
+
 
 class Invoice(models.Model):
     # pk = invoice number, which is fully exposed.
@@ -114,9 +135,6 @@ class Invoice(models.Model):
     deleted = models.BooleanField(null=False, blank=False, default=False, help_text="This invoice has been deleted")
     deletion_reason = models.CharField(max_length=500, null=False, blank=True, default='', help_text="Reason for deletion of invoice")
 
-    # base64 encoded version of the PDF invoice
-    pdf_invoice = models.TextField(blank=True, null=False)
-
     # Which class, if any, is responsible for processing the payment
     # of this invoice. This can typically be to flag a conference
     # payment as done once the payment is in. processorid is an arbitrary
@@ -136,9 +154,6 @@ class Invoice(models.Model):
     # Reminder (if any) sent when?
     remindersent = models.DateTimeField(null=True, blank=True, verbose_name="Automatic reminder sent at")
 
-    # Once an invoice is paid, a recipient is generated. PDF base64
-    pdf_receipt = models.TextField(blank=True, null=False)
-
     # Information for accounting of this invoice. This is intentionally not
     # foreign keys - we'll just drop some such information into the system
     # manually in the forms.
@@ -153,6 +168,20 @@ class Invoice(models.Model):
     def ispaid(self):
         return self.paidat is not None
 
+    # The PDF invoice is generated when the invoice is finalized, and once the invoice
+    # is paid, a receipt is generated as well.
+    def get_pdf_invoice(self):
+        return _get_document('invoicepdf', self.id)
+
+    def set_pdf_invoice(self, pdf):
+        _save_document('invoicepdf', self.id, pdf)
+
+    def get_pdf_receipt(self):
+        return _get_document('invoicereceipt', self.id)
+
+    def set_pdf_receipt(self, pdf):
+        _save_document('invoicereceipt', self.id, pdf)
+
     @property
     def isexpired(self):
         return (self.paidat is None) and self.duedate and (self.duedate < timezone.now())
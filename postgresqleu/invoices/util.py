@@ -1,20 +1,21 @@
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Sum, Prefetch
 from django.db.models.functions import Coalesce
 from django.conf import settings
 from django.utils import timezone
 
 from collections import defaultdict
+from datetime import datetime, time, timedelta
 from dateutil import rrule
 from decimal import Decimal
 import importlib
-import base64
 import re
 import io
 
 from postgresqleu.mailqueue.util import send_template_mail, send_simple_mail
 from postgresqleu.accounting.util import create_accounting_entry
 from postgresqleu.util.currency import format_currency
+from postgresqleu.util.db import exec_to_dict_iter, exec_to_single_list
 from postgresqleu.util.random import generate_random_token
 
 from .models import Invoice, InvoiceRow, InvoiceHistory, InvoiceLog
@@ -50,11 +51,82 @@ class InvoicePresentationWrapper(object):
         return [PaymentMethodWrapper(m, self.__invoice, self.__returnurl) for m in self.allowedmethods.filter(active=True)]
 
 
+# Renders the PDFs of invoices and receipts. Everything that is the same for all
+# invoices, like the PDF builder and the payment methods, is only looked up once
+# per renderer, so when rendering many invoices, use the same renderer for all of
+# them. Fonts and logos are loaded once per process by the builder itself.
+class InvoicePdfRenderer(object):
+    def __init__(self):
+        (modname, classname) = settings.INVOICE_PDF_BUILDER.rsplit('.', 1)
+        self.builder = getattr(importlib.import_module(modname), classname)
+        self._methods = {}
+
+    # Get the bank info to include on the invoice, if any payment method allowed
+    # for it provides it. If more than one supports it then the one with the
+    # highest priority (=lowest sortkey) will be used.
+    def _get_bankinfo(self, invoice):
+        for pm in invoice.allowedmethods.all():
+            if pm.active and pm.config and 'bankinfo' in pm.config and len(pm.config['bankinfo']) > 1:
+                if pm.id not in self._methods:
+                    self._methods[pm.id] = pm.get_implementation()
+                m = self._methods[pm.id]
+                if not (hasattr(m, 'available') and not m.available(invoice)):
+                    return pm.config['bankinfo']
+        return None
+
+    def render(self, invoice, preview=False, receipt=False):
+        if invoice.recipient_secret:
+            paymentlink = '{0}/invoices/{1}/{2}/'.format(settings.SITEBASE, invoice.pk, invoice.recipient_secret)
+        else:
+            paymentlink = None
+
+        pdfinvoice = self.builder(invoice.title,
+                                  "%s\n%s" % (invoice.recipient_name, invoice.recipient_address),
+                                  invoice.invoicedate,
+                                  receipt and invoice.paidat or invoice.duedate,
+                                  invoice.pk,
+                                  preview=preview,
+                                  receipt=receipt,
+                                  # Bank info is never included on receipts
+                                  bankinfo=None if receipt else self._get_bankinfo(invoice),
+                                  paymentref=invoice.payment_reference,
+                                  totalvat=invoice.total_vat,
+                                  reverse_vat=invoice.reverse_vat,
+                                  paymentlink=paymentlink,
+                                  )
+
+        # Order of rows is important - so preserve whatever order they were created
+        # in. This is also the order that they get rendered by automatically by
+        # djangos inline forms, so it should be consistent with whatever is shown
+        # on the website.
+        for r in sorted(invoice.invoicerow_set.all(), key=lambda r: r.id):
+            pdfinvoice.addrow(r.rowtext, r.rowamount, r.rowcount, r.vatrate)
+
+        return pdfinvoice.save().getvalue()
+
+    # Render the invoices (or receipts) in a queryset, returning a generator of
+    # (invoice, pdf). The payment methods and rows of the invoices are fetched
+    # along with them instead of separately for each invoice.
+    def render_many(self, invoices, receipt=False):
+        for invoice in invoices.prefetch_related(
+                'allowedmethods',
+                Prefetch('invoicerow_set', queryset=InvoiceRow.objects.select_related('vatrate')),
+        ):
+            yield (invoice, self.render(invoice, receipt=receipt))
+
+
 # Functionality wrapper around an invoice that allows actions
 # to be performed on it, such as creating PDFs.
 class InvoiceWrapper(object):
-    def __init__(self, invoice):
+    def __init__(self, invoice, renderer=None):
         self.invoice = invoice
+        self._renderer = renderer
+
+    @property
+    def renderer(self):
+        if not self._renderer:
+            self._renderer = InvoicePdfRenderer()
+        return self._renderer
 
     @property
     def invoiceurl(self):
@@ -93,7 +165,7 @@ class InvoiceWrapper(object):
         self.invoice.recipient_secret = generate_random_token()
 
         # Generate pdf
-        self.invoice.pdf_invoice = base64.b64encode(self.render_pdf_invoice()).decode('ascii')
+        self.invoice.set_pdf_invoice(self.render_pdf_invoice())
 
         # Indicate that we're finalized
         self.invoice.finalized = True
@@ -103,53 +175,10 @@ class InvoiceWrapper(object):
         InvoiceHistory(invoice=self.invoice, txt='Finalized').save()
 
     def render_pdf_invoice(self, preview=False):
-        return self._render_pdf(preview=preview, receipt=False)
+        return self.renderer.render(self.invoice, preview=preview)
 
     def render_pdf_receipt(self):
-        return self._render_pdf(receipt=True)
-
-    def _render_pdf(self, preview=False, receipt=False):
-        (modname, classname) = settings.INVOICE_PDF_BUILDER.rsplit('.', 1)
-        PDFInvoice = getattr(importlib.import_module(modname), classname)
-        if self.invoice.recipient_secret:
-            paymentlink = '{0}/invoices/{1}/{2}/'.format(settings.SITEBASE, self.invoice.pk, self.invoice.recipient_secret)
-        else:
-            paymentlink = None
-
-        # Include bank info on the invoice if any payment method chosen
-        # provides it. If more than one supports it then the one with
-        # the highest priority (=lowest sortkey) will be used.
-        for pm in self.invoice.allowedmethods.filter(active=True):
-            if pm.config and 'bankinfo' in pm.config and len(pm.config['bankinfo']) > 1:
-                m = pm.get_implementation()
-                if not (hasattr(m, 'available') and not m.available(self.invoice)):
-                    bankinfo = pm.config['bankinfo']
-                    break
-        else:
-            bankinfo = None
-
-        pdfinvoice = PDFInvoice(self.invoice.title,
-                                "%s\n%s" % (self.invoice.recipient_name, self.invoice.recipient_address),
-                                self.invoice.invoicedate,
-                                receipt and self.invoice.paidat or self.invoice.duedate,
-                                self.invoice.pk,
-                                preview=preview,
-                                receipt=receipt,
-                                bankinfo=bankinfo,
-                                paymentref=self.invoice.payment_reference,
-                                totalvat=self.invoice.total_vat,
-                                reverse_vat=self.invoice.reverse_vat,
-                                paymentlink=paymentlink,
-                            )
-
-        # Order of rows is important - so preserve whatever order they were created
-        # in. This is also the order that they get rendered by automatically by
-        # djangos inline forms, so it should be consistent with whatever is shown
-        # on the website.
-        for r in self.invoice.invoicerow_set.all().order_by('id'):
-            pdfinvoice.addrow(r.rowtext, r.rowamount, r.rowcount, r.vatrate)
-
-        return pdfinvoice.save().getvalue()
+        return self.renderer.render(self.invoice, receipt=True)
 
     def render_pdf_refund(self, refund):
         (modname, classname) = settings.REFUND_PDF_BUILDER.rsplit('.', 1)
@@ -180,35 +209,38 @@ class InvoiceWrapper(object):
 
     def email_receipt(self):
         # If no receipt exists yet, we have to bail too
-        if not self.invoice.pdf_receipt:
+        pdf = self.invoice.get_pdf_receipt()
+        if not pdf:
             return
 
         self._email_something('paid_receipt.txt',
                               'Receipt for %s #%s' % (settings.INVOICE_TITLE_PREFIX, self.invoice.id),
                               '%s_receipt_%s.pdf' % (settings.INVOICE_FILENAME_PREFIX, self.invoice.id),
-                              self.invoice.pdf_receipt,
+                              pdf,
                               bcc=(self.invoice.processor is None))
         InvoiceHistory(invoice=self.invoice, txt='Sent receipt').save()
 
     def email_invoice(self):
-        if not self.invoice.pdf_invoice:
+        pdf = self.invoice.get_pdf_invoice()
+        if not pdf:
             return
 
         self._email_something('invoice.txt',
                               '%s #%s' % (settings.INVOICE_TITLE_PREFIX, self.invoice.id),
                               '%s_invoice_%s.pdf' % (settings.INVOICE_FILENAME_PREFIX, self.invoice.id),
-                              self.invoice.pdf_invoice,
+                              pdf,
                               bcc=True)
         InvoiceHistory(invoice=self.invoice, txt='Sent invoice to %s' % self.invoice.recipient_email).save()
 
     def email_reminder(self):
-        if not self.invoice.pdf_invoice:
+        pdf = self.invoice.get_pdf_invoice()
+        if not pdf:
             return
 
         self._email_something('invoice_reminder.txt',
                               '%s #%s - reminder' % (settings.INVOICE_TITLE_PREFIX, self.invoice.id),
                               '%s_invoice_%s.pdf' % (settings.INVOICE_FILENAME_PREFIX, self.invoice.id),
-                              self.invoice.pdf_invoice,
+                              pdf,
                               bcc=True)
         InvoiceHistory(invoice=self.invoice, txt='Sent reminder to %s' % self.invoice.recipient_email).save()
 
@@ -230,13 +262,13 @@ class InvoiceWrapper(object):
 
     def email_refund_sent(self, refund):
         # Generate the refund notice so we have something to send
-        refund.refund_pdf = base64.b64encode(self.render_pdf_refund(refund)).decode('ascii')
-        refund.save()
+        pdf = self.render_pdf_refund(refund)
+        refund.set_refund_pdf(pdf)
 
         self._email_something('invoice_refund.txt',
                               '%s #%s - refunded' % (settings.INVOICE_TITLE_PREFIX, self.invoice.id),
                               '{0}_refund_{1}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, self.invoice.id),
-                              refund.refund_pdf,
+                              pdf,
                               bcc=True,
                               extracontext={'refund': refund}
         )
@@ -260,7 +292,7 @@ class InvoiceWrapper(object):
 
         pdfdata = []
         if pdfname:
-            pdfdata = [(pdfname, 'application/pdf', base64.b64decode(pdfcontents)), ]
+            pdfdata = [(pdfname, 'application/pdf', pdfcontents), ]
 
         if bcc:
             bcclist = [settings.INVOICE_NOTIFICATION_RECEIVER, ]
@@ -390,7 +422,7 @@ class InvoiceManager(object):
 
         # Generate a PDF receipt for this, since it's now paid
         wrapper = InvoiceWrapper(invoice)
-        invoice.pdf_receipt = base64.b64encode(wrapper.render_pdf_receipt()).decode('ascii')
+        invoice.set_pdf_receipt(wrapper.render_pdf_receipt())
 
         # Save and we're done!
         invoice.save()
@@ -683,6 +715,7 @@ if available).
                        reverse_vat=False,
                        extra_bcc_list=None,
                        extradescription='',
+                       renderer=None,
                        ):
         invoice = Invoice(
             recipient_email=recipient_email,
@@ -720,8 +753,9 @@ if available).
         invoice.save()
 
         # That should be it. Finalize so we get a PDF, and then
-        # return whatever we have.
-        wrapper = InvoiceWrapper(invoice)
+        # return whatever we have. When creating many invoices, the
+        # caller can pass a renderer to use for all of them.
+        wrapper = InvoiceWrapper(invoice, renderer)
         wrapper.finalizeInvoice()
         return invoice
 
@@ -804,6 +838,75 @@ def diff_workdays(start, end):
     return weekdays
 
 
+# Number of documents fetched from the database at a time when exporting
+INVOICE_EXPORT_FETCH_SIZE = 20
+
+
+# Get the SQL conditions, on invoices_invoice aliased as i, and their parameters for
+# matching the finalized invoices that match all the given filters. The dates are
+# inclusive, and the conference filter matches the invoices still connected to
+# registrations, bulk payments, sponsors etc of the conference.
+def _get_invoice_filter(startdate=None, enddate=None, conference=None, paymentmethod=None, idlist=None):
+    where = ["i.finalized"]
+    params = {}
+    if startdate:
+        where.append("i.invoicedate >= %(startdate)s")
+        params['startdate'] = timezone.make_aware(datetime.combine(startdate, time.min))
+    if enddate:
+        where.append("i.invoicedate < %(enddate)s")
+        params['enddate'] = timezone.make_aware(datetime.combine(enddate + timedelta(days=1), time.min))
+    if conference:
+        where.append("""i.id IN (
+ SELECT invoice_id FROM confreg_conferenceregistration WHERE conference_id=%(confid)s
+ UNION ALL SELECT invoice_id FROM confreg_bulkpayment WHERE conference_id=%(confid)s
+ UNION ALL SELECT invoice_id FROM confreg_registrationtransferpending WHERE conference_id=%(confid)s
+ UNION ALL SELECT o.invoice_id FROM confreg_pendingadditionalorder o INNER JOIN confreg_conferenceregistration r ON r.id=o.reg_id WHERE r.conference_id=%(confid)s
+ UNION ALL SELECT invoice_id FROM confsponsor_sponsor WHERE conference_id=%(confid)s
+ UNION ALL SELECT invoice_id FROM confsponsor_purchasedvoucher WHERE conference_id=%(confid)s
+)""")
+        params['confid'] = conference.id
+    if paymentmethod:
+        where.append("i.paidusing_id=%(methodid)s")
+        params['methodid'] = paymentmethod.id
+    if idlist:
+        where.append("i.id=ANY(%(idlist)s)")
+        params['idlist'] = list(idlist)
+    return " AND ".join(where), params
+
+
+# Get the ids of the finalized invoices that match all the given filters (see
+# _get_invoice_filter), in order.
+def get_filtered_invoice_ids(**filters):
+    where, params = _get_invoice_filter(**filters)
+    return exec_to_single_list("SELECT i.id FROM invoices_invoice i WHERE {} ORDER BY i.id".format(where), params)
+
+
+# Get a generator of the invoice and/or receipt PDFs of the finalized invoices that
+# match all the given filters (see _get_invoice_filter), in the format used by
+# generate_streaming_tar() and generate_streaming_zip(). The documents are read
+# through a server-side cursor, so only a few of them are held in memory at a
+# time no matter how many match.
+def get_invoice_export_generator(invoices=True, receipts=True, **filters):
+    where, params = _get_invoice_filter(**filters)
+    params['keys'] = [k for k, include in (('invoicepdf', invoices), ('invoicereceipt', receipts)) if include]
+
+    def _generate():
+        for d in exec_to_dict_iter("""SELECT i.id, s.key, s.data, length(s.data) AS datalen,
+ EXTRACT(epoch FROM CASE WHEN s.key='invoicereceipt' THEN COALESCE(i.paidat, i.invoicedate) ELSE i.invoicedate END) AS mtime
+FROM invoices_invoice i
+INNER JOIN util_storage s ON s.storageid=i.id AND s.key=ANY(%(keys)s)
+WHERE {}
+ORDER BY i.id, s.key""".format(where), params, itersize=INVOICE_EXPORT_FETCH_SIZE):
+            yield (
+                '{}_{}.pdf'.format('invoice' if d['key'] == 'invoicepdf' else 'receipt', d['id']),
+                d['mtime'],
+                d['data'],
+                d['datalen'],
+            )
+
+    return _generate
+
+
 def is_managed_bank_account(account):
     # All managed bank account methods have to specify a field for
     # "account" that is the one that they manage. So figure out if
@@ -1,14 +1,13 @@
 from django.shortcuts import render, get_object_or_404
 from django.forms.models import inlineformset_factory
 from django.forms import ModelMultipleChoiceField
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, Http404
 from django.contrib.auth.decorators import login_required
 from django.db import transaction
 from django.db.models import Q, Count, Max
 from django.contrib import messages
 from django.conf import settings
 
-import base64
 import io
 from datetime import timedelta
 from decimal import Decimal
@@ -402,6 +401,14 @@ def viewinvoice_secret(request, invoiceid, invoicesecret):
     })
 
 
+def _pdf_response(pdf, what, invoiceid):
+    if pdf is None:
+        raise Http404("PDF not found")
+    r = HttpResponse(pdf, content_type='application/pdf')
+    r['Content-disposition'] = 'filename={}_{}_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, what, invoiceid)
+    return r
+
+
 @login_required
 def viewinvoicepdf(request, invoiceid):
     invoice = get_object_or_404(Invoice, pk=invoiceid)
@@ -409,18 +416,12 @@ def viewinvoicepdf(request, invoiceid):
         # End users can only view their own invoices, but invoice managers can view all
         authenticate_backend_group(request, 'Invoice managers')
 
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_invoice_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(invoice.pdf_invoice))
-    return r
+    return _pdf_response(invoice.get_pdf_invoice(), 'invoice', invoice.id)
 
 
 def viewinvoicepdf_secret(request, invoiceid, invoicesecret):
     invoice = get_object_or_404(Invoice, pk=invoiceid, recipient_secret=invoicesecret)
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_invoice_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(invoice.pdf_invoice))
-    return r
+    return _pdf_response(invoice.get_pdf_invoice(), 'invoice', invoice.id)
 
 
 @login_required
@@ -430,18 +431,12 @@ def viewreceipt(request, invoiceid):
         # End users can only view their own invoices, but invoice managers can view all
         authenticate_backend_group(request, 'Invoice managers')
 
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_receipt_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(invoice.pdf_receipt))
-    return r
+    return _pdf_response(invoice.get_pdf_receipt(), 'receipt', invoice.id)
 
 
 def viewreceipt_secret(request, invoiceid, invoicesecret):
     invoice = get_object_or_404(Invoice, pk=invoiceid, recipient_secret=invoicesecret)
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_receipt_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(invoice.pdf_receipt))
-    return r
+    return _pdf_response(invoice.get_pdf_receipt(), 'receipt', invoice.id)
 
 
 @login_required
@@ -453,19 +448,13 @@ def viewrefundnote(request, invoiceid, refundid):
 
     refund = get_object_or_404(InvoiceRefund, invoice=invoiceid, pk=refundid)
 
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_refund_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(refund.refund_pdf))
-    return r
+    return _pdf_response(refund.get_refund_pdf(), 'refund', invoice.id)
 
 
 def viewrefundnote_secret(request, invoiceid, invoicesecret, refundid):
     invoice = get_object_or_404(Invoice, pk=invoiceid, recipient_secret=invoicesecret)
     refund = get_object_or_404(InvoiceRefund, invoice=invoice, pk=refundid)
-    r = HttpResponse(content_type='application/pdf')
-    r['Content-disposition'] = 'filename={}_refund_{}.pdf'.format(settings.INVOICE_FILENAME_PREFIX, invoice.id)
-    r.write(base64.b64decode(refund.refund_pdf))
-    return r
+    return _pdf_response(refund.get_refund_pdf(), 'refund', invoice.id)
 
 
 @login_required
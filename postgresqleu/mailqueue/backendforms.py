@@ -23,6 +23,7 @@ class BackendMailqueueAttachmentManager:
 class BackendMailqueueForm(BackendForm):
     decoded = forms.CharField(label="Decoded message", widget=StaticTextWidget(monospace=True))
     htmldecoded = forms.CharField(label="HTML message", widget=StaticHtmlPreviewWidget())
+    fullmsg = forms.CharField(label="Full message", widget=forms.Textarea)
 
     list_fields = ['sendtime', 'regtime', 'sendtime', 'sender', 'receiver', 'subject', ]
     helplink = 'mail'
@@ -33,11 +34,12 @@ class BackendMailqueueForm(BackendForm):
 
     class Meta:
         model = QueuedMail
-        fields = ['sender', 'receiver', 'sendtime', 'subject', 'fullmsg', ]
+        fields = ['sender', 'receiver', 'sendtime', 'subject', ]
 
     def fix_fields(self):
         self.initial['decoded'] = self.parsed_content()
         self.initial['htmldecoded'] = self.parsed_html()
+        self.initial['fullmsg'] = self.instance.fullmsg
 
     # Replacing the cid images using a regexp is kind of ugly, but it does work...
     def _ensure_parsed(self):
@@ -0,0 +1,71 @@
+#
+# Daemon to send queued email as soon as it is committed
+#
+# Listens for notifications from the mail queue and delivers mail
+# immediately. Mail that is scheduled for later delivery is sent once
+# its sendtime is reached.
+#
+# This can be run instead of, or in parallel with, the send_queued_mail
+# cronjob.
+#
+
+from django.db import connection
+from django.db.models import Min
+from django.utils import timezone
+
+import select
+import sys
+
+from postgresqleu.util.reload import ReloadCommand
+from postgresqleu.mailqueue.models import QueuedMail
+from postgresqleu.mailqueue.sender import SMTPConnectionPool, send_pending_mail
+
+
+class Command(ReloadCommand):
+    help = 'Daemon to send queued mail'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Number of parallel delivery workers')
+
+    def handle_with_reload(self, args, options):
+        with connection.cursor() as curs:
+            curs.execute("LISTEN pgeu_mailqueue")
+            curs.execute("SET application_name = 'pgeu mail sender'")
+
+        pool = SMTPConnectionPool(options['workers'])
+
+        while True:
+            # Eat any notifications before we start sending, since anything
+            # that's in the queue at this point will be picked up below.
+            self.eat_notifications()
+
+            try:
+                numsent, elapsed = send_pending_mail(pool, options['workers'])
+                if numsent:
+                    print("Sent {} messages in {:.2f} seconds".format(numsent, elapsed))
+                sleeptime = self.seconds_until_next_mail()
+            except Exception as e:
+                # Most likely the local MTA is not available, so wait a minute
+                # and then try again.
+                sys.stderr.write("Failed to send queued mail: {}\n".format(e))
+                sleeptime = 60
+
+            # Don't hold on to SMTP connections while we're idle
+            pool.close()
+
+            # Sleep until the next mail is due or a new one is queued, but wake
+            # up to check at least every 5 minutes, just in case.
+            select.select([connection.connection], [], [], sleeptime)
+
+    def seconds_until_next_mail(self):
+        nexttime = QueuedMail.objects.aggregate(n=Min('sendtime'))['n']
+        if nexttime is None:
+            return 5 * 60
+        # Never sleep less than a second, to make sure we don't end up in a
+        # tight loop if the mail is already being delivered by somebody else.
+        return min(max((nexttime - timezone.now()).total_seconds(), 1), 5 * 60)
+
+    def eat_notifications(self):
+        connection.connection.poll()
+        while connection.connection.notifies:
+            connection.connection.notifies.pop()
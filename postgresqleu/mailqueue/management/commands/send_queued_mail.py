@@ -2,36 +2,37 @@
 #
 # This script is intended to be run frequently from cron. We queue things
 # up in the db so that they get automatically rolled back as necessary,
-# but once we reach this point we're just going to send all of them one
-# by one.
+# but once we reach this point we're just going to send all of them,
+# in batches over a set of reused SMTP connections.
 #
-from django.core.management.base import BaseCommand, CommandError
-from django.db import connection
-from django.conf import settings
-from django.utils import timezone
-
-import smtplib
+# Multiple workers (or multiple concurrent runs of this script) split
+# the queue between them using row locks, so there is no need to
+# interlock against ourselves.
+#
+from django.core.management.base import BaseCommand
 
-from postgresqleu.mailqueue.models import QueuedMail
+from postgresqleu.mailqueue.sender import SMTPConnectionPool, send_pending_mail, delete_unused_mail_bodies
 
 
 class Command(BaseCommand):
     help = 'Send queued mail'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1, help='Number of parallel delivery workers')
+        parser.add_argument('--batchsize', type=int, default=100, help='Number of messages to deliver per batch')
+
     def handle(self, *args, **options):
-        # Grab advisory lock, if available. Lock id is just a random number
-        # since we only need to interlock against ourselves. The lock is
-        # automatically released when we're done.
-        curs = connection.cursor()
-        curs.execute("SELECT pg_try_advisory_lock(72181378)")
-        if not curs.fetchall()[0][0]:
-            raise CommandError("Failed to get advisory lock, existing send_queued_mail process stuck?")
+        with SMTPConnectionPool(options['workers']) as pool:
+            numsent, elapsed = send_pending_mail(pool, options['workers'], options['batchsize'])
+
+        # Clean up any message bodies left behind by earlier runs
+        delete_unused_mail_bodies()
 
-        for m in QueuedMail.objects.filter(sendtime__lte=timezone.now()):
-            # Yes, we do a new connection for each run. Just because we can.
-            # If it fails we'll throw an exception and just come back on the
-            # next cron job. And local delivery should never fail...
-            smtp = smtplib.SMTP(getattr(settings, "SMTPSERVER", "localhost"))
-            smtp.sendmail(m.sender, m.receiver, m.fullmsg.encode('utf-8'))
-            smtp.close()
-            m.delete()
+        # Only generate output when asked for, since this normally runs from
+        # cron which will send an email for any output.
+        if numsent and options['verbosity'] > 1:
+            self.stdout.write("Sent {} messages in {:.2f} seconds ({:.1f} messages/sec)".format(
+                numsent,
+                elapsed,
+                numsent / elapsed if elapsed else numsent,
+            ))
@@ -0,0 +1,51 @@
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mailqueue', '0003_queuedmail_regtime'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedMailBody',
+            fields=[
+                ('hash', models.CharField(max_length=64, primary_key=True, serialize=False)),
+                ('fullmsg', models.TextField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='queuedmail',
+            name='headers',
+            field=models.TextField(blank=True, default=''),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='queuedmail',
+            name='body',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.PROTECT, to='mailqueue.queuedmailbody'),
+        ),
+        # Existing messages have all their headers in the body
+        migrations.RunSQL(
+            """
+INSERT INTO mailqueue_queuedmailbody (hash, fullmsg)
+SELECT DISTINCT encode(sha256(convert_to(fullmsg, 'UTF8')), 'hex'), fullmsg FROM mailqueue_queuedmail
+ON CONFLICT (hash) DO NOTHING;
+UPDATE mailqueue_queuedmail SET body_id=encode(sha256(convert_to(fullmsg, 'UTF8')), 'hex');
+            """,
+            """
+UPDATE mailqueue_queuedmail q SET fullmsg=q.headers || b.fullmsg FROM mailqueue_queuedmailbody b WHERE b.hash=q.body_id
+            """,
+        ),
+        migrations.AlterField(
+            model_name='queuedmail',
+            name='body',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, to='mailqueue.queuedmailbody'),
+        ),
+        migrations.RemoveField(
+            model_name='queuedmail',
+            name='fullmsg',
+        ),
+    ]
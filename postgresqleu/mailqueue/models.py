@@ -2,12 +2,24 @@ from django.db import models
 from django.utils import timezone
 
 
+class QueuedMailBody(models.Model):
+    # The raw MIME message, minus the per-recipient headers. Stored by the
+    # hash of its contents, so the same message sent to multiple recipients
+    # (bcc or bulk) is only stored once, attachments and all.
+    hash = models.CharField(max_length=64, null=False, blank=False, primary_key=True)
+    fullmsg = models.TextField(null=False, blank=False)
+
+    def __str__(self):
+        return self.hash
+
+
 class QueuedMail(models.Model):
     sender = models.EmailField(max_length=100, null=False, blank=False)
     receiver = models.EmailField(max_length=100, null=False, blank=False)
-    # We store the raw MIME message, so if there are any attachments or
-    # anything, we just push them right in there!
-    fullmsg = models.TextField(null=False, blank=False)
+    # Headers that are specific to this recipient, which are prepended
+    # to the shared message body when the mail is sent.
+    headers = models.TextField(null=False, blank=True)
+    body = models.ForeignKey(QueuedMailBody, null=False, blank=False, on_delete=models.PROTECT)
     sendtime = models.DateTimeField(null=False, blank=False, default=timezone.now)
     regtime = models.DateTimeField(null=False, blank=False, auto_now_add=True)
     subject = models.CharField(max_length=500, null=False, blank=False)
@@ -15,5 +27,9 @@ class QueuedMail(models.Model):
     def __str__(self):
         return "%s: %s -> %s" % (self.pk, self.sender, self.receiver)
 
+    @property
+    def fullmsg(self):
+        return self.headers + self.body.fullmsg
+
     class Meta:
         ordering = ('sendtime', )
@@ -0,0 +1,198 @@
+# Mail delivery functionality lives in a separate module so it can be
+# used both from the send_queued_mail command and from anything else
+# that wants to push out the queue.
+from django.conf import settings
+from django.db import connection, transaction, DatabaseError
+from django.utils import timezone
+
+import queue
+import smtplib
+import sys
+import threading
+import time
+
+from postgresqleu.util.db import exec_no_result
+from postgresqleu.mailqueue.models import QueuedMail
+
+
+class _PooledSMTPConnection:
+    def __init__(self, server, maxmessages):
+        self.server = server
+        self.maxmessages = maxmessages
+        self.smtp = None
+        self.sentcount = 0
+
+    def _connect(self):
+        self.smtp = smtplib.SMTP(self.server)
+        self.sentcount = 0
+
+    def close(self):
+        if self.smtp:
+            try:
+                self.smtp.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self.smtp = None
+
+    def sendmail(self, sender, receiver, msg):
+        # Some MTAs limit how many messages can be delivered over a single
+        # connection, so cycle it once we've hit our own limit.
+        if self.smtp and self.sentcount >= self.maxmessages:
+            self.close()
+
+        if not self.smtp:
+            self._connect()
+            self.smtp.sendmail(sender, receiver, msg)
+        else:
+            try:
+                self.smtp.sendmail(sender, receiver, msg)
+            except (smtplib.SMTPServerDisconnected, ConnectionError):
+                # The connection we had open went away while idle, so
+                # reconnect and try again. If that fails as well, the
+                # exception is passed up to the caller.
+                self.smtp = None
+                self._connect()
+                self.smtp.sendmail(sender, receiver, msg)
+        self.sentcount += 1
+
+
+class SMTPConnectionPool:
+    """
+    A pool of SMTP connections to the local MTA, so that many messages can be
+    delivered over each connection rather than reconnecting for every message.
+    Connections are opened lazily and reconnected as needed.
+    """
+    def __init__(self, size=1, maxmessages=500):
+        self.server = getattr(settings, "SMTPSERVER", "localhost")
+        self.maxmessages = maxmessages
+        self._conns = [_PooledSMTPConnection(self.server, maxmessages) for i in range(size)]
+        self._pool = queue.LifoQueue()
+        for c in self._conns:
+            self._pool.put(c)
+
+    def get(self):
+        return self._pool.get()
+
+    def put(self, conn):
+        self._pool.put(conn)
+
+    def close(self):
+        # Close all open connections. The pool itself remains usable, and
+        # will reconnect when needed.
+        for c in self._conns:
+            c.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def delete_unused_mail_bodies(hashes=None):
+    # Remove message bodies that are no longer referenced by any queued mail.
+    # Bodies that are locked are being reused by somebody queueing a new mail
+    # right now, so leave those alone.
+    with transaction.atomic():
+        exec_no_result("""DELETE FROM mailqueue_queuedmailbody WHERE hash IN (
+ SELECT hash FROM mailqueue_queuedmailbody b
+ WHERE ({}) AND NOT EXISTS (SELECT 1 FROM mailqueue_queuedmail q WHERE q.body_id=b.hash)
+ FOR UPDATE SKIP LOCKED
+)""".format(hashes is None and 'true' or 'hash=ANY(%(hashes)s)'), {
+            'hashes': hashes,
+        })
+
+
+def _send_mail_batch(smtp, batchsize):
+    # Grab a batch of mails that are due, skipping any that are currently
+    # being delivered by another worker (or another process entirely).
+    error = None
+    sent = []
+    with transaction.atomic():
+        mails = list(QueuedMail.objects.select_for_update(skip_locked=True, of=('self', )).
+                     select_related('body').
+                     only('sender', 'receiver', 'headers', 'body__fullmsg').
+                     filter(sendtime__lte=timezone.now()).
+                     order_by('sendtime', 'id')[:batchsize])
+        for m in mails:
+            try:
+                smtp.sendmail(m.sender, m.receiver, m.fullmsg.encode('utf-8'))
+            except Exception as e:
+                # Stop processing this batch, but make sure whatever was delivered
+                # so far gets removed from the queue before we give up.
+                error = e
+                break
+            sent.append(m)
+
+        if sent:
+            QueuedMail.objects.filter(id__in=[m.id for m in sent]).delete()
+
+    if sent:
+        # This is done in a separate transaction, so a failure can never cause
+        # mails that have already been delivered to be rolled back into the queue.
+        # Anything left behind will be removed by a later run.
+        try:
+            delete_unused_mail_bodies(list(set(m.body_id for m in sent)))
+        except DatabaseError as e:
+            sys.stderr.write("Failed to remove unused mail bodies: {}\n".format(e))
+
+    if error:
+        raise error
+    return len(sent), len(mails) == batchsize
+
+
+def _send_mail_worker(pool, batchsize, result):
+    smtp = pool.get()
+    try:
+        while True:
+            n, more = _send_mail_batch(smtp, batchsize)
+            result['sent'] += n
+            if not more:
+                break
+    except Exception as e:
+        result['error'] = e
+    finally:
+        pool.put(smtp)
+
+
+def _send_mail_thread(pool, batchsize, result):
+    try:
+        _send_mail_worker(pool, batchsize, result)
+    finally:
+        # Each thread gets its own database connection, so make sure it's
+        # closed when the thread is done.
+        connection.close()
+
+
+def send_pending_mail(pool, workers=1, batchsize=100):
+    """
+    Deliver all mail that is currently due, using up to workers parallel
+    workers each pulling batches of up to batchsize messages off the queue.
+
+    Returns a tuple of the number of messages sent and the time it took.
+    If any worker failed, the first exception is re-raised once all workers
+    have finished.
+    """
+    starttime = time.time()
+    results = [{'sent': 0, 'error': None} for i in range(workers)]
+
+    if workers == 1:
+        # Single worker runs in our own thread and on our own connection
+        _send_mail_worker(pool, batchsize, results[0])
+    else:
+        threads = [threading.Thread(target=_send_mail_thread, args=(pool, batchsize, r)) for r in results]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    numsent = sum(r['sent'] for r in results)
+    elapsed = time.time() - starttime
+
+    for r in results:
+        if r['error']:
+            raise r['error']
+
+    return numsent, elapsed
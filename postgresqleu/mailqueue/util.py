@@ -6,10 +6,14 @@ from email.header import Header
 from email import encoders, charset
 from email.parser import Parser
 import email.policy
+import hashlib
 import re
 
+from psycopg2.extras import execute_values
+
 from postgresqleu.util.context_processors import settings_context
-from postgresqleu.confreg.jinjafunc import render_jinja_template, render_jinja_conference_mail
+from postgresqleu.util.db import exec_no_result, get_native_cursor
+from postgresqleu.confreg.jinjafunc import render_jinja_template, render_jinja_conference_mail, JinjaConferenceMailRenderer
 
 from django.utils import timezone
 
@@ -30,6 +34,53 @@ def send_template_mail(sender, receiver, subject, templatename, templateattr={},
     )
 
 
+# Send the same jinja template to many recipients. The templates are only loaded
+# once, and the mails are written to the queue in batches. Recipients is an iterable
+# of (receiver, receivername, templateattr), which can be a generator so that not all
+# recipients have to be held in memory at once. Returns the number of mails queued.
+def send_template_mail_bulk(sender, subject, templatename, recipients, sendername=None, suppress_auto_replies=True, sendat=None, conference=None, batchsize=500):
+    renderer = JinjaConferenceMailRenderer(conference, templatename)
+    bodies = {}
+    mails = []
+    num = 0
+
+    def _flush():
+        # The same body can occur more than once, but is only stored once since
+        # they are collected by hash.
+        _store_mail_bodies(bodies)
+        QueuedMail.objects.bulk_create(mails)
+        bodies.clear()
+        mails.clear()
+
+    for receiver, receivername, templateattr in recipients:
+        (plain, html, htmlattachments) = renderer.render(templateattr, subject)
+        headers, fullmsg = _build_mail(
+            sender, receiver, subject,
+            plain.lstrip(), None, htmlattachments, sendername, receivername,
+            suppress_auto_replies, False, sendat, html.lstrip(),
+        )
+        bodyhash = hashlib.sha256(fullmsg.encode('utf8')).hexdigest()
+        bodies[bodyhash] = fullmsg
+        mails.append(QueuedMail(
+            sender=sender,
+            receiver=receiver,
+            subject=subject,
+            headers=headers,
+            body_id=bodyhash,
+            sendtime=sendat or timezone.now(),
+        ))
+        num += 1
+        if len(mails) >= batchsize:
+            _flush()
+
+    if mails:
+        _flush()
+
+    if num:
+        exec_no_result('NOTIFY pgeu_mailqueue')
+    return num
+
+
 def _encoded_email_header(name, email):
     if name:
         return formataddr((str(Header(name, 'utf-8')), email))
@@ -59,7 +110,53 @@ def _add_attachments(attachments, msg, isinline):
         msg.attach(part)
 
 
-def _internal_send_mail(sender, receiver, subject, msgtxt, attachments=None, htmlattachments=None, bcc=None, sendername=None, receivername=None, suppress_auto_replies=True, is_auto_reply=False, sendat=None, htmlbody=None):
+def _store_mail_bodies(bodies):
+    # Store the message bodies (a dict of hash -> body) that are not already
+    # there. Those that are get locked instead, so they can't be removed from
+    # under us by the sender cleaning up unused bodies. If one is removed between
+    # the insert and the lock, it's just inserted again.
+    curs = get_native_cursor()
+    missing = dict(bodies)
+    while missing:
+        inserted = execute_values(
+            curs,
+            "INSERT INTO mailqueue_queuedmailbody (hash, fullmsg) VALUES %s ON CONFLICT (hash) DO NOTHING RETURNING hash",
+            list(missing.items()),
+            fetch=True,
+        )
+        existing = set(missing) - set(r[0] for r in inserted)
+        if not existing:
+            break
+        curs.execute(
+            "SELECT hash FROM mailqueue_queuedmailbody WHERE hash=ANY(%(hashes)s) FOR KEY SHARE",
+            {
+                'hashes': list(existing),
+            }
+        )
+        missing = {h: missing[h] for h in existing - set(r[0] for r in curs.fetchall())}
+
+
+def _store_mail_body(fullmsg):
+    bodyhash = hashlib.sha256(fullmsg.encode('utf8')).hexdigest()
+    _store_mail_bodies({bodyhash: fullmsg})
+    return bodyhash
+
+
+def _set_boundaries(part):
+    # The default MIME boundaries are random, which would give every copy of the
+    # same mail a different hash. Derive them from the contents of the part
+    # instead, which also guarantees they don't occur in it.
+    if part.is_multipart():
+        h = hashlib.sha256()
+        for p in part.get_payload():
+            _set_boundaries(p)
+            h.update(p.as_string().encode('utf8'))
+        part.set_boundary('==============={}=='.format(h.hexdigest()[:40]))
+
+
+# Build the MIME message, returning the headers specific to the recipient and the
+# rest of the message separately.
+def _build_mail(sender, receiver, subject, msgtxt, attachments, htmlattachments, sendername, receivername, suppress_auto_replies, is_auto_reply, sendat, htmlbody):
     # attachment format, each is a tuple of (name, mimetype,contents)
     # content should be *binary* and not base64 encoded, since we need to
     # use the base64 routines from the email library to get a properly
@@ -87,12 +184,7 @@ def _internal_send_mail(sender, receiver, subject, msgtxt, attachments=None, htm
         msg = mpart
 
     msg['Subject'] = subject
-    msg['To'] = _encoded_email_header(receivername, receiver)
     msg['From'] = _encoded_email_header(sendername, sender)
-    if sendat is None:
-        msg['Date'] = formatdate(localtime=True)
-    else:
-        msg['Date'] = format_datetime(sendat)
     if suppress_auto_replies:
         # Do our best to set some headers to indicate that auto-replies like out of office
         # messages should not be sent to this email.
@@ -102,14 +194,24 @@ def _internal_send_mail(sender, receiver, subject, msgtxt, attachments=None, htm
         else:
             msg['Auto-Submitted'] = 'auto-generated'
 
-    # Just write it to the queue, so it will be transactionally rolled back
-    QueuedMail(
-        sender=sender,
-        receiver=receiver,
-        subject=subject,
-        fullmsg=msg.as_string(),
-        sendtime=sendat or timezone.now(),
-    ).save()
+    # The To and Date headers are stored with each queued mail, and the rest
+    # of the message is stored only once regardless of how many recipients
+    # it is sent to.
+    headers = msg.policy.fold('To', _encoded_email_header(receivername, receiver))
+    if sendat is None:
+        headers += msg.policy.fold('Date', formatdate(localtime=True))
+    else:
+        headers += msg.policy.fold('Date', format_datetime(sendat))
+    _set_boundaries(msg)
+    return headers, msg.as_string()
+
+
+def _internal_send_mail(sender, receiver, subject, msgtxt, attachments=None, htmlattachments=None, bcc=None, sendername=None, receivername=None, suppress_auto_replies=True, is_auto_reply=False, sendat=None, htmlbody=None):
+    headers, fullmsg = _build_mail(
+        sender, receiver, subject, msgtxt, attachments, htmlattachments, sendername, receivername,
+        suppress_auto_replies, is_auto_reply, sendat, htmlbody,
+    )
+    bodyhash = _store_mail_body(fullmsg)
 
     # Any bcc is just entered as a separate email
     if bcc:
@@ -117,15 +219,25 @@ def _internal_send_mail(sender, receiver, subject, msgtxt, attachments=None, htm
             bcc = set(bcc)
         else:
             bcc = set((bcc, ))
+    else:
+        bcc = set()
+
+    # Just write it to the queue, so it will be transactionally rolled back
+    QueuedMail.objects.bulk_create([
+        QueuedMail(
+            sender=sender,
+            receiver=r,
+            subject=subject,
+            headers=headers,
+            body_id=bodyhash,
+            sendtime=sendat or timezone.now(),
+        ) for r in [receiver] + list(bcc)
+    ])
 
-        for b in bcc:
-            QueuedMail(
-                sender=sender,
-                receiver=b,
-                subject=subject,
-                fullmsg=msg.as_string(),
-                sendtime=sendat or timezone.now(),
-            ).save()
+    # Wake up the mail sender daemon, if one is running. The notification
+    # is only delivered once our transaction commits, so the mail will be
+    # visible by the time it gets there.
+    exec_no_result('NOTIFY pgeu_mailqueue')
 
 
 def parse_mail_content(fullmsg):
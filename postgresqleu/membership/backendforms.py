@@ -43,6 +43,7 @@ class MemberLogManager(object):
 class BackendMemberForm(BackendForm):
     helplink = 'membership'
     list_fields = ['fullname', 'user', 'paiduntil']
+    list_server_side = True
     queryset_select_related = ['user', ]
     defaultsort = [['paiduntil', 'desc'], ['fullname', 'asc']]
     allow_email = True
@@ -9,7 +9,6 @@
 #
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.utils import timezone
 
 from datetime import datetime, timedelta
@@ -19,6 +18,7 @@ from decimal import Decimal
 from postgresqleu.paypal.models import TransactionInfo
 from postgresqleu.paypal.util import PaypalAPI
 from postgresqleu.invoices.models import InvoicePaymentMethod
+from postgresqleu.util.payment.sync import fetch_for_methods, sync_provider_transactions
 
 
 class Command(BaseCommand):
@@ -27,50 +27,53 @@ class Command(BaseCommand):
     class ScheduledJob:
         scheduled_interval = timedelta(minutes=30)
         trigger_next_jobs = 'postgresqleu.paypal.paypal_match'
+        concurrency_group = 'paypal'
 
         @classmethod
         def should_run(self):
             return InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal').exists()
 
-    @transaction.atomic
     def handle(self, *args, **options):
-        synctime = timezone.now()
+        self.synctime = timezone.now()
 
-        # There may be multiple accounts, so loop over them
-        for method in InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal'):
-            try:
-                lastsync = method.status['lastsync']
-                if isinstance(lastsync, str):
-                    lastsync = dateutil.parser.parse(lastsync)
-                # Always go back one day to cover for the very slow async update of the
-                # Paypal sync api.
-                lastsync -= timedelta(days=1)
-            except KeyError:
-                # Status not set yet, so just assumed we synced a month ago (silly, I know..)
-                lastsync = timezone.now() - timedelta(days=31)
+        # There may be multiple accounts, so fetch from all of them at once, and then
+        # store the new transactions one account at a time. Matching of them is done
+        # by paypal_match.
+        methods = InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal')
+        fetch_for_methods(methods, self.fetch_transactions, self.store_transactions)
 
-            api = PaypalAPI(method.get_implementation())
+    def fetch_transactions(self, method):
+        try:
+            lastsync = method.status['lastsync']
+            if isinstance(lastsync, str):
+                lastsync = dateutil.parser.parse(lastsync)
+            # Always go back one day to cover for the very slow async update of the
+            # Paypal sync api.
+            lastsync -= timedelta(days=1)
+        except KeyError:
+            # Status not set yet, so just assumed we synced a month ago (silly, I know..)
+            lastsync = timezone.now() - timedelta(days=31)
 
-            # Fetch all transactions from last sync, with a 3 day overlap
-            for r in api.get_transaction_list(lastsync - timedelta(days=3)):
-                if TransactionInfo.objects.filter(paypaltransid=r['TRANSACTIONID']).exists():
-                    continue
+        api = PaypalAPI(method.get_implementation())
 
-                t = TransactionInfo(paypaltransid=r['TRANSACTIONID'])
-                t.timestamp = datetime.strptime(r['TIMESTAMP'], '%Y-%m-%dT%H:%M:%S%z')
-                t.amount = Decimal(r['AMT'])
-                if 'FEEAMT' in r:
-                    t.fee = -Decimal(r['FEEAMT'])
-                else:
-                    t.fee = 0
-                t.sender = r['EMAIL']
-                t.sendername = r['NAME']
-                t.transtext = r['SUBJECT']
-                t.matched = False
-                t.paymentmethod = method
+        # Fetch all transactions from last sync, with a 3 day overlap
+        return list(api.get_transaction_list(lastsync - timedelta(days=3)))
 
-                t.save()
+    def store_transactions(self, method, transactions):
+        sync_provider_transactions(method, TransactionInfo, 'paypaltransid',
+                                   transactions,
+                                   self._transaction_fields,
+                                   per_method=False,
+                                   synctime=self.synctime)
 
-            # Update the sync timestamp
-            method.status['lastsync'] = synctime
-            method.save()
+    def _transaction_fields(self, r):
+        return {
+            'paypaltransid': r['TRANSACTIONID'],
+            'timestamp': datetime.strptime(r['TIMESTAMP'], '%Y-%m-%dT%H:%M:%S%z'),
+            'amount': Decimal(r['AMT']),
+            'fee': -Decimal(r['FEEAMT']) if 'FEEAMT' in r else 0,
+            'sender': r['EMAIL'],
+            'sendername': r['NAME'],
+            'transtext': r['SUBJECT'],
+            'matched': False,
+        }
@@ -29,6 +29,7 @@ class Command(BaseCommand):
     class ScheduledJob:
         # This job gets scheduled to run after paypal_fetch only.
         internal = True
+        concurrency_group = 'paypal'
 
         @classmethod
         def should_run(self):
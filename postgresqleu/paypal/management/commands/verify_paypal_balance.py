@@ -8,7 +8,6 @@
 
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.conf import settings
 
 from datetime import time
@@ -17,6 +16,7 @@ from postgresqleu.invoices.models import InvoicePaymentMethod
 from postgresqleu.paypal.util import PaypalAPI
 from postgresqleu.accounting.util import get_latest_account_balance
 from postgresqleu.mailqueue.util import send_simple_mail
+from postgresqleu.util.payment.sync import fetch_for_methods
 
 
 class Command(BaseCommand):
@@ -24,28 +24,28 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_times = [time(3, 4), ]
+        concurrency_group = 'paypal'
 
         @classmethod
         def should_run(self):
             return InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal').exists()
 
-    @transaction.atomic
     def handle(self, *args, **options):
-        for method in InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal'):
-            pm = method.get_implementation()
+        # Get the balance of all accounts at once, and then compare them one by one.
+        # We only ever care about the primary currency.
+        methods = InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.paypal.Paypal')
+        fetch_for_methods(methods, lambda m: PaypalAPI(m.get_implementation()).get_primary_balance(), self.verify_one_account)
 
-            api = PaypalAPI(pm)
+    def verify_one_account(self, method, paypal_balance):
+        pm = method.get_implementation()
 
-            # We only ever care about the primary currency
-            paypal_balance = api.get_primary_balance()
+        accounting_balance = get_latest_account_balance(pm.config('accounting_income'))
 
-            accounting_balance = get_latest_account_balance(pm.config('accounting_income'))
-
-            if accounting_balance != paypal_balance:
-                send_simple_mail(settings.INVOICE_SENDER_EMAIL,
-                                 pm.config('report_receiver'),
-                                 'Paypal balance mismatch!',
-                                 """Paypal balance ({0}) does not match the accounting system ({1}) for payment method {2}!
+        if accounting_balance != paypal_balance:
+            send_simple_mail(settings.INVOICE_SENDER_EMAIL,
+                             pm.config('report_receiver'),
+                             'Paypal balance mismatch!',
+                             """Paypal balance ({0}) does not match the accounting system ({1}) for payment method {2}!
 
     This could be because some entry has been missed in the accouting
     (automatic or manual), or because of an ongoing booking of something
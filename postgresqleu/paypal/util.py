@@ -16,6 +16,7 @@ class PaypalAPI(object):
     def __init__(self, pm):
         self.token = None
         self.pm = pm
+        self.session = requests.session()
         if pm.config('sandbox'):
             self.REST_ENDPOINT = 'https://api.sandbox.paypal.com/'
         else:
@@ -23,7 +24,7 @@ class PaypalAPI(object):
 
     def ensure_access_token(self):
         if not self.token:
-            r = requests.post(
+            r = self.session.post(
                 '{0}v1/oauth2/token'.format(self.REST_ENDPOINT),
                 headers=self.BASE_HEADERS,
                 data={
@@ -44,18 +45,18 @@ class PaypalAPI(object):
         return h
 
     def _rest_api_call(self, suburl, params):
-        return requests.get('{0}{1}'.format(self.REST_ENDPOINT, suburl),
-                            params=params,
-                            headers=self._authorized_headers(),
+        return self.session.get('{0}{1}'.format(self.REST_ENDPOINT, suburl),
+                                params=params,
+                                headers=self._authorized_headers(),
         )
 
     def _rest_api_post(self, suburl, json):
         self.ensure_access_token()
         h = self.BASE_HEADERS.copy()
         h['Authorization'] = 'Bearer ' + self.token
-        return requests.post('{0}{1}'.format(self.REST_ENDPOINT, suburl),
-                             json=json,
-                             headers=self._authorized_headers(),
+        return self.session.post('{0}{1}'.format(self.REST_ENDPOINT, suburl),
+                                 json=json,
+                                 headers=self._authorized_headers(),
         )
 
     def _dateformat(self, d):
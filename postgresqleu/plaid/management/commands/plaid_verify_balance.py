@@ -4,13 +4,13 @@
 #
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.db.models import Sum
 from django.conf import settings
 
 from postgresqleu.invoices.models import InvoicePaymentMethod, PendingBankTransaction
 from postgresqleu.accounting.util import get_latest_account_balance
 from postgresqleu.mailqueue.util import send_simple_mail
+from postgresqleu.util.payment.sync import fetch_for_methods
 
 import datetime
 from decimal import Decimal
@@ -21,20 +21,19 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_times = [datetime.time(3, 25), ]
+        concurrency_group = 'plaid'
 
         @classmethod
         def should_run(self):
             return InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.plaid.Plaid', config__verify_balances=True).exists()
 
-    @transaction.atomic
     def handle(self, *args, **options):
-        for method in InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.plaid.Plaid', config__verify_balances=True):
-            self.handle_method(method)
+        methods = InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.plaid.Plaid', config__verify_balances=True)
+        fetch_for_methods(methods, lambda m: m.get_implementation().get_account_balances(), self.handle_method)
 
-    def handle_method(self, method):
+    def handle_method(self, method, balances):
         impl = method.get_implementation()
 
-        balances = impl.get_account_balances()
         if len(balances) != 1:
             raise Exception("Expected one account, got {}".format(len(balances)))
         plaid_balance = balances[0]['balance']
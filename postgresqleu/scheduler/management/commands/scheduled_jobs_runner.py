@@ -5,25 +5,65 @@
 # crash on database loss for example, so should be run from an init
 # handler that automaticaly restarts (after some delay)
 #
+# Up to SCHEDULED_JOBS_CONCURRENCY jobs are run at the same time, each
+# in its own thread. External jobs are run in a separate process from
+# that thread, internal ones directly in it. Jobs that should never
+# run at the same time as each other (for example because they work
+# on the same provider) can specify the same concurrency_group, and
+# a job never runs concurrently with itself.
+#
 
 from django.core.management import load_command_class
-from django.db import connection
+from django.db import connection, connections
 from django.utils import timezone
 from django.conf import settings
 
 from datetime import timedelta
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import time
 import io
 import sys
 import os
 import subprocess
 import select
+import threading
 import traceback
 
 from postgresqleu.util.reload import ReloadCommand
 from postgresqleu.mailqueue.util import send_simple_mail
 from postgresqleu.scheduler.util import reschedule_job
 from postgresqleu.scheduler.models import ScheduledJob, JobHistory, get_config
+from postgresqleu.scheduler.zygote import start_zygote, check_output_forked
+
+
+# Like subprocess.check_output() with stderr included in the output, but
+# also adds the CPU time and peak memory usage of the process to the usage
+# dict. This requires collecting the process ourselves, using wait4().
+def check_output_with_usage(args, timeout, usage):
+    with subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
+        timedout = threading.Event()
+
+        def _kill():
+            timedout.set()
+            p.kill()
+
+        timer = threading.Timer(timeout, _kill)
+        timer.start()
+        try:
+            output = p.stdout.read()
+            (pid, status, ru) = os.wait4(p.pid, 0)
+        finally:
+            timer.cancel()
+        p.returncode = os.waitstatus_to_exitcode(status)
+
+    if timedout.is_set():
+        raise subprocess.TimeoutExpired(args, timeout)
+
+    usage['cputime'] = ru.ru_utime + ru.ru_stime
+    usage['maxrss'] = ru.ru_maxrss
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, args, output=output)
+    return output
 
 
 class Command(ReloadCommand):
@@ -38,6 +78,9 @@ class Command(ReloadCommand):
             os._exit(1)
 
     def inner_handle(self):
+        if settings.SCHEDULED_JOBS_FORKSERVER:
+            start_zygote()
+
         with connection.cursor() as curs:
             curs.execute("LISTEN pgeu_scheduled_job")
             curs.execute("SET application_name = 'pgeu scheduled job runner'")
@@ -78,80 +121,148 @@ class Command(ReloadCommand):
             connection.connection.notifies.pop()
 
     def run_pending_jobs(self):
-        while True:
-            jobs = ScheduledJob.objects.filter(nextrun__lte=timezone.now(), enabled=True)
-            if not jobs:
-                # Nothing left to do!
-                return
-
-            for job in jobs:
-                # Start by finding the command class itself
-                try:
-                    cmd = load_command_class(job.app, job.command)
-                    if hasattr(cmd.ScheduledJob, 'should_run'):
-                        # If method should_run exists, call it and figure out if the job should
-                        # run. If we get an excpetion in this check, we make sure to run the job,
-                        # to be on the safe side.
-                        try:
-                            if not cmd.ScheduledJob.should_run():
-                                self.stderr.write("Skipping job {}".format(job.description))
-                                job.lastskip = timezone.now()
-                                reschedule_job(job, save=True)
-                                continue
-                        except Exception as e:
-                            sys.stderr.write("Exception when trying to figure out if '{0}' should run:\n{1}\n\nJob will be run.\n".format(job.description, e))
+        # Jobs currently running, as future -> (job id, concurrency group)
+        running = {}
 
-                    self.stderr.write("Running job {}".format(job.description))
-                    # Now figure out what type of job it is, and run it
-                    job.lastrunsuccess = self.run_job(job, cmd)
-                    job.lastrun = timezone.now()
-                    job.lastskip = None
-                    reschedule_job(job, save=True)
-
-                    # A job can define one or more other jobs to schedule immediately
-                    # after this job has completed.
-                    if hasattr(cmd.ScheduledJob, 'trigger_next_jobs'):
-                        if isinstance(cmd.ScheduledJob.trigger_next_jobs, str):
-                            nextjobs = [cmd.ScheduledJob.trigger_next_jobs, ]
-                        elif isinstance(cmd.ScheduledJob.trigger_next_jobs, list) or isinstance(cmd.ScheduledJob.trigger_next_jobs, tuple):
-                            nextjobs = cmd.ScheduledJob.trigger_next_jobs
-                        else:
-                            raise Exception("trigger_next_jobs must be string or iterable!")
-
-                        for j in nextjobs:
+        with ThreadPoolExecutor(max_workers=settings.SCHEDULED_JOBS_CONCURRENCY) as pool:
+            while True:
+                runningids = set(j for j, g in running.values())
+                runninggroups = set(g for j, g in running.values())
+                # Jobs that are due, but waiting for a free worker or for a job
+                # in the same group to finish
+                waiting = set()
+
+                for job in ScheduledJob.objects.filter(nextrun__lte=timezone.now(), enabled=True).exclude(pk__in=runningids).order_by('nextrun'):
+                    if len(running) >= settings.SCHEDULED_JOBS_CONCURRENCY:
+                        # All workers are busy
+                        waiting.add(job.id)
+                        continue
+
+                    # Start by finding the command class itself
+                    try:
+                        cmd = load_command_class(job.app, job.command)
+                        group = getattr(cmd.ScheduledJob, 'concurrency_group', job.command)
+                        if group in runninggroups:
+                            # Another job in the same group is running, so this one will
+                            # have to wait for it to finish.
+                            waiting.add(job.id)
+                            continue
+
+                        if hasattr(cmd.ScheduledJob, 'should_run'):
+                            # If method should_run exists, call it and figure out if the job should
+                            # run. If we get an excpetion in this check, we make sure to run the job,
+                            # to be on the safe side.
                             try:
-                                pieces = j.split('.')
-                                sj = ScheduledJob.objects.get(app='.'.join(pieces[:-1]),
-                                                              command=pieces[-1])
-                                sj.nextrun = timezone.now()
-                                sj.save()
-                            except ScheduledJob.DoesNotExist:
-                                self.stderr.write("Could not find job {} to run after {}".format(j, job.description))
-                                # But it's not critical, so we don't bother notifying
-
-                except Exception as e:
-                    # Hard exception at the top level will cause us to disbale
-                    # the job.
-                    job.lastrun = timezone.now()
-                    job.lastrunsuccess = False
-                    job.enabled = False
-                    job.nextrun = None
-                    job.save()
-                    JobHistory(job=job,
-                               time=timezone.now(),
-                               success=False,
-                               runtime=timedelta(),
-                               output="Internal exception:\n{0}\n\nJob has been disabled".format(e),
-                    ).save()
-                    self.send_notification_email("Exception running scheduled job",
-                                                 "Job has been disbaled.\nException:\n{0}\n".format(e))
+                                if not cmd.ScheduledJob.should_run():
+                                    self.stderr.write("Skipping job {}".format(job.description))
+                                    job.lastskip = timezone.now()
+                                    reschedule_job(job, save=True)
+                                    continue
+                            except Exception as e:
+                                sys.stderr.write("Exception when trying to figure out if '{0}' should run:\n{1}\n\nJob will be run.\n".format(job.description, e))
+                    except Exception as e:
+                        self.disable_job(job, e)
+                        continue
+
+                    if get_config().hold_all_jobs:
+                        # Jobs were put on hold while we were running others, so don't
+                        # start any more. The ones running are left to complete.
+                        self.stderr.write("All jobs are being held, not starting any more")
+                        break
+
+                    self.stderr.write("Running job {}".format(job.description))
+                    running[pool.submit(self.run_job_in_thread, job, cmd)] = (job.id, group)
+                    runninggroups.add(group)
+
+                if not running:
+                    # Nothing left to do!
+                    return
+
+                # Wait for a job to finish, but also wake up to start any other job that
+                # becomes due in the meantime. Jobs that are already waiting can't start
+                # until a job has finished anyway.
+                excluded = waiting.union(j for j, g in running.values())
+                done, notdone = wait(running.keys(), timeout=self.seconds_until_next_job(excluded), return_when=FIRST_COMPLETED)
+                for f in done:
+                    del running[f]
+                    # Exceptions are handled in the thread, so this should never happen, but if
+                    # it does we let it crash the runner rather than silently lose it.
+                    f.result()
+
+    def seconds_until_next_job(self, excluded):
+        # Never sleep for more than a minute while jobs are running, so jobs that are
+        # rescheduled from the web interface are picked up reasonably quickly.
+        nextjob = ScheduledJob.objects.only('nextrun').filter(enabled=True, nextrun__isnull=False).exclude(pk__in=excluded).order_by('nextrun').first()
+        if not nextjob:
+            return 60
+        return min(60, max(1, (nextjob.nextrun - timezone.now()).total_seconds() + 1))
+
+    def run_job_in_thread(self, job, cmd):
+        # The time the job was scheduled for when it started. If it's changed while the
+        # job is running, for example because another job triggered it, that time is
+        # kept instead of the one calculated when it completes.
+        startnextrun = job.nextrun
+        try:
+            # Now figure out what type of job it is, and run it
+            job.lastrunsuccess = self.run_job(job, cmd)
+            job.lastrun = timezone.now()
+            job.lastskip = None
+            job.save(update_fields=['lastrun', 'lastrunsuccess', 'lastskip'])
+            reschedule_job(job, save=False)
+            ScheduledJob.objects.filter(pk=job.pk, nextrun=startnextrun).update(nextrun=job.nextrun)
+
+            # A job can define one or more other jobs to schedule immediately
+            # after this job has completed.
+            if hasattr(cmd.ScheduledJob, 'trigger_next_jobs'):
+                if isinstance(cmd.ScheduledJob.trigger_next_jobs, str):
+                    nextjobs = [cmd.ScheduledJob.trigger_next_jobs, ]
+                elif isinstance(cmd.ScheduledJob.trigger_next_jobs, list) or isinstance(cmd.ScheduledJob.trigger_next_jobs, tuple):
+                    nextjobs = cmd.ScheduledJob.trigger_next_jobs
+                else:
+                    raise Exception("trigger_next_jobs must be string or iterable!")
+
+                for j in nextjobs:
+                    # Only update the time, since the job may be running right now in which
+                    # case it will be run again once it's completed.
+                    pieces = j.split('.')
+                    if not ScheduledJob.objects.filter(app='.'.join(pieces[:-1]),
+                                                       command=pieces[-1]).update(nextrun=timezone.now()):
+                        self.stderr.write("Could not find job {} to run after {}".format(j, job.description))
+                        # But it's not critical, so we don't bother notifying
+        except Exception as e:
+            self.disable_job(job, e)
+        finally:
+            # Each thread gets its own database connection, which must not
+            # be left around when the thread is reused or goes away.
+            connections.close_all()
+
+    def disable_job(self, job, e):
+        # Hard exception at the top level will cause us to disbale
+        # the job.
+        job.lastrun = timezone.now()
+        job.lastrunsuccess = False
+        job.enabled = False
+        job.nextrun = None
+        job.save()
+        JobHistory(job=job,
+                   time=timezone.now(),
+                   success=False,
+                   runtime=timedelta(),
+                   output="Internal exception:\n{0}\n\nJob has been disabled".format(e),
+        ).save()
+        self.send_notification_email("Exception running scheduled job",
+                                     "Job has been disbaled.\nException:\n{0}\n".format(e))
 
     def run_job(self, job, cmd):
         starttime = time.time()
+        # Time between when the job was scheduled to run and when it actually started
+        queuedelay = max(timezone.now() - job.nextrun, timedelta()) if job.nextrun else None
+        # Resource usage, as far as it can be tracked for this type of job
+        usage = {}
         if getattr(cmd.ScheduledJob, 'internal', False):
-            (output, success) = self.run_internal_job(job, cmd)
+            (output, success) = self.run_internal_job(job, cmd, usage)
         else:
-            (output, success) = self.run_external_job(job, cmd)
+            (output, success) = self.run_external_job(job, cmd, usage)
 
         # Create a job history record. The caller will update the main job entry,
         # but we want to store the output.
@@ -160,6 +271,10 @@ class Command(ReloadCommand):
                    success=success,
                    runtime=timedelta(seconds=time.time() - starttime),
                    output=output.getvalue(),
+                   queuedelay=queuedelay,
+                   cputime=timedelta(seconds=usage['cputime']) if 'cputime' in usage else None,
+                   maxrss=usage.get('maxrss', None),
+                   queries=usage.get('queries', None),
         ).save()
 
         if success and job.notifyonsuccess and output.tell():
@@ -173,27 +288,40 @@ class Command(ReloadCommand):
 
         return success
 
-    def run_internal_job(self, job, cmd):
+    def run_internal_job(self, job, cmd, usage):
         # Internal jobs are run in our own process and as such don't
         # have timeouts or anything like that.
         output = io.StringIO()
         success = False
 
+        # The connection and the CPU time are both per thread, so this
+        # only counts what this job does.
+        queries = 0
+
+        def _count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        cpustart = time.thread_time()
         try:
-            cmd.execute(no_color=True,
-                        force_color=False,
-                        skip_checks=True,
-                        stdout=output,
-                        stderr=output)
+            with connection.execute_wrapper(_count_queries):
+                cmd.execute(no_color=True,
+                            force_color=False,
+                            skip_checks=True,
+                            stdout=output,
+                            stderr=output)
             success = True
         except Exception as e:
             output.write("**** EXCEPTION ****\n")
             output.write(str(e))
             output.write("\n")
 
+        usage['cputime'] = time.thread_time() - cpustart
+        usage['queries'] = queries
         return (output, success)
 
-    def run_external_job(self, job, cmd):
+    def run_external_job(self, job, cmd, usage):
         # External jobs are run in an external process with a timeout, as set in the
         # job. If it's not set, it will be set to 2 minutes.
         timeout = getattr(cmd.ScheduledJob, 'timeout', 2)
@@ -202,13 +330,16 @@ class Command(ReloadCommand):
         fullout = io.StringIO()
         success = False
 
-        # Figure out our python
         try:
-            output = subprocess.check_output(
-                [sys.executable, os.path.abspath("{0}/../manage.py".format(settings.PROJECT_ROOT)), job.command],
-                stderr=subprocess.STDOUT,
-                timeout=timeout_seconds,
-            )
+            if settings.SCHEDULED_JOBS_FORKSERVER:
+                output = check_output_forked(job.command, timeout_seconds, usage)
+            else:
+                # Figure out our python
+                output = check_output_with_usage(
+                    [sys.executable, os.path.abspath("{0}/../manage.py".format(settings.PROJECT_ROOT)), job.command],
+                    timeout_seconds,
+                    usage,
+                )
             if output:
                 fullout.write(output.decode('utf8', errors='ignore'))
             success = True
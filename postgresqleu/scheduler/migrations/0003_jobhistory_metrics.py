@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-18 02:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('scheduler', '0002_command_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='jobhistory',
+            name='cputime',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobhistory',
+            name='maxrss',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobhistory',
+            name='queries',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='jobhistory',
+            name='queuedelay',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='jobhistory',
+            name='time',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
@@ -63,10 +63,17 @@ class ScheduledJob(models.Model):
 
 class JobHistory(models.Model):
     job = models.ForeignKey(ScheduledJob, null=False, blank=False, on_delete=models.CASCADE)
-    time = models.DateTimeField(null=False, blank=False, auto_now_add=True)
+    time = models.DateTimeField(null=False, blank=False, auto_now_add=True, db_index=True)
     success = models.BooleanField(null=False)
     runtime = models.DurationField(null=False)
     output = models.TextField(null=False, blank=True)
+    # Metrics, which are only available for some runs. Peak memory usage is in kB,
+    # and is not tracked for internal jobs since they share the process of the
+    # runner. Number of queries is only tracked for internal jobs.
+    queuedelay = models.DurationField(null=True, blank=True)
+    cputime = models.DurationField(null=True, blank=True)
+    maxrss = models.IntegerField(null=True, blank=True)
+    queries = models.IntegerField(null=True, blank=True)
 
     @property
     def first_output(self):
@@ -3,6 +3,8 @@ from django.utils import timezone
 
 from datetime import timedelta
 
+from postgresqleu.util.db import exec_to_dict
+
 
 def notify_job_change():
     with connection.cursor() as curs:
@@ -64,3 +66,43 @@ def reschedule_job(job, save=True, notify=False):
         job.save()
         if notify:
             notify_job_change()
+
+
+# Metrics tracked for each job run, as name -> (SQL expression, description).
+# Times are in seconds and memory in kB. Not all metrics are available for
+# all runs, and runs without it are ignored when summarizing.
+JOB_METRICS = {
+    'runtime': ("date_part('epoch', runtime)", "Runtime"),
+    'queuedelay': ("date_part('epoch', queuedelay)", "Delay from scheduled to actual start"),
+    'cputime': ("date_part('epoch', cputime)", "CPU time"),
+    'maxrss': ("maxrss", "Peak memory usage"),
+    'queries': ("queries", "Number of database queries"),
+}
+JOB_METRIC_QUANTILES = (0.5, 0.9, 0.99)
+
+
+# Summarize the runs of all jobs (or just one job) since the given time. Returns
+# one row per job that has run, with the number of runs and failures, and for
+# each metric a list of the values at JOB_METRIC_QUANTILES as <metric>_quantiles
+# and the maximum as <metric>_max.
+def get_job_metrics(since, jobid=None):
+    aggs = []
+    for name, (expr, desc) in JOB_METRICS.items():
+        aggs.append("percentile_cont(%(quantiles)s) WITHIN GROUP (ORDER BY {0}) AS {1}_quantiles, max({0}) AS {1}_max".format(expr, name))
+
+    return exec_to_dict("""SELECT j.id, j.app, j.command, j.description, runs, failures, {}
+FROM scheduler_scheduledjob j
+INNER JOIN (
+ SELECT job_id, count(*) AS runs, count(*) FILTER (WHERE NOT success) AS failures, {}
+ FROM scheduler_jobhistory
+ WHERE time > %(since)s AND (%(jobid)s IS NULL OR job_id=%(jobid)s)
+ GROUP BY job_id
+) h ON h.job_id=j.id
+ORDER BY j.description""".format(
+        ", ".join("{0}_quantiles, {0}_max".format(name) for name in JOB_METRICS.keys()),
+        ", ".join(aggs),
+    ), {
+        'since': since,
+        'jobid': jobid,
+        'quantiles': list(JOB_METRIC_QUANTILES),
+    })
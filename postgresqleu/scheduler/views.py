@@ -14,7 +14,33 @@ from postgresqleu.util.request import get_int_or_error
 
 from .models import ScheduledJob, JobHistory, get_config
 from .forms import ScheduledJobForm
-from .util import reschedule_job, notify_job_change
+from .util import reschedule_job, notify_job_change, get_job_metrics, JOB_METRICS, JOB_METRIC_QUANTILES
+
+
+def _format_metric(name, val):
+    if val is None:
+        return ''
+    if name == 'maxrss':
+        return '{:.1f} MB'.format(val / 1024)
+    if name == 'queries':
+        return str(int(val))
+    return '{:.2f} s'.format(val)
+
+
+# Job metrics since the given time, formatted for the metrics table, with only
+# the metrics that have any values for each job.
+def _get_metrics_summary(since, jobid=None):
+    summary = []
+    for r in get_job_metrics(since, jobid):
+        summary.append({
+            'job': r,
+            'metrics': [{
+                'description': desc,
+                'quantiles': [_format_metric(name, v) for v in r['{}_quantiles'.format(name)]],
+                'max': _format_metric(name, r['{}_max'.format(name)]),
+            } for name, (expr, desc) in JOB_METRICS.items() if r['{}_max'.format(name)] is not None],
+        })
+    return summary
 
 
 def index(request):
@@ -113,6 +139,8 @@ def job(request, jobid):
     return render(request, 'scheduler/job.html', {
         'job': job,
         'history': history,
+        'metrics': _get_metrics_summary(timezone.now() - timedelta(days=7), job.id),
+        'quantiles': JOB_METRIC_QUANTILES,
         'form': form,
         'page_range': page_range,
         'breadcrumbs': [('/admin/jobs/', 'Scheduled jobs'), ],
@@ -133,3 +161,18 @@ def history(request):
         'breadcrumbs': [('/admin/jobs/', 'Scheduled jobs'), ],
         'helplink': 'jobs',
     })
+
+
+def metrics(request):
+    if not request.user.is_superuser:
+        raise PermissionDenied("Access denied")
+
+    days = get_int_or_error(request.GET, 'days', 7)
+
+    return render(request, 'scheduler/metrics.html', {
+        'days': days,
+        'metrics': _get_metrics_summary(timezone.now() - timedelta(days=days)),
+        'quantiles': JOB_METRIC_QUANTILES,
+        'breadcrumbs': [('/admin/jobs/', 'Scheduled jobs'), ],
+        'helplink': 'jobs',
+    })
@@ -0,0 +1,87 @@
+# Run external scheduled jobs in processes forked from a "zygote" that
+# already has django set up and all the management commands imported,
+# instead of starting a new python and loading everything for every run.
+#
+# The multiprocessing forkserver does the actual forking, with the
+# zygote_preload module preloaded to do the setup. Since the forkserver
+# is a separate process that never touches the database, the forked
+# processes start out without any database connections or other state
+# from the scheduler itself.
+#
+import multiprocessing
+import os
+import resource
+import subprocess
+import tempfile
+
+
+def _run_command(command, outputfile, usagepipe):
+    # Send all output to the file, the same way as stdout and stderr are
+    # combined when running the job in a new process.
+    fd = os.open(outputfile, os.O_WRONLY)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+
+    from django.core.management import execute_from_command_line, get_commands, load_command_class
+    from postgresqleu.scheduler.zygote_preload import checks_passed
+
+    argv = ['manage.py', command]
+    app = get_commands().get(command, None)
+    if checks_passed and app and load_command_class(app, command).requires_system_checks:
+        argv.append('--skip-checks')
+    try:
+        execute_from_command_line(argv)
+    finally:
+        ru = resource.getrusage(resource.RUSAGE_SELF)
+        usagepipe.send({
+            'cputime': ru.ru_utime + ru.ru_stime,
+            'maxrss': ru.ru_maxrss,
+        })
+
+
+_context = None
+
+
+def _get_context():
+    global _context
+    if _context is None:
+        _context = multiprocessing.get_context('forkserver')
+        _context.set_forkserver_preload(['postgresqleu.scheduler.zygote_preload'])
+    return _context
+
+
+# Start the zygote in the background, so the first job doesn't have to wait
+# for all of it.
+def start_zygote():
+    from multiprocessing import forkserver
+    _get_context()
+    forkserver.ensure_running()
+
+
+# Run a management command in a process forked from the zygote. Works like
+# subprocess.check_output() with stderr included in the output, raising
+# CalledProcessError if the command fails and TimeoutExpired if it did not
+# finish within the timeout (in which case it is killed). If the process
+# exits, its CPU time and peak memory usage are added to the usage dict.
+def check_output_forked(command, timeout, usage):
+    with tempfile.NamedTemporaryFile(prefix='pgeujob_') as f:
+        r, w = _get_context().Pipe(duplex=False)
+        p = _get_context().Process(target=_run_command, args=(command, f.name, w), name=command)
+        p.start()
+        w.close()
+        p.join(timeout)
+        if p.is_alive():
+            p.kill()
+            p.join()
+            r.close()
+            raise subprocess.TimeoutExpired(command, timeout)
+
+        if r.poll():
+            usage.update(r.recv())
+        r.close()
+
+        output = f.read()
+        if p.exitcode != 0:
+            raise subprocess.CalledProcessError(p.exitcode, command, output=output)
+        return output
@@ -0,0 +1,19 @@
+# Imported in the zygote process (the multiprocessing forkserver) only, to
+# set up django and import all management commands before any jobs are
+# forked from it. See zygote.py.
+import django
+from django.core import checks
+from django.core.management import get_commands
+
+import importlib
+
+django.setup()
+
+for name, app in get_commands().items():
+    if app.startswith('django'):
+        continue
+    importlib.import_module('{}.management.commands.{}'.format(app, name))
+
+# Run the system checks once here, which also imports all the views, so the
+# jobs don't have to. If they fail, the jobs run them again to report it.
+checks_passed = not any(m.is_serious() and not m.is_silenced() for m in checks.run_checks())
@@ -285,6 +285,13 @@ SCHEDULED_JOBS_EMAIL = DEFAULT_EMAIL
 # Email to send info about scheduled jobs from
 # SCHEDULED_JOBS_EMAIL_SENDER = DEFAULT_EMAIL
 
+# Maximum number of scheduled jobs to run at the same time
+SCHEDULED_JOBS_CONCURRENCY = 4
+
+# Run external scheduled jobs in processes forked from a process that already
+# has everything loaded, instead of starting a new python for each run.
+SCHEDULED_JOBS_FORKSERVER = False
+
 # Treasurer email address. This is only used as pass-through to templates for
 # end-user reference, and never actually by the system to send and receive.
 TREASURER_EMAIL = DEFAULT_EMAIL
@@ -312,6 +319,10 @@ MEETINGS_WS_BASE_URL = None
 # be used instead of TCP.
 MEETINGS_STATUS_BASE_URL = None
 
+# Number of seconds that proxies and clients may cache public conference
+# feeds (schedule exports, news feeds etc) before they have to revalidate them.
+PUBLIC_FEED_CACHE_TIME = 60
+
 # First, attempt to load settings from a pgeu_system_settings module
 # available somewhere in the PYTHONPATH.
 try:
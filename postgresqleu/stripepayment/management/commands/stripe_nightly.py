@@ -29,6 +29,7 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_times = [time(3, 00), ]
+        concurrency_group = 'stripe'
 
         @classmethod
         def should_run(self):
@@ -17,6 +17,7 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_interval = timedelta(hours=4)
+        concurrency_group = 'stripe'
 
         @classmethod
         def should_run(self):
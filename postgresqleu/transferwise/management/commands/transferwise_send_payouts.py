@@ -18,6 +18,7 @@ class Command(BaseCommand):
     class ScheduledJob:
         scheduled_interval = timedelta(minutes=30)
         trigger_next_jobs = 'postgresqleu.transferwise.transferwise_fetch_transactions'
+        concurrency_group = 'transferwise'
 
         @classmethod
         def should_run(self):
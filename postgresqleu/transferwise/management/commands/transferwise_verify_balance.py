@@ -11,7 +11,6 @@
 
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.db.models import Sum
 from django.conf import settings
 
@@ -26,6 +25,7 @@ from postgresqleu.mailqueue.util import send_simple_mail
 from postgresqleu.transferwise.api import TransferwiseApi
 from postgresqleu.transferwise.models import TransferwisePayout
 from postgresqleu.util.checksum import luhn
+from postgresqleu.util.payment.sync import fetch_for_methods
 
 
 class Command(BaseCommand):
@@ -33,23 +33,19 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_times = [datetime.time(3, 15), ]
+        concurrency_group = 'transferwise'
 
         @classmethod
         def should_run(self):
             return InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.transferwise.Transferwise').exists()
 
-    @transaction.atomic
     def handle(self, *args, **options):
-        for method in InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.transferwise.Transferwise'):
-            self.verify_one_account(method)
+        methods = InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.transferwise.Transferwise')
+        fetch_for_methods(methods, lambda m: TransferwiseApi(m.get_implementation()).get_balance(), self.verify_one_account)
 
-    def verify_one_account(self, method):
+    def verify_one_account(self, method, tw_balance):
         pm = method.get_implementation()
 
-        api = TransferwiseApi(pm)
-
-        tw_balance = api.get_balance()
-
         accounting_balance = get_latest_account_balance(pm.config('bankaccount'))
 
         # Pending bank transactions are included in the tw_balance, but they are *not* yet
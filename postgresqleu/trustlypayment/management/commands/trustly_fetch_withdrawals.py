@@ -27,6 +27,7 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_interval = timedelta(hours=6)
+        concurrency_group = 'trustly'
 
         @classmethod
         def should_run(self):
@@ -8,7 +8,6 @@
 
 
 from django.core.management.base import BaseCommand
-from django.db import transaction
 from django.conf import settings
 
 from datetime import time
@@ -17,6 +16,7 @@ from postgresqleu.invoices.models import InvoicePaymentMethod
 from postgresqleu.trustlypayment.util import Trustly
 from postgresqleu.accounting.util import get_latest_account_balance
 from postgresqleu.mailqueue.util import send_simple_mail
+from postgresqleu.util.payment.sync import fetch_for_methods
 
 
 class Command(BaseCommand):
@@ -24,24 +24,19 @@ class Command(BaseCommand):
 
     class ScheduledJob:
         scheduled_times = [time(3, 7), ]
+        concurrency_group = 'trustly'
 
         @classmethod
         def should_run(self):
             return InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.trustly.TrustlyPayment').exists()
 
-    @transaction.atomic
     def handle(self, *args, **options):
-        for method in InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.trustly.TrustlyPayment'):
-            self.verify_one_account(method)
+        methods = InvoicePaymentMethod.objects.filter(active=True, classname='postgresqleu.util.payment.trustly.TrustlyPayment')
+        fetch_for_methods(methods, lambda m: Trustly(m.get_implementation()).get_balance(), self.verify_one_account)
 
-    def verify_one_account(self, method):
-        method = method
+    def verify_one_account(self, method, trustly_balance):
         pm = method.get_implementation()
 
-        trustly = Trustly(pm)
-
-        trustly_balance = trustly.get_balance()
-
         accounting_balance = get_latest_account_balance(pm.config('accounting_income'))
 
         if accounting_balance != trustly_balance:
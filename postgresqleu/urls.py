@@ -338,6 +338,7 @@ urlpatterns.extend([
     re_path(r'^admin/invoices/vatcache/(.*/)?$', postgresqleu.invoices.backendviews.edit_vatvalidationcache),
     re_path(r'^admin/invoices/refunds/$', postgresqleu.invoices.backendviews.refunds),
     re_path(r'^admin/invoices/refundexposure/$', postgresqleu.invoices.backendviews.refundexposure),
+    re_path(r'^admin/invoices/export/$', postgresqleu.invoices.backendviews.export),
     re_path(r'^admin/invoices/banktransactions/$', postgresqleu.invoices.backendviews.banktransactions),
     re_path(r'^admin/invoices/banktransactions/(\d+)/$', postgresqleu.invoices.backendviews.banktransactions_match),
     re_path(r'^admin/invoices/banktransactions/(\d+)/(\d+)/$', postgresqleu.invoices.backendviews.banktransactions_match_invoice),
@@ -380,6 +381,7 @@ urlpatterns.extend([
     re_path(r'^admin/jobs/$', postgresqleu.scheduler.views.index),
     re_path(r'^admin/jobs/(\d+)/$', postgresqleu.scheduler.views.job),
     re_path(r'^admin/jobs/history/$', postgresqleu.scheduler.views.history),
+    re_path(r'^admin/jobs/metrics/$', postgresqleu.scheduler.views.metrics),
 
     # Digial signatures
     re_path(r'^admin/digisign/providers/(\d+)/log/$', postgresqleu.digisign.backendviews.view_provider_log),
@@ -424,6 +426,7 @@ urlpatterns.extend([
     # Monitoring endpoints
     re_path(r'^monitor/git/$', postgresqleu.util.monitor.gitinfo),
     re_path(r'^monitor/nagios/$', postgresqleu.util.monitor.nagios),
+    re_path(r'^monitor/prometheus/$', postgresqleu.util.monitor.prometheus),
 
     # Digital assets needed to do deep-linking in the android app.
     re_path(r'^.well-known/assetlinks.json$', postgresqleu.util.views.assetlinks),
@@ -23,6 +23,7 @@ class BackendForm(ConcurrentProtectedModelForm):
     queryset_extra_fields = {}   # Goes into queryset.extra()
     queryset_extra_columns = []  # Just columns included in .only()
     queryset_calculated_fields = []  # Fields that aren't in the query at all, just added to the end
+    list_server_side = False  # Sort, search and paginate the list on the server, for long lists
     selectize_multiple_fields = None
     selectize_taglist_fields = None
     json_fields = None
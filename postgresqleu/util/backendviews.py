@@ -1,13 +1,23 @@
-from django.core.exceptions import PermissionDenied, ValidationError
+from django.core.exceptions import PermissionDenied, ValidationError, FieldDoesNotExist
 from django.db import transaction, DatabaseError
+from django.db.models import F, Q, Func, Value, DateTimeField, TextField
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Cast
 from django import forms
 from django.shortcuts import render, get_object_or_404
 from django.urls import reverse, NoReverseMatch
 from django.http import HttpResponse, HttpResponseRedirect, Http404
 from django.contrib.admin.utils import NestedObjects
 from django.contrib import messages
+from django.utils.formats import localize
+from django.utils.html import conditional_escape, linebreaks
+from django.utils.timezone import template_localtime, get_current_timezone_name
+
+import json
 
 from postgresqleu.util.lists import flatten_list
+from postgresqleu.util.markup import LineBreakString
+from postgresqleu.util.request import get_int_or_error
 from postgresqleu.confreg.util import get_authenticated_conference
 from postgresqleu.confreg.backendforms import BackendCopySelectConferenceForm
 
@@ -231,6 +241,185 @@ def backend_process_form(request, urlname, formclass, id, cancel_url='../', save
     })
 
 
+def _get_list_queryset(formclass, conference, bypass_conference_filter, object_queryset):
+    if bypass_conference_filter:
+        if object_queryset is not None:
+            return object_queryset.all()
+        return formclass.Meta.model.objects.all()
+    if hasattr(formclass.Meta, 'conference_queryset'):
+        return formclass.Meta.conference_queryset(conference).all()
+    return formclass.Meta.model.objects.filter(conference=conference)
+
+
+def _get_list_values(formclass, conference, objects):
+    cache = {}
+    return [{
+        'id': o.pk,
+        'vals': [getattr(o, '_display_{0}'.format(f))(cache) if hasattr(o, '_display_{0}'.format(f)) else getattr(o, f) for f in formclass.get_list_fields(conference)],
+    } | dict(zip(["rowclass", "rowtitle"], formclass.get_rowclass_and_title(o, cache))) for o in objects]
+
+
+# Get how each column in the list maps to the database, for lists that are sorted,
+# searched and filtered on the server. Columns that are calculated in python can't
+# be sorted or searched on.
+def _get_list_columns(formclass, conference):
+    columns = []
+    for f in formclass.get_list_fields(conference):
+        header = formclass.get_field_verbose_name(f)
+        nosearch = 'nosearch' in formclass.coltypes.get(header, [])
+        nosort = 'nosort' in formclass.coltypes.get(header, [])
+        c = {
+            'field': f,
+            'header': header,
+            'sortby': None,
+            'related': None,
+            'searchable': False,
+            'datetime': False,
+        }
+        if f in formclass.queryset_extra_fields:
+            c['sortby'] = f
+            c['searchable'] = True
+        elif f not in formclass.queryset_calculated_fields:
+            try:
+                field = formclass.Meta.model._meta.get_field(f)
+                if field.concrete and not field.many_to_many:
+                    c['sortby'] = f
+                    c['searchable'] = True
+                    if field.many_to_one:
+                        c['related'] = field.related_model
+                    c['datetime'] = isinstance(field, DateTimeField)
+            except FieldDoesNotExist:
+                pass
+        if nosort:
+            c['sortby'] = None
+        if nosearch:
+            c['searchable'] = False
+        columns.append(c)
+    return columns
+
+
+def _render_list_cell(v):
+    if isinstance(v, bool):
+        return '<i class="glyphicon glyphicon-ok"><span class="hidden">true</span></i>' if v else '<span class="hidden">false</span>'
+    if isinstance(v, LineBreakString):
+        return linebreaks(v or '', autoescape=True)
+    if not v:
+        return ''
+    return conditional_escape(localize(template_localtime(v)))
+
+
+# Get the text of a column as it's shown in the list, for searching and filtering.
+# Datetimes are shown in the current timezone, without the offset.
+def _get_list_text(formclass, c):
+    if c['field'] in formclass.queryset_extra_fields:
+        return Cast(RawSQL(formclass.queryset_extra_fields[c['field']], []), output_field=TextField())
+    if c['datetime']:
+        return Func(
+            Func(Value(get_current_timezone_name()), F(c['field']), function='timezone'),
+            Value('YYYY-MM-DD HH24:MI:SS'),
+            function='to_char',
+            output_field=TextField(),
+        )
+    return Cast(F(c['field']), output_field=TextField())
+
+
+# Return one page of a list that is sorted, searched and filtered on the server, in
+# the format used by datatables.
+def _backend_list_data(request, formclass, conference, objects):
+    columns = _get_list_columns(formclass, conference)
+    filtercolumns = formclass.get_column_filters(conference)
+    base = objects
+
+    # All the filtering and sorting is done on the text of the columns, the same way
+    # as it would be done in the browser. For columns that reference other objects
+    # that's the name of the object, so find the ones that match in python.
+    objects = objects.annotate(**{
+        '_listtext_{}'.format(i): _get_list_text(formclass, c)
+        for i, c in enumerate(columns) if c['searchable'] and not c['related']
+    })
+    if formclass.queryset_extra_fields:
+        objects = objects.annotate(**{k: RawSQL(v, []) for k, v in formclass.queryset_extra_fields.items()})
+
+    def _related_ids(c, match):
+        return [o.pk for o in c['related'].objects.filter(pk__in=base.values(c['field'])) if match(str(o))]
+
+    def _column_q(i, c, match, text_lookup, text_value):
+        if c['related']:
+            return Q(**{'{}__in'.format(c['field']): _related_ids(c, match)})
+        return Q(**{'_listtext_{}__{}'.format(i, text_lookup): text_value})
+
+    # Filters on individual columns, from the dropdowns for the columns that have them
+    for i, c in enumerate(columns):
+        v = request.GET.get('columns[{}][search][value]'.format(i), '')
+        if not v or c['header'] not in filtercolumns or not (c['searchable'] or c['related']):
+            continue
+        if c['related']:
+            empty = Q(**{'{}__isnull'.format(c['field']): True})
+        else:
+            empty = Q(**{'_listtext_{}__isnull'.format(i): True}) | Q(**{'_listtext_{}'.format(i): ''})
+        if v == '<Empty>':
+            objects = objects.filter(empty)
+        elif v == '<Any>':
+            objects = objects.exclude(empty)
+        else:
+            objects = objects.filter(_column_q(i, c, lambda s: s == v, 'exact', v))
+
+    # Global search, where each word has to match any of the searchable columns
+    for word in request.GET.get('search[value]', '').split():
+        q = Q(pk__in=[])
+        for i, c in enumerate(columns):
+            if c['searchable']:
+                q |= _column_q(i, c, lambda s: word.lower() in s.lower(), 'icontains', word)
+        objects = objects.filter(q)
+
+    order = []
+    n = 0
+    while 'order[{}][column]'.format(n) in request.GET:
+        try:
+            c = columns[int(request.GET['order[{}][column]'.format(n)])]
+        except (ValueError, IndexError):
+            return HttpResponse("Invalid sort column", status=400)
+        if c['sortby']:
+            order.append('{}{}'.format('-' if request.GET.get('order[{}][dir]'.format(n), 'asc') == 'desc' else '', c['sortby']))
+        n += 1
+    if not order and formclass.list_order_by:
+        order = list(formclass.list_order_by)
+    # Always include the primary key last, so the paging is stable
+    objects = objects.order_by(*order, 'pk')
+
+    start = get_int_or_error(request.GET, 'start')
+    length = min(max(get_int_or_error(request.GET, 'length'), 1), 1000)
+
+    page = objects
+    if formclass.queryset_select_related:
+        page = page.select_related(*formclass.queryset_select_related)
+    values = _get_list_values(formclass, conference, page[start:start + length])
+
+    allow_select = formclass.allow_email or formclass.get_assignable_columns(conference)
+    data = []
+    for o in values:
+        row = {str(i): _render_list_cell(v) for i, v in enumerate(o['vals'])}
+        row['0'] = '<a class="nocolor" href="{}/"><span class="glyphicon glyphicon-pencil" aria-hidden="true"></span></a> {}'.format(o['id'], row['0'])
+        if allow_select:
+            row['select'] = ''
+            if formclass.allow_email:
+                row['select'] += '<input class="skincheckbox mailcheckbox" type="checkbox" name="em_{0}" id="em_{0}"><label for="em_{0}"><i class="glyphicon glyphicon-envelope" title="Select entry for sending an email"></i></label>'.format(o['id'])
+            if formclass.get_assignable_columns(conference):
+                row['select'] += '<input class="skincheckbox assigncheckbox" type="checkbox" name="ass_{0}" id="ass_{0}"><label for="ass_{0}"><i class="glyphicon glyphicon-tasks" title="Select entry for assignment"></i></label>'.format(o['id'])
+        if o.get('rowclass', None):
+            row['DT_RowClass'] = o['rowclass']
+        if o.get('rowtitle', None):
+            row['DT_RowAttr'] = {'title': o['rowtitle']}
+        data.append(row)
+
+    return HttpResponse(json.dumps({
+        'draw': get_int_or_error(request.GET, 'draw'),
+        'recordsTotal': base.count(),
+        'recordsFiltered': objects.count(),
+        'data': data,
+    }), content_type='application/json')
+
+
 def backend_list_editor(request, urlname, formclass, resturl, allow_new=True, allow_delete=True, allow_save=True, conference=None, breadcrumbs=[], bypass_conference_filter=False, instancemaker=None, return_url='../', topadmin=None, object_queryset=None):
     if not conference and not bypass_conference_filter:
         conference = get_authenticated_conference(request, urlname)
@@ -242,18 +431,12 @@ def backend_list_editor(request, urlname, formclass, resturl, allow_new=True, al
 
     if resturl:
         resturl = resturl.rstrip('/')
+    if resturl == 'listdata' and formclass.list_server_side:
+        return _backend_list_data(request, formclass, conference, _get_list_queryset(formclass, conference, bypass_conference_filter, object_queryset))
+
     if resturl == '' or resturl is None:
         # Render the list of objects
-        if bypass_conference_filter:
-            if object_queryset is not None:
-                objects = object_queryset.all()
-            else:
-                objects = formclass.Meta.model.objects.all()
-        else:
-            if hasattr(formclass.Meta, 'conference_queryset'):
-                objects = formclass.Meta.conference_queryset(conference).all()
-            else:
-                objects = formclass.Meta.model.objects.filter(conference=conference)
+        objects = _get_list_queryset(formclass, conference, bypass_conference_filter, object_queryset)
         if formclass.list_order_by:
             objects = objects.order_by(*formclass.list_order_by)
 
@@ -307,17 +490,22 @@ def backend_list_editor(request, urlname, formclass, resturl, allow_new=True, al
             else:
                 raise Http404()
 
-        cache = {}
-        values = [{
-            'id': o.pk,
-            'vals': [getattr(o, '_display_{0}'.format(f))(cache) if hasattr(o, '_display_{0}'.format(f)) else getattr(o, f) for f in formclass.get_list_fields(conference)],
-        } | dict(zip(["rowclass", "rowtitle"], formclass.get_rowclass_and_title(o, cache))) for o in objects]
+        if formclass.list_server_side:
+            # The rows are loaded one page at a time from listdata/
+            values = []
+        else:
+            values = _get_list_values(formclass, conference, objects)
 
         return render(request, 'confreg/admin_backend_list.html', {
             'conference': conference,
             'basetemplate': basetemplate,
             'topadmin': topadmin,
             'values': values,
+            'serverside': formclass.list_server_side,
+            'servercolumns': [
+                {'orderable': c['sortby'] is not None, 'searchable': c['searchable']}
+                for c in _get_list_columns(formclass, conference)
+            ] if formclass.list_server_side else None,
             'title': formclass._verbose_name_plural().capitalize(),
             'singular_name': formclass._verbose_name(),
             'plural_name': formclass._verbose_name_plural(),
@@ -1,6 +1,7 @@
-from django.db import connection
+from django.db import connection, transaction
 from django.conf import settings
 import collections
+import uuid
 
 from psycopg2.extras import register_default_jsonb
 from psycopg2.tz import LocalTimezone
@@ -37,6 +38,26 @@ def exec_to_dict(query, params=None):
     return [dict(list(zip(columns, row)))for row in curs.fetchall()]
 
 
+# Generator returning the same rows as exec_to_dict, but fetched in batches
+# from a server-side cursor so the whole result never has to be held in
+# memory. The transaction the cursor lives in is kept open until the
+# generator is exhausted or closed.
+def exec_to_dict_iter(query, params=None, itersize=1000):
+    with transaction.atomic():
+        curs = connection.cursor().cursor.connection.cursor(name='pgeu_{}'.format(uuid.uuid4().hex))
+        register_default_jsonb(curs, globally=False)
+        curs.itersize = itersize
+        try:
+            curs.execute(query, params)
+            columns = None
+            for row in curs:
+                if columns is None:
+                    columns = [col[0] for col in curs.description]
+                yield dict(zip(columns, row))
+        finally:
+            curs.close()
+
+
 def exec_to_scalar(query, params=None):
     curs = get_native_cursor()
     curs.execute(query, params)
@@ -0,0 +1,38 @@
+from collections import OrderedDict
+import threading
+
+
+class LRUCache:
+    """
+    A simple size bounded cache, safe to use from multiple threads. When the cache
+    is full, the least recently used entry is evicted.
+
+    Unlike functools.lru_cache this allows the caller to decide what the key is,
+    which is needed when the key isn't simply the arguments of a function.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+                return self._data[key]
+            except KeyError:
+                return default
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
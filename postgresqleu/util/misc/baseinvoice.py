@@ -9,16 +9,21 @@ from reportlab.lib.styles import ParagraphStyle
 from reportlab.lib.utils import ImageReader
 from reportlab.platypus import Paragraph
 from reportlab.platypus.tables import Table, TableStyle
-from reportlab.platypus.flowables import Image
-from reportlab.pdfbase.pdfmetrics import registerFont, getFont
-from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfbase.pdfmetrics import getFont
 from io import BytesIO
+import functools
 
 from django.utils import timezone
 from django.conf import settings
 
 from postgresqleu.util.currency import format_currency
-from postgresqleu.util.reporttools import cm
+from postgresqleu.util.reporttools import cm, register_fonts
+
+
+# The logo is the same on all documents, so only load and decode it once
+@functools.lru_cache(maxsize=4)
+def _get_logo(filename):
+    return ImageReader(filename)
 
 
 class PDFBase(object):
@@ -39,8 +44,7 @@ class PDFBase(object):
         self.canvas.setAuthor(settings.ORG_NAME)
         self.canvas._doc.info.producer = "{0} Invoicing System".format(settings.ORG_NAME)
 
-        for font, fontfile in settings.REGISTER_FONTS:
-            registerFont(TTFont(font, fontfile))
+        register_fonts(settings.REGISTER_FONTS)
 
     def trimstring(self, s, maxlen, fontname, fontsize):
         while len(s) > 5:
@@ -79,8 +83,7 @@ class PDFBase(object):
             self.canvas.rotate(-45)
 
         if self.logo:
-            im = Image(self.logo, width=cm(3), height=cm(3))
-            im.drawOn(self.canvas, cm(2), cm(25))
+            self.canvas.drawImage(_get_logo(self.logo), cm(2), cm(25), width=cm(3), height=cm(3), mask='auto')
 
         if self.headertext:
             t = self.canvas.beginText()
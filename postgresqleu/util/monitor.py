@@ -1,12 +1,16 @@
 from django.core.exceptions import PermissionDenied
 from django.http import HttpResponse
 from django.conf import settings
+from django.utils import timezone
 
+from datetime import timedelta
 import subprocess
 import os.path
 
 from postgresqleu.util.decorators import global_login_exempt
 from postgresqleu.util.db import exec_to_scalar
+from postgresqleu.scheduler.models import ScheduledJob
+from postgresqleu.scheduler.util import get_job_metrics, JOB_METRICS, JOB_METRIC_QUANTILES
 
 
 def _validate_monitor_request(request):
@@ -86,3 +90,71 @@ def nagios(request):
         return HttpResponse("CRITICAL: {}".format(", ".join(errors)), content_type='text/plain')
     else:
         return HttpResponse("OK", content_type='text/plain')
+
+
+def _prometheus_escape(s):
+    return s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+@global_login_exempt
+def prometheus(request):
+    _validate_monitor_request(request)
+
+    # Metrics about the scheduled jobs in the Prometheus text format. The
+    # percentiles are over the runs in the last 24 hours.
+    lines = []
+
+    def _metric(name, mtype, helptext, values):
+        lines.append('# HELP {} {}'.format(name, helptext))
+        lines.append('# TYPE {} {}'.format(name, mtype))
+        for labels, v in values:
+            if labels:
+                lines.append('{}{{{}}} {}'.format(
+                    name,
+                    ','.join('{}="{}"'.format(k, _prometheus_escape(str(lv))) for k, lv in labels.items()),
+                    v,
+                ))
+            else:
+                lines.append('{} {}'.format(name, v))
+
+    _metric('pgeu_scheduler_runner_connected', 'gauge', 'If the job scheduler is connected to the database', [
+        ({}, int(exec_to_scalar("SELECT EXISTS (SELECT 1 FROM pg_stat_activity WHERE application_name='pgeu scheduled job runner' AND datname=current_database())"))),
+    ])
+
+    jobs = list(ScheduledJob.objects.only('command', 'enabled', 'lastrun', 'lastrunsuccess').order_by('command'))
+    _metric('pgeu_scheduler_job_enabled', 'gauge', 'If the job is enabled', [
+        ({'job': j.command}, int(j.enabled)) for j in jobs
+    ])
+    _metric('pgeu_scheduler_job_last_run_timestamp_seconds', 'gauge', 'Time of the last run of the job', [
+        ({'job': j.command}, j.lastrun.timestamp()) for j in jobs if j.lastrun
+    ])
+    _metric('pgeu_scheduler_job_last_run_success', 'gauge', 'If the last run of the job was successful', [
+        ({'job': j.command}, int(j.lastrunsuccess)) for j in jobs if j.lastrun
+    ])
+
+    metrics = get_job_metrics(timezone.now() - timedelta(hours=24))
+    _metric('pgeu_scheduler_job_runs', 'gauge', 'Number of runs of the job in the last 24 hours', [
+        ({'job': m['command']}, m['runs']) for m in metrics
+    ])
+    _metric('pgeu_scheduler_job_failures', 'gauge', 'Number of failed runs of the job in the last 24 hours', [
+        ({'job': m['command']}, m['failures']) for m in metrics
+    ])
+    for name, (expr, desc) in JOB_METRICS.items():
+        if name == 'maxrss':
+            # Reported in kB, but Prometheus wants base units
+            metricname, scale = 'pgeu_scheduler_job_maxrss_bytes', 1024
+        elif name == 'queries':
+            metricname, scale = 'pgeu_scheduler_job_queries', 1
+        else:
+            metricname, scale = 'pgeu_scheduler_job_{}_seconds'.format(name), 1
+
+        values = []
+        for m in metrics:
+            if m['{}_max'.format(name)] is None:
+                continue
+            for q, v in zip(JOB_METRIC_QUANTILES, m['{}_quantiles'.format(name)]):
+                values.append(({'job': m['command'], 'quantile': q}, v * scale))
+            values.append(({'job': m['command'], 'quantile': 1}, m['{}_max'.format(name)] * scale))
+        _metric(metricname, 'gauge', '{} of the job in the last 24 hours'.format(desc), values)
+
+    return HttpResponse("\n".join(lines) + "\n", content_type='text/plain; version=0.0.4')
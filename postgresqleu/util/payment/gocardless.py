@@ -5,7 +5,6 @@ from django.conf import settings
 
 import datetime
 from decimal import Decimal
-import io
 import json
 import time
 import uuid
@@ -236,8 +235,8 @@ class Gocardless(BaseManagedBankPayment):
         raise Exception("Multiple balances returned, don't know which one to use")
 
     def fetch_transactions(self):
-        notes = io.StringIO()
-
+        # Returns the transactions and the new sync date. The sync date is *not* saved,
+        # the caller has to do that once the transactions have been stored.
         params = {}
         start_date = self.method.config.get('last_sync_date', None)
         if start_date:
@@ -257,7 +256,4 @@ class Gocardless(BaseManagedBankPayment):
                     settings.CURRENCY_ISO,
                 ))
 
-        self.method.config['last_sync_date'] = str(datetime.date.today())
-        self.method.save(update_fields=['config', ])
-
-        return transactions
+        return transactions, str(datetime.date.today())
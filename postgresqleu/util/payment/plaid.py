@@ -10,7 +10,6 @@ from postgresqleu.util.widgets import StaticTextWidget, MonospaceTextarea
 from postgresqleu.util.forms import SubmitButtonField
 from postgresqleu.util.payment.banktransfer import BaseManagedBankPayment
 from postgresqleu.util.payment.banktransfer import BaseManagedBankPaymentForm
-from postgresqleu.mailqueue.util import send_simple_mail
 
 import requests
 
@@ -178,12 +177,14 @@ class Plaid(BaseManagedBankPayment):
         # Sync transactions from plaid.
         # ONLY added transactions supported at this point. Anything under removed or changed will be turned
         # into an email notification only.
+        # Returns the transactions and any such notes. The updated sync cursor is *not* saved,
+        # and the notes are not sent, the caller has to do that once the transactions have
+        # been stored.
         if 'access_token' not in self.method.config:
             print("No access token, exiting")
-            return []
+            return [], ''
 
         notes = io.StringIO()
-        initial_cursor = self.method.config.get('sync_cursor', None)
 
         param = {
             'access_token': self.method.config['access_token'],
@@ -226,19 +227,4 @@ class Plaid(BaseManagedBankPayment):
                 break
             # if we have more, we loop up to get more
 
-        if initial_cursor != self.method.config['sync_cursor']:
-            self.method.save(update_fields=['config'])
-
-        if notes.tell():
-            # Some notes were generated. We don't have a good way to handle this, so we're just going to generate an email with it...
-            send_simple_mail(
-                settings.INVOICE_SENDER_EMAIL,
-                self.method.config['notification_receiver'],
-                "Plaid transaction fetch notices for {}".format(self.method.internaldescription),
-                "Fetching plaid transactions for {} resulted in some noties:\n\n{}\n".format(
-                    self.method.internaldescription,
-                    notes.getvalue(),
-                ),
-            )
-
-        return transactions
+        return transactions, notes.getvalue()
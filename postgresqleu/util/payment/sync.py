@@ -0,0 +1,119 @@
+from django.db import connection, transaction
+from django.utils import timezone
+
+from concurrent.futures import ThreadPoolExecutor
+import itertools
+import sys
+import traceback
+
+# Number of provider transactions to dedupe and insert per round-trip
+SYNC_PAGE_SIZE = 500
+
+# Max number of accounts to talk to the same provider for at once
+FETCH_MAX_WORKERS = 4
+
+
+def fetch_for_methods(methods, fetch, process, maxworkers=FETCH_MAX_WORKERS):
+    """Call fetch(method) for all payment methods in parallel, and then
+    process(method, result) for each of them in turn.
+
+    fetch is intended for the slow part of talking to the provider only, and
+    should not write to the database. Anything that does should be done in
+    process, which is called in the main thread in a separate transaction for
+    each method, in the same order as methods.
+
+    A failure to fetch or process one method does not stop the others from
+    being processed. Once all methods have been handled, an exception listing
+    each method that failed is raised.
+
+    If there is more than one method, fetch runs in a separate thread with its
+    own database connection.
+    """
+    methods = list(methods)
+
+    def _fetch(method):
+        try:
+            return fetch(method), None
+        except Exception as e:
+            return None, e
+
+    def _fetch_in_thread(method):
+        try:
+            return _fetch(method)
+        finally:
+            connection.close()
+
+    if len(methods) < 2:
+        results = [_fetch(m) for m in methods]
+    else:
+        with ThreadPoolExecutor(max_workers=min(maxworkers, len(methods))) as executor:
+            results = list(executor.map(_fetch_in_thread, methods))
+
+    failures = []
+    for method, (result, e) in zip(methods, results):
+        try:
+            if e is not None:
+                raise e
+            with transaction.atomic():
+                process(method, result)
+        except Exception as e:
+            failures.append((method, e))
+            traceback.print_exception(e, file=sys.stderr)
+
+    if failures:
+        raise Exception("Failed to process {} of {} payment methods:\n{}".format(
+            len(failures),
+            len(methods),
+            "\n".join("{}: {}".format(m.internaldescription, e) for m, e in failures),
+        ))
+
+
+def sync_provider_transactions(method, model, idfield, records, normalize, per_method=True, synctime=None, pagesize=SYNC_PAGE_SIZE):
+    """Store transactions fetched from a payment provider.
+
+    records is an iterable of provider transactions, and normalize a function
+    that turns one of them into a dict of field values for model (including
+    idfield, which is the provider's id of the transaction). Records are
+    handled in pages, where the already known ids are looked up with a single
+    query and the new ones are inserted with a single bulk insert.
+
+    Returns a list of tuples of (object, record) for each transaction that
+    was added, in the order they were received. Once all records have been
+    stored, the time of the sync is stored in the status of the payment method
+    as lastsync. If the records were fetched earlier, the time that was done
+    should be passed as synctime.
+
+    If per_method is set, the provider id is only unique within the payment
+    method, otherwise it's unique across all methods of the provider.
+    """
+    if not synctime:
+        synctime = timezone.now()
+    seen = set()
+    added = []
+
+    records = iter(records)
+    while True:
+        page = [(normalize(r), r) for r in itertools.islice(records, pagesize)]
+        if not page:
+            break
+
+        existing = model.objects.filter(**{'{}__in'.format(idfield): [f[idfield] for f, r in page]})
+        if per_method:
+            existing = existing.filter(paymentmethod=method)
+        seen.update(existing.values_list(idfield, flat=True))
+
+        new = []
+        for fields, r in page:
+            if fields[idfield] in seen:
+                continue
+            seen.add(fields[idfield])
+            new.append((model(paymentmethod=method, **fields), r))
+
+        if new:
+            model.objects.bulk_create([o for o, r in new])
+            added.extend(new)
+
+    method.status['lastsync'] = synctime
+    method.save(update_fields=['status'])
+
+    return added
@@ -2,12 +2,18 @@ from PIL import Image
 import base64
 from io import BytesIO
 
+from postgresqleu.util.lrucache import LRUCache
+
+
+# The same QR codes get generated over and over again, for example for the
+# tickets, badges and emails of a registration, so keep the generated images
+# keyed by content, version and size. Many of them contain secret tokens, so
+# they are only ever kept in memory, in a cache of bounded size.
+_qr_cache = LRUCache(5000)
 
-# Support both the qrcode library (current) and the qrencode one (legacy)
-def generate_base64_qr(s, version, requested_size):
-    if not version:
-        version = 5
 
+# Support both the qrcode library (current) and the qrencode one (legacy)
+def _generate_qr_png(s, version, requested_size):
     try:
         import qrcode
 
@@ -18,7 +24,7 @@ def generate_base64_qr(s, version, requested_size):
 
             (ver, size, qrimage) = qrencode.encode(s, version=version, level=qrencode.QR_ECLEVEL_M)
         except ImportError:
-            return ""
+            return None
 
     if qrimage.size[0] != requested_size:
         if qrimage.size[0] < requested_size:
@@ -29,4 +35,29 @@ def generate_base64_qr(s, version, requested_size):
 
     b = BytesIO()
     qrimage.save(b, "png")
-    return base64.b64encode(b.getvalue()).decode('ascii')
+    return b.getvalue()
+
+
+def store_qr_png(s, version, requested_size, png):
+    _qr_cache.set((s, version or 5, requested_size), png)
+
+
+# Return a QR code for the string as a PNG image, or None if there is no QR
+# library available.
+def get_qr_png(s, version, requested_size):
+    key = (s, version or 5, requested_size)
+    png = _qr_cache.get(key)
+    if png is not None:
+        return png
+
+    png = _generate_qr_png(s, version or 5, requested_size)
+    if png is not None:
+        store_qr_png(s, version, requested_size, png)
+    return png
+
+
+def generate_base64_qr(s, version, requested_size):
+    png = get_qr_png(s, version, requested_size)
+    if png is None:
+        return ""
+    return base64.b64encode(png).decode('ascii')
@@ -1,4 +1,6 @@
 from reportlab.lib import units
+from reportlab.pdfbase.pdfmetrics import registerFont
+from reportlab.pdfbase.ttfonts import TTFont
 
 
 def cm(n):
@@ -7,3 +9,14 @@ def cm(n):
 
 def mm(n):
     return n * units.mm
+
+
+# Parsing the font files is expensive, so only do it once per process
+_registered_fonts = {}
+
+
+def register_fonts(fonts):
+    for font, fontfile in fonts:
+        if _registered_fonts.get(font, None) != fontfile:
+            registerFont(TTFont(font, fontfile))
+            _registered_fonts[font] = fontfile
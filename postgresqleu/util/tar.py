@@ -1,5 +1,7 @@
 import io
 import tarfile
+import time
+import zipfile
 
 
 class TarStreamer:
@@ -14,11 +16,13 @@ class TarStreamer:
     def tell(self):
         return self.ofs
 
+    def flush(self):
+        pass
+
     def close(self):
         self.buf.close()
 
     def pop(self):
-        print("Returning {} bytes at offset {}".format(len(self.buf.getvalue()), self.ofs))
         s = self.buf.getvalue()
         self.buf.close()
         self.buf = io.BytesIO()
@@ -56,3 +60,18 @@ def generate_streaming_tar(tar_generator):
         yield streamer.pop()
     tar.close()
     yield streamer.pop()
+
+
+# Same as generate_streaming_tar, but generating a zip file. The streamer can't
+# seek, so zipfile writes the sizes and checksums after the data of each file.
+def generate_streaming_zip(zip_generator):
+    streamer = TarStreamer()
+    zf = zipfile.ZipFile(streamer, mode='w', compression=zipfile.ZIP_DEFLATED)
+    for name, mtime, data, datalen in zip_generator():
+        info = zipfile.ZipInfo(name, time.localtime(int(mtime))[:6])
+        info.compress_type = zipfile.ZIP_DEFLATED
+        with zf.open(info, mode='w') as f:
+            f.write(data)
+        yield streamer.pop()
+    zf.close()
+    yield streamer.pop()